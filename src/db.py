@@ -18,7 +18,7 @@
 #              administrators to prevent traffic from those networks from     #
 #              entering or leaving the network.                               #
 #                                                                             #
-# INPUT: None                                                                 #
+# INPUT: Optional command line arguments (see ./db.py --help)                 #
 #                                                                             #
 # OUTPUT: STDOUT                                                              #
 #                                                                             #
@@ -48,6 +48,12 @@
 from scapy.all import *
 import ipaddress
 import time
+import argparse
+import contextlib
+import os
+import sys
+
+import pf #./pf.py, worker pool for --workers
 
 
 
@@ -76,12 +82,23 @@ def capturePackets(packet):
     
 
 
+    #skip packets without an IP layer
+    if IP not in packet:
+
+        return
+
+
+
+    #networks can only be checked against ip_address objects, not strings
+    source = ipaddress.ip_address(packet[IP].src)
+
+
+
     #check for bogon networks
-    if IP in packet \
-    and (any(packet[IP].src in net for net in private) \
-    or any(packet[IP].src in net for net in loopback) \
-    or any(packet[IP].src in net for net in reserved) \
-    or any(packet[IP].src in net for net in multicast)):
+    if any(source in net for net in private) \
+    or any(source in net for net in loopback) \
+    or any(source in net for net in reserved) \
+    or any(source in net for net in multicast):
         
 
 
@@ -90,6 +107,70 @@ def capturePackets(packet):
 
 
 
+def sniffWorker(groupid):
+    '''
+    Runs the bogon check in a --workers process on its fanout share of the
+    traffic of the interface.
+    '''
+
+    sock = conf.L2listen(iface=interface, filter="")
+    pf.joinFanout(sock.ins, groupid)
+
+    sniff(opened_socket=sock, prn=pf.counted(capturePackets), store=0)
+
+
+
+def benchmarkWorker(groupid):
+    '''
+    Runs sniffWorker with the alerts muted, for --benchmark.
+    '''
+
+    with open(os.devnull, 'w') as devnull, \
+    contextlib.redirect_stdout(devnull):
+
+        sniffWorker(groupid)
+
+
+
+#parse command line arguments
+parser = argparse.ArgumentParser(description="Check for bogon traffic")
+parser.add_argument("--workers", type=int, default=1, \
+                    help="number of capture processes sharing the traffic \
+through PACKET_FANOUT (default: 1)")
+parser.add_argument("--benchmark", type=float, metavar="SECONDS", \
+                    help="measure packets per second with 1 up to --workers \
+processes for SECONDS each, then exit")
+args = parser.parse_args()
+
+
+
+#measure how the packets per second scale with the number of workers
+if args.benchmark:
+
+    print(f"\n\n\nBenchmarking 1 to {args.workers} workers for \
+{args.benchmark} seconds each. Generate traffic now...\n")
+
+    rates = [pf.runWorkers(workers, benchmarkWorker, duration=args.benchmark) \
+             for workers in range(1, args.workers + 1)]
+
+    print("\n\n\nScaling:")
+    print("--------")
+
+
+
+    for workers, pps in enumerate(rates, 1):
+
+        scaling = pps / max(rates[0], 1e-9)
+
+        print(f"{workers:>3} workers: {pps:12.0f} packets/s, \
+{pps / workers:12.0f} per worker, {scaling:5.2f}x one worker")
+
+
+
+    sys.exit(0)
+
+
+
 #sniff on simgle interfaces
 print("\n\n\nPotential bogon src IPs will be printed. Over 99% will be false \
 positives. If you want a record outside of STDOUT, restart this script and \
@@ -101,5 +182,14 @@ time.sleep(5)
 
 print("\n\n\nChecking for potential bogon traffic...\n\n\n")
 
+#spread the traffic over several processes
+if args.workers > 1:
+
+    pf.runWorkers(args.workers, sniffWorker)
+
+    sys.exit(0)
+
+
+
 #store=0 keeps the memory clear
 sniff(prn=capturePackets, filter="", store=0, iface=interface)
\ No newline at end of file
@@ -45,7 +45,7 @@
 #                  abnormal network behavior, such as unexpected drops in     #
 #                  network performance or network outages.                    #
 #                                                                             #
-# INPUT: None                                                                 #
+# INPUT: Optional command line arguments (see ./dc.py --help)                 #
 #                                                                             #
 # OUTPUT: STDOUT                                                              #
 #                                                                             #
@@ -68,42 +68,918 @@
 
 #import dependencies
 from scapy.all import *
+from array import array
+import argparse
+import bisect
+import collections
+import math
+import operator
 import psutil
-import os
+import queue
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import pf #./pf.py, worker pool for --workers
+
+
+
+#declare constants
+RTTTTL = 60 #seconds a measured RTT is reused before the host is probed again
+RTTCACHESIZE = 4096 #hosts whose RTT is remembered
+RTTQUEUESIZE = 256 #probes waiting to be sent, further requests are skipped
+RTTPATTERN = re.compile(r"time=([\d.]+) ms")
+SAMPLEHISTORY = 60 #interface counter samples kept per interface
+MAXSENDRATE = 1e8 #bytes/s sent on an interface considered excessive
+SKETCHWIDTH = 2048 #counters per Count-Min Sketch row
+SKETCHDEPTH = 4 #rows (hash functions) per Count-Min Sketch
+ICMPWINDOW = 10 #seconds the ICMP rate of a source is measured over
+ICMPBUCKETS = 10 #sub-windows the sliding window moves by
+HASHPRIME = (1 << 61) - 1 #modulus of the sketch hash functions
+MAXPAIRS = 250000 #src/dst pairs whose timing is tracked
+MININTERVAL = 0.01 #seconds between packets of a pair considered too fast
+BURSTCOUNT = 5 #too fast intervals a pair needs before it counts as a burst
+BEACONMIN = 10 #intervals since its last report a pair needs to beacon
+BEACONCV = 0.1 #stddev / mean of the intervals below which a pair beacons
+BEACONMININTERVAL = 2 #seconds, ping's default 1 s cadence and faster steady
+                      #traffic are left to the rate and burst checks
+BEACONDECAY = 0.125 #weight of the newest interval in the mean and variance
+TIMINGEDGES = [0.001, 0.01, 0.1, 1, 10, 60, 300] #histogram bin edges (s)
+TIMINGBINS = len(TIMINGEDGES) + 1 #histogram counters per pair
+MINPAYLOAD = 8 #bytes a payload needs before it is classified
+MINENCODED = 16 #bytes of base64/hex text a payload needs to count as encoded
+BASE64BYTES = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz\
+0123456789+/=\r\n")
+HEXBYTES = frozenset(b"0123456789abcdefABCDEF")
+KEYWORDCOVERT = 1 #payload keyword classes, or'd together in a bitmask
+KEYWORDENCODED = 2
+KEYWORDSHELL = 4
+KEYWORDS = {b"steg": KEYWORDCOVERT, \
+            b"b64": KEYWORDENCODED, \
+            b"powershell": KEYWORDSHELL, \
+            b"bash": KEYWORDSHELL, \
+            b"cmd": KEYWORDSHELL, \
+            b"sh": KEYWORDSHELL}
+KEYWORDPATTERN = re.compile(b"|".join(map(re.escape, KEYWORDS)), re.IGNORECASE)
+ECHOTIMEOUT = 10 #seconds an echo request waits for its reply
+ECHOSLOTS = 64 #slots of the timer wheel that expires echo requests
+ECHOREQUEST = 8 #ICMP types
+ECHOREPLY = 0
+ECHOMATCHED = 1 #outcomes of pairing an echo reply with its request
+ECHOMISMATCHED = 2
+ECHOUNSOLICITED = 3
 
 
 
 #declare variables
-lasticmppackettime = 0
-icmppacketcounts = {}
+interfaces = ["wlp1s0"] #replace with the interfaces you want monitored
+
+
+
+#define classes
+class RttProber:
+    '''
+    Measures round trip times in a background thread so the sniff callback
+    never waits on a ping. Each host is probed at most once per RTTTTL
+    seconds; the results are kept in a bounded least recently used map and
+    lastRtt() only ever reads it.
+    '''
+
+    def __init__(self, ttl, cachesize, queuesize):
+
+        self.ttl = ttl
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict() #host: [rtt ms, queued at]
+        self.pending = queue.Queue(maxsize=queuesize)
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+
+    def lastRtt(self, host):
+        '''
+        Returns the last RTT measured to host in ms, or None if it is unknown
+        or the host didn't answer. A probe is queued when there is no result
+        or the result is older than the TTL.
+        '''
+
+        #the thread is started here so every --workers process gets its own
+        if self.thread is None:
+
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+
+        now = time.monotonic()
+
+
+
+        with self.lock:
+
+            entry = self.cache.get(host)
+
+
+
+            if entry is None:
+
+                entry = [None, None]
+                self.cache[host] = entry
+
+
+
+                if len(self.cache) > self.cachesize:
+
+                    self.cache.popitem(last=False)
+
+
+
+            #a host is only stamped as probed once its probe is queued, so a
+            #full queue leaves it to be retried on the next packet
+            if entry[1] is None or now - entry[1] > self.ttl:
+
+                if self.schedule(host):
+
+                    entry[1] = now
+
+
+
+            self.cache.move_to_end(host)
+
+
+
+            return entry[0]
+
+
+
+    def schedule(self, host):
+        '''
+        Queues a probe of host and returns whether there was room for it.
+        '''
+
+        try:
+
+            self.pending.put_nowait(host)
+
+        except queue.Full:
+
+            return False
+
+
+
+        return True
+
+
+
+    def run(self):
+
+        while True:
+
+            host = self.pending.get()
+            rtt = ping(host)
+
+
+
+            with self.lock:
+
+                entry = self.cache.get(host)
+
+
+
+                if entry is not None:
+
+                    entry[0] = rtt
+
+
+
+class IfaceSampler:
+    '''
+    Polls the counters of every interface in a background thread every
+    interval seconds instead of reading /proc/net/dev on every packet. The
+    last SAMPLEHISTORY samples of each interface are kept in a ring buffer
+    and the current rates are worked out once per sample, so detectors read
+    them with a single dict lookup.
+    '''
+
+    def __init__(self, interval, history):
+
+        self.interval = interval
+        self.history = history
+        self.samples = {} #interface: deque of (time, sent, recv, psent, precv)
+        self.rates = {} #interface: (sent, recv, psent, precv) per second
+        self.thread = None
+
+
+
+    def start(self):
+
+        #started on first use so every --workers process gets its own
+        if self.thread is None:
+
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+
+    def run(self):
+
+        while True:
+
+            self.sample()
+
+            time.sleep(self.interval)
+
+
+
+    def sample(self):
+
+        now = time.monotonic()
+        rates = {}
+
+
+
+        for name, counters in psutil.net_io_counters(pernic=True).items():
+
+            samples = self.samples.get(name)
+
+
+
+            if samples is None:
+
+                samples = collections.deque(maxlen=self.history)
+                self.samples[name] = samples
+
+
+
+            samples.append((now, \
+                            counters.bytes_sent, \
+                            counters.bytes_recv, \
+                            counters.packets_sent, \
+                            counters.packets_recv))
+
+
+
+            if len(samples) > 1:
+
+                rates[name] = self.perSecond(samples[-2], samples[-1])
+
+
+
+        #swap the whole dict so readers never see it half updated
+        self.rates = rates
+
+
+
+    def perSecond(self, first, last):
+
+        elapsed = max(last[0] - first[0], 1e-9)
+
+
+
+        #counters that went backwards were reset, count them as idle
+        return tuple(max(end - start, 0) / elapsed \
+                     for start, end in zip(first[1 :], last[1 :]))
+
+
+
+    def rate(self, name):
+        '''
+        Returns the (bytes sent, bytes received, packets sent, packets
+        received) per second of an interface over the last interval, or None
+        before two samples were taken.
+        '''
+
+        self.start()
+
+
+
+        return self.rates.get(name)
+
+
+
+    def delta(self, name):
+        '''
+        Returns the same rates averaged over the whole sample history.
+        '''
+
+        samples = self.samples.get(name)
+
+
+
+        if not samples or len(samples) < 2:
+
+            return None
+
+
+
+        return self.perSecond(samples[0], samples[-1])
+
+
+
+class CountMinWindow:
+    '''
+    Counts ICMP packets per source over a sliding window in fixed memory.
+    The window is split into buckets, each a Count-Min Sketch of depth rows
+    by width counters, plus a running total of all buckets. A packet adds 1
+    to one counter per row of the current bucket and of the total; the
+    estimate for a source is its smallest counter in the total, which can
+    overcount on hash collisions but never undercounts. When time moves into
+    a new bucket the oldest bucket is subtracted from the total and cleared,
+    so memory is (buckets + 1) * depth * width counters no matter how many
+    sources are seen.
+    '''
+
+    '''
+    With topk > 0 the topk sources with the highest estimates are also
+    counted exactly, per bucket, so the heavy hitters can be reported without
+    the sketch's overcounting. A source replaces the smallest tracked one
+    once its estimate is higher.
+    '''
+
+    def __init__(self, width, depth, window, buckets, topk):
+
+        self.width = width
+        self.depth = depth
+        self.bucketseconds = window / buckets
+        self.zeros = array('I', bytes(4 * width * depth))
+        self.buckets = [array('I', self.zeros) for i in range(buckets)]
+        self.total = array('I', self.zeros)
+        self.tick = 0
+        self.hashes = [(random.getrandbits(60) | 1, random.getrandbits(60)) \
+                       for i in range(depth)]
+        self.topk = topk
+        self.heavy = {} #source: exact count per bucket
+        self.floor = 0 #smallest exact count among the heavy sources
+
+
+
+    def advance(self, now):
+
+        tick = int(now // self.bucketseconds)
+
+
+
+        if tick <= self.tick:
+
+            return
+
+
+
+        #expire the buckets that fell out of the window
+        for i in range(1, min(tick - self.tick, len(self.buckets)) + 1):
+
+            slot = (self.tick + i) % len(self.buckets)
+            self.total = array('I', map(operator.sub, \
+                                        self.total, \
+                                        self.buckets[slot]))
+            self.buckets[slot][:] = self.zeros
+
+
+
+            for counts in self.heavy.values():
+
+                counts[slot] = 0
+
+
+
+        self.tick = tick
+        self.heavy = {source: counts \
+                      for source, counts in self.heavy.items() if any(counts)}
+        self.floor = min(map(sum, self.heavy.values()), default=0)
+
+
+
+    def add(self, source, now):
+        '''
+        Counts a packet from source and returns the estimated number of
+        packets it sent within the window.
+        '''
+
+        self.advance(now)
+
+        slot = self.tick % len(self.buckets)
+        bucket = self.buckets[slot]
+        total = self.total
+        key = hash(source)
+        estimate = None
+
+
+
+        for row, (a, b) in enumerate(self.hashes):
+
+            index = row * self.width + ((a * key + b) % HASHPRIME) % self.width
+            bucket[index] += 1
+            total[index] += 1
+
+
+
+            if estimate is None or total[index] < estimate:
+
+                estimate = total[index]
+
+
+
+        if self.topk:
+
+            self.countHeavy(source, slot, estimate)
+
+
+
+        return estimate
+
+
+
+    def countHeavy(self, source, slot, estimate):
+
+        counts = self.heavy.get(source)
+
+
+
+        if counts is not None:
+
+            counts[slot] += 1
+
+            return
+
+
+
+        if len(self.heavy) >= self.topk:
+
+            #the floor only goes stale upwards, refresh it before replacing
+            if estimate > self.floor:
+
+                self.floor = min(map(sum, self.heavy.values()))
+
+
+
+            if estimate <= self.floor:
+
+                return
+
+
+
+            smallest = min(self.heavy, key=lambda name: sum(self.heavy[name]))
+            del self.heavy[smallest]
+
+
+
+        counts = [0] * len(self.buckets)
+        counts[slot] = 1
+        self.heavy[source] = counts
+        self.floor = min(map(sum, self.heavy.values()))
+
+
+
+    def topSources(self):
+        '''
+        Returns the exactly counted heavy hitters as (source, packets in the
+        window), highest first.
+        '''
+
+        return sorted(((source, sum(counts)) \
+                       for source, counts in self.heavy.items()), \
+                      key=lambda item: item[1], \
+                      reverse=True)
+
+
+
+class PairTiming:
+    '''
+    Inter-arrival statistics of the ICMP packets from one source to one
+    destination in a fixed-size record: the last arrival and interval, a
+    streaming mean and variance and a histogram of the intervals on the
+    TIMINGEDGES bins. The mean and variance are exponentially decayed
+    (BEACONDECAY), so no intervals are stored and a pair that only starts
+    to beacon late is still found. The histogram counters live in one
+    array shared by all pairs of a PairTimings, at TIMINGBINS counters from
+    the slot of the pair, instead of in an array object per pair.
+    '''
+
+    __slots__ = ('last', 'interval', 'count', 'mean', 'variance', \
+                 'histogram', 'slot')
+
+
+
+    def __init__(self, now, histogram, slot):
+
+        self.last = now
+        self.interval = None
+        self.count = 0 #intervals since the pair was last reported
+        self.mean = 0.0
+        self.variance = 0.0
+        self.histogram = histogram
+        self.slot = slot
+
+
+
+    def update(self, now):
+
+        interval = max(now - self.last, 0.0)
+        self.last = now
+        self.interval = interval
+
+
+
+        #exponentially decayed update of the mean and variance
+        if self.count == 0 and self.mean == 0.0:
+
+            self.mean = interval
+
+        else:
+
+            delta = interval - self.mean
+            self.mean += BEACONDECAY * delta
+            self.variance = (1 - BEACONDECAY) * \
+                            (self.variance + BEACONDECAY * delta * delta)
+
+
+
+        self.count += 1
+        self.histogram[self.slot * TIMINGBINS + \
+                       bisect.bisect_right(TIMINGEDGES, interval)] += 1
+
+
+
+    def isBurst(self):
+        '''
+        The last packet came too fast after the one before, and the pair has
+        done that often enough not to be a one-off.
+        '''
+
+        start = self.slot * TIMINGBINS
+
+
+
+        return self.interval is not None \
+        and self.interval < MININTERVAL \
+        and self.histogram[start] + self.histogram[start + 1] >= BURSTCOUNT
+
+
+
+    def isBeacon(self):
+        '''
+        The pair sends at a steady, slow pace: the spread of its intervals is
+        small compared to their mean. A pair that is reported starts counting
+        its intervals again, so a beacon is reported once every BEACONMIN
+        intervals rather than on every packet after it was first found.
+        '''
+
+        if self.count < BEACONMIN or self.mean < BEACONMININTERVAL:
+
+            return False
+
+
+
+        if math.sqrt(self.variance) / self.mean >= BEACONCV:
+
+            return False
+
+
+
+        self.count = 0
+
+
+
+        return True
+
+
+
+class PairTimings:
+    '''
+    Maps (src, dst) to its PairTiming, keeping at most maxpairs pairs. The
+    least recently seen pair is evicted for a new one, which takes over its
+    slot in the shared histogram, so memory is bounded and every update is
+    O(1).
+    '''
+
+    def __init__(self, maxpairs):
+
+        self.maxpairs = maxpairs
+        self.pairs = collections.OrderedDict()
+        self.histogram = array('I') #TIMINGBINS counters per slot
+
+
+
+    def update(self, src, dst, now):
+
+        key = (src, dst)
+        timing = self.pairs.get(key)
+
+
+
+        if timing is None:
+
+            #reuse the slot of the evicted pair or add one at the end
+            if len(self.pairs) >= self.maxpairs:
+
+                slot = self.pairs.popitem(last=False)[1].slot
+                start = slot * TIMINGBINS
+                self.histogram[start : start + TIMINGBINS] = \
+                    array('I', bytes(4 * TIMINGBINS))
+
+            else:
+
+                slot = len(self.pairs)
+                self.histogram.frombytes(bytes(4 * TIMINGBINS))
+
+
+
+            timing = PairTiming(now, self.histogram, slot)
+            self.pairs[key] = timing
+
+
+
+            return timing
+
+
+
+        self.pairs.move_to_end(key)
+        timing.update(now)
+
+
+
+        return timing
+
+
+
+class PayloadFeatures:
+    '''
+    What the payload checks need to know about an ICMP payload, worked out
+    from one byte histogram: the length, the count of bytes per class,
+    whether all bytes are in the base64 or hex alphabet and a bitmask of the
+    keyword classes found in it. The payload is never decoded or copied into
+    a str.
+    '''
+
+    __slots__ = ('length', 'upper', 'lower', 'digit', 'control', 'highbit', \
+                 'isbase64', 'ishex', 'keywords')
+
+
+
+    def __init__(self, load):
+
+        self.length = len(load)
+        self.upper = self.lower = self.digit = self.control = self.highbit = 0
+        histogram = collections.Counter(load)
+
+
+
+        #one walk over the distinct byte values gives the classes
+        for byte, count in histogram.items():
+
+            if byte >= 0x80:
+
+                self.highbit += count
+
+            elif byte < 0x20 or byte == 0x7f:
+
+                self.control += count
+
+            elif 0x41 <= byte <= 0x5a:
+
+                self.upper += count
+
+            elif 0x61 <= byte <= 0x7a:
+
+                self.lower += count
+
+            elif 0x30 <= byte <= 0x39:
+
+                self.digit += count
+
+
+
+        self.isbase64 = histogram.keys() <= BASE64BYTES
+        self.ishex = histogram.keys() <= HEXBYTES
+        self.keywords = 0
+
+
+
+        for match in KEYWORDPATTERN.finditer(load):
+
+            self.keywords |= KEYWORDS[match.group().lower()]
+
+
+
+    def isEncoded(self):
+        '''
+        The payload reads like base64 or hex text. Real base64 data mixes upper
+        and lower case, which keeps the letter-only padding of Windows pings
+        from matching, unless the payload is labeled with a "b64" marker.
+        '''
+
+        if self.length < MINENCODED:
+
+            return False
+
+
+
+        if self.keywords & KEYWORDENCODED and self.isbase64:
+
+            return True
+
+
+
+        if self.ishex:
+
+            return self.digit > 0
+
+
+
+        return self.isbase64 and self.upper > 0 and self.lower > 0
+
+
+
+class EchoTable:
+    '''
+    Pairs ICMP echo replies with their requests. An outstanding request is
+    stored under (src, dst, id, seq) with the hash of its payload, and the
+    reply is looked up under (dst, src, id, seq): a reply has to echo the
+    payload of its request, so a different hash or no request at all is a
+    sign of data riding in the replies.
+    '''
+
+    '''
+    Requests expire on a timer wheel of ECHOSLOTS slots spanning the timeout:
+    a request is listed in the slot of the tick it arrived in, and moving to
+    a new tick drops the requests of the slot it reuses, so expiry costs O(1)
+    per request. A request answered, sent again or evicted leaves its slot
+    at once, so the slots never list more than the maxentries requests held;
+    past maxentries the oldest is evicted. len() gives the number of
+    requests held.
+    '''
+
+    def __init__(self, timeout, slots, maxentries):
+
+        self.tickseconds = timeout / slots
+        self.slots = [set() for i in range(slots)]
+        self.tick = None
+        self.maxentries = maxentries
+        self.entries = {} #(src, dst, id, seq): (payload hash, tick)
+        self.counters = collections.Counter()
+
+
+
+    def __len__(self):
+
+        return len(self.entries)
+
+
+
+    def advance(self, now):
+
+        tick = int(now // self.tickseconds)
+
+
+
+        if self.tick is None:
+
+            self.tick = tick
+
+
+
+        #expire the requests of the slots the wheel moves over
+        for i in range(1, min(tick - self.tick, len(self.slots)) + 1):
+
+            slot = self.slots[(self.tick + i) % len(self.slots)]
+
+
+
+            for key in slot:
+
+                del self.entries[key]
+
+
+
+            self.counters["expired"] += len(slot)
+            slot.clear()
+
+
+
+        self.tick = max(tick, self.tick)
+
+
+
+    def remove(self, key):
+        '''
+        Removes the request stored under key from the table and its slot and
+        returns its entry, or None.
+        '''
+
+        entry = self.entries.pop(key, None)
+
+
+
+        if entry is not None:
+
+            self.slots[entry[1] % len(self.slots)].discard(key)
+
+
+
+        return entry
+
+
+
+    def request(self, key, payload, now):
+
+        self.advance(now)
+        self.remove(key)
+        self.entries[key] = (hash(payload), self.tick)
+        self.slots[self.tick % len(self.slots)].add(key)
+        self.counters["requests"] += 1
+
+
+
+        if len(self.entries) > self.maxentries:
+
+            self.remove(next(iter(self.entries)))
+            self.counters["evicted"] += 1
+
+
+
+    def reply(self, key, payload, now):
+        '''
+        Returns ECHOMATCHED, ECHOMISMATCHED or ECHOUNSOLICITED for a reply
+        whose request would be stored under key.
+        '''
+
+        self.advance(now)
+        self.counters["replies"] += 1
+        entry = self.remove(key)
+
+
+
+        if entry is None:
+
+            self.counters["unsolicited"] += 1
+
+            return ECHOUNSOLICITED
+
+
+
+        if entry[0] != hash(payload):
+
+            self.counters["mismatched"] += 1
+
+            return ECHOMISMATCHED
+
+
+
+        return ECHOMATCHED
 
 
 
 #define functions
 def icmpTunnelingDetector(pkt):
 
-    if isUnusualIcmpTraffic(pkt):
+    #update the timing of the src/dst pair once for both timing checks
+    timing = pairtimings.update(pkt[IP].src, pkt[IP].dst, float(pkt.time))
+
+
+
+    #classify the payload once for both payload checks
+    features = None
+
+
+
+    if pkt.haslayer(Raw) and len(pkt[Raw].load) >= MINPAYLOAD:
+
+        features = PayloadFeatures(pkt[Raw].load)
+
+
+
+    if isMismatchedEchoReply(pkt):
+
+        print(f"Echo reply not matching its request detected from \
+{pkt[IP].src} to {pkt[IP].dst}")
+
+
+
+    if isUnusualIcmpTraffic(pkt, timing):
 
         print(f"Unusual ICMP traffic pattern detected from {pkt[IP].src} to \
 {pkt[IP].dst}")
 
 
 
-    if isCoverChannel(pkt):
+    if isCoverChannel(features):
 
         print(f"Covert channel detected in ICMP packet from {pkt[IP].src} to \
 {pkt[IP].dst}")
 
 
 
-    if isSuspiciousPayload(pkt):
+    if isSuspiciousPayload(features):
 
         print(f"Suspicious payload content detected in ICMP packet from \
 {pkt[IP].src} to {pkt[IP].dst}")
 
 
 
-    if isTimingAnomaly(pkt):
+    if isTimingAnomaly(pkt, timing):
 
         print(f"Timing anomaly detected in ICMP packet from {pkt[IP].src} to \
 {pkt[IP].dst}")
@@ -117,52 +993,67 @@ def icmpTunnelingDetector(pkt):
 
 
 
-def isUnusualIcmpTraffic(pkt):
+def isMismatchedEchoReply(pkt):
+    '''
+    Records echo requests in the pairing table and checks echo replies
+    against them. Returns True for a reply without a request or with a
+    payload other than its request's.
+    '''
+
+    icmp = pkt[ICMP]
+    payload = pkt[Raw].load if pkt.haslayer(Raw) else b""
+
 
-    global lasticmppackettime
 
-    #check for unusually large or small ICMP packets
-    if len(pkt[ICMP]) < 8 or len(pkt[ICMP]) > 1500:
-      
-        return True
+    #a reply is stored under the key of the request it answers
+    if icmp.type == ECHOREQUEST:
+
+        key = (pkt[IP].src, pkt[IP].dst, icmp.id, icmp.seq)
+        echotable.request(key, payload, float(pkt.time))
 
+    elif icmp.type == ECHOREPLY:
 
+        key = (pkt[IP].dst, pkt[IP].src, icmp.id, icmp.seq)
+        pairing = echotable.reply(key, payload, float(pkt.time))
 
-    #check for high volume of ICMP packets
-    if pkt[IP].src in icmppacketcounts:
 
-        icmppacketcounts[pkt[IP].src] += 1
 
+        return pairing != ECHOMATCHED
 
 
-    else:
 
-        icmppacketcounts[pkt[IP].src] = 1
+    return False
+
 
 
+def isUnusualIcmpTraffic(pkt, timing):
 
-    if icmppacketcounts[pkt[IP].src] > 100:
+    #check for unusually large or small ICMP packets
+    if len(pkt[ICMP]) < 8 or len(pkt[ICMP]) > 1500:
 
         return True
 
 
 
-    #check for ICMP packets with unusual source or destination addresses
-    if pkt[IP].src.startswith("10.") and not pkt[IP].dst.startswith("10."):
+    #check for high volume of ICMP packets (packets per second per source)
+    if icmprates.add(pkt[IP].src, float(pkt.time)) / ICMPWINDOW \
+    > args.max_icmp_rate:
 
         return True
 
 
 
-    #check for ICMP packets with unusual timing or delay
-    if pkt.time - lasticmppackettime < 0.01:
+    #check for ICMP packets with unusual source or destination addresses
+    if pkt[IP].src.startswith("10.") and not pkt[IP].dst.startswith("10."):
 
         return True
 
 
 
-    #update the last ICMP packet time
-    lasticmppackettime = pkt.time
+    #check for bursts of ICMP packets between the same pair of hosts
+    if timing.isBurst():
+
+        return True
 
 
 
@@ -171,100 +1062,78 @@ def isUnusualIcmpTraffic(pkt):
 
 
 
-def isCoverChannel(pkt):
+def isCoverChannel(features):
     '''
     This function is a demo only and should be taken with a grain of salt
     '''
 
-    # check if packet has a Raw layer
-    if not pkt.haslayer(Raw):
-        return False
+    #check if the packet has a payload long enough to classify
+    if features is None:
 
-    #check for covert channels in ICMP packet payload
-    payload = str(pkt[Raw].load)
-    
-    if len(payload) < 8:
-    
         return False
 
 
 
     #sloppy check for hidden messages using steganography
-    if "steg" in payload.lower():
+    if features.keywords & KEYWORDCOVERT:
         
         return True
 
 
 
     #check for encoding of data in packet payload
-    if "b64" in payload.lower():
-        
-        try:
-        
-            decodedpayload = base64.b64decode(payload)
-
-
+    if features.isEncoded():
 
-            if "secret message" in decodedpayload:
-        
-                return True
+        return True
 
 
 
-        except:
+    #no covert channels detected
+    return False
 
-            pass
 
 
+def isSuspiciousPayload(features):
 
-    #no covert channels detected
-    return False
+    #check if the packet has a payload long enough to classify
+    if features is None:
 
+        return False
 
 
-def isSuspiciousPayload(pkt):
 
-    # check if packet has a Raw layer
-    if not pkt.haslayer(Raw):
-        return False
+    #check for payloads that are not valid ASCII, which takes in encrypted
+    #and compressed payloads
+    if features.highbit:
 
-    #check for payloads that are not valid ASCII
-    try:
-        payload = pkt[Raw].load.decode("ascii")
-    except UnicodeDecodeError:
         return True
 
-    #check for payloads that are not valid base64
-    try:
-        decodedpayload = base64.b64decode(payload)
-    except:
-        return True
 
-    #check for payloads that are not valid JSON
-    try:
-        json.loads(payload)
-    except:
-        return True
 
     #check for payloads that contain shell commands
-    if any(command in payload.lower() for command in ["sh", "bash", "cmd", "powershell"]):
+    if features.keywords & KEYWORDSHELL:
+
         return True
 
+
+
     #no suspicious payloads detected
     return False
 
 
 
-def isTimingAnomaly(pkt):
+def isTimingAnomaly(pkt, timing):
 
-    #declare global because we need the previous packet time
-    global lasticmppackettime
+    #check for ICMP packets that are sent too quickly to the same host
+    if timing.interval is not None and timing.interval < MININTERVAL:
+
+        return True
 
 
 
-    #check for ICMP packets that are sent too quickly
-    if pkt.time - lasticmppackettime < 0.01:
-      
+    #check for beacon-like regular ICMP packets to the same host
+    if timing.isBeacon():
+
         return True
 
 
@@ -276,11 +1145,6 @@ def isTimingAnomaly(pkt):
 
 
 
-    #update the last ICMP packet time
-    lasticmppackettime = pkt.time
-
-
-
     #no timing anomalies detected
     return False
 
@@ -295,15 +1159,19 @@ def isAbnormalNetworkBehavior(pkt):
 
 
 
-    #check for excessive use of network resources
-    if psutil.net_io_counters().bytes_sent > 1e9:
-      
-        return True
+    #check for excessive use of network resources (bytes sent per second)
+    for name in [pkt.sniffed_on] if pkt.sniffed_on else interfaces:
+
+        rates = ifacesampler.rate(name)
 
+        if rates is not None and rates[0] > MAXSENDRATE:
 
+            return True
 
-    #check for unusual network latency or packet loss
-    rtt = ping(pkt[IP].dst)
+
+
+    #check for unusual network latency or packet loss (last known RTT)
+    rtt = rttprober.lastRtt(pkt[IP].dst)
 
     if rtt is not None and rtt > 100:
  
@@ -318,21 +1186,165 @@ def isAbnormalNetworkBehavior(pkt):
 
 def ping(host):
     '''
-    Returns True if host (str) responds to a ping request.
+    Returns the round trip time to host (str) in ms, or None if it doesn't
+    respond to a ping request. Only called from the RttProber thread.
     '''
 
-    #ping parameter
-    pingstr = "-c 1"
+    #ping parameters: one request, wait at most a second for the reply
+    pingargs = ["ping", "-c", "1", "-W", "1", host]
 
 
 
     #ping
-    response = os.system(f"ping {pingstr} {host} > /dev/null 2>&1")
+    try:
+
+        response = subprocess.run(pingargs, \
+                                  capture_output=True, \
+                                  text=True, \
+                                  timeout=5)
+
+    except (OSError, subprocess.TimeoutExpired):
+
+        return None
+
+
 
+    #return the time reported for the reply
+    match = RTTPATTERN.search(response.stdout)
 
 
-    #teturn True if the response code is zero
-    return response == 0
+
+    return float(match.group(1)) if match else None
+
+
+
+def printTopSources():
+    '''
+    Prints the heavy hitters counted exactly by the ICMP rate sketch.
+    '''
+
+    if not args.top_k:
+
+        return
+
+
+
+    print("\n\n\nTop ICMP sources (packets in the last window):")
+    print("---------------------------------------------")
+
+
+
+    for source, count in icmprates.topSources():
+
+        print(f"{source}: {count}")
+
+
+
+def printEchoTable():
+    '''
+    Prints the size and counters of the echo pairing table.
+    '''
+
+    counters = echotable.counters
+
+    print("\n\n\nEcho pairing table:")
+    print("-------------------")
+    print(f"outstanding requests: {len(echotable)}")
+
+
+
+    for name in ["requests", "replies", "unsolicited", "mismatched", \
+                 "expired", "evicted"]:
+
+        print(f"{name}: {counters[name]}")
+
+
+
+def sniffWorker(groupid):
+    '''
+    Runs the detector in a --workers process on its fanout share of the ICMP
+    traffic of every interface. A fanout group only spans one interface, so
+    each interface gets its own group.
+    '''
+
+    sockets = []
+
+
+
+    for i, name in enumerate(interfaces):
+
+        sock = conf.L2listen(iface=name, filter="icmp")
+        pf.joinFanout(sock.ins, groupid + i)
+        sockets.append(sock)
+
+
+
+    sniff(opened_socket=sockets, \
+          prn=pf.counted(icmpTunnelingDetector), \
+          store=0)
+
+    printTopSources()
+    printEchoTable()
+
+
+
+#parse command line arguments
+parser = argparse.ArgumentParser(description="Sniff out potential ICMP \
+tunneling")
+parser.add_argument("--workers", type=int, default=1, \
+                    help="number of capture processes sharing the traffic \
+through PACKET_FANOUT (default: 1)")
+parser.add_argument("--sample-interval", type=float, default=1, \
+                    help="seconds between interface counter samples \
+(default: 1)")
+parser.add_argument("--max-icmp-rate", type=float, default=10, \
+                    help="ICMP packets per second from one source \
+considered unusual (default: 10)")
+parser.add_argument("--top-k", type=int, default=10, \
+                    help="heavy hitter sources counted exactly and printed \
+on exit, 0 to disable (default: 10)")
+parser.add_argument("--max-echoes", type=int, default=65536, \
+                    help="outstanding echo requests held for pairing with \
+their replies (default: 65536)")
+parser.add_argument("--rtt-ttl", type=float, default=RTTTTL, \
+                    help="seconds a measured RTT is reused before the host \
+is pinged again (default: 60)")
+parser.add_argument("--rtt-cache", type=int, default=RTTCACHESIZE, \
+                    help="hosts whose RTT is remembered \
+(default: 4096)")
+parser.add_argument("--rtt-queue", type=int, default=RTTQUEUESIZE, \
+                    help="pings waiting to be sent, further ones are skipped \
+(default: 256)")
+args = parser.parse_args()
+
+
+
+#create the RTT prober
+rttprober = RttProber(args.rtt_ttl, args.rtt_cache, args.rtt_queue)
+
+
+
+#create the per-source ICMP rate sketch
+icmprates = CountMinWindow(SKETCHWIDTH, \
+                           SKETCHDEPTH, \
+                           ICMPWINDOW, \
+                           ICMPBUCKETS, \
+                           args.top_k)
+
+
+
+#create the per src/dst timing tracker
+pairtimings = PairTimings(MAXPAIRS)
+
+
+
+#create the echo request/reply pairing table
+echotable = EchoTable(ECHOTIMEOUT, ECHOSLOTS, args.max_echoes)
+
+
+
+#create the interface counter sampler
+ifacesampler = IfaceSampler(args.sample_interval, SAMPLEHISTORY)
 
 
 
@@ -341,5 +1353,17 @@ print("\n\n\nSniffing for ICMP tunneling...\n\n\n")
 
 
 
+#spread the traffic over several processes
+if args.workers > 1:
+
+    pf.runWorkers(args.workers, sniffWorker)
+
+    sys.exit(0)
+
+
+
 #set up packet capture on network interfaces
-sniff(prn=icmpTunnelingDetector, filter="icmp", iface=["wlp1s0"])
\ No newline at end of file
+sniff(prn=icmpTunnelingDetector, filter="icmp", iface=interfaces)
+
+printTopSources()
+printEchoTable()
\ No newline at end of file
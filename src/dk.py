@@ -22,11 +22,19 @@
 #              4.) Repeated use of the same ACK packet number                 #
 #              5.) Unusual TCP header flags                                   #
 #                                                                             #
-# INPUT: None                                                                 #
+# INPUT: Optional command line arguments (see ./dk.py --help)                 #
 #                                                                             #
 # OUTPUT: STDOUT                                                              #
 #                                                                             #
-# PRE-RUNTIME NOTES: None                                                     #
+# PRE-RUNTIME NOTES: Packets are read from a memory-mapped TPACKET_V3 ring by #
+#                    default. If the ring cannot be set up the script falls   #
+#                    back to the original raw socket. Run with --benchmark to #
+#                    compare the packets per second of both. --batch          #
+#                    evaluates the indicators over batches of packets and     #
+#                    needs numpy. A BPF filter is attached to the socket so   #
+#                    only TCP segments with ACK set reach the script; narrow  #
+#                    it with --ports/--hosts, widen it with --no-filter and   #
+#                    measure it with --replay on a pcap.                      #
 #                                                                             #
 # AUTHORS: @southwickio                                                       #
 #                                                                             #
@@ -43,80 +51,440 @@
 
 
 #import dependencies
+import argparse
+import collections
+import contextlib
+import ctypes
+import mmap
+import os
+import select
 import socket
 import struct
+import sys
+import time
 
+import pf #./pf.py, worker pool for --workers
 
 
-#define variables
-prevacknum = 0
 
+#import optional dependencies
+try:
 
+    import numpy #pip3 install numpy, only needed for --batch
 
-#define functions
-def printIndicators(pkt):
+except ImportError:
+
+    numpy = None
+
+
+
+#define constants from <linux/if_ether.h> and <linux/if_packet.h>
+ETH_P_IP = 0x0800
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_OUTGOING = 4
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+
+
+#define constants from <linux/filter.h> for the classic BPF filter
+SO_ATTACH_FILTER = 26
+SKF_NET_OFF = -0x100000 #load offsets relative to the IP header
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+BPFINSN = struct.Struct('HBBI') #struct sock_filter
+
+
+
+#define pcap constants for --replay
+PCAPLINKTYPES = {1: 14, 101: 0, 113: 16, 228: 0} #link type: header length
+
+
+
+#define ring parameters
+FRAMESIZE = 2048 #only used by the kernel to size the frame count
+BLOCKTIMEOUT = 100 #ms before the kernel retires a partially filled block
+POLLTIMEOUT = 100 #ms to wait for a block before checking in with the caller
+BLOCKSTATUS = struct.Struct('I') #tpacket_hdr_v1.block_status
+BLOCKHEADER = struct.Struct('II') #num_pkts, offset_to_first_pkt
+FRAMEHEADER = struct.Struct('IIIIIIHH') #tpacket3_hdr up to tp_net
+IPLENGTH = struct.Struct('!H') #total length, 2 bytes into the IP header
+
+
+
+#define flow table parameters
+EXPIREBATCH = 8 #idle flows expired at most per new flow
+
+
+
+#define batch parameters
+HEADERDTYPE = [('pktlen', 'i8'), \
+               ('iphlen', 'i8'), \
+               ('totallength', 'i8'), \
+               ('srcaddr', 'u8'), \
+               ('dstaddr', 'u8'), \
+               ('srcport', 'u8'), \
+               ('dstport', 'u8'), \
+               ('acknum', 'u8'), \
+               ('tcphlen', 'i8'), \
+               ('tcpflags', 'u1')]
+
+
+
+#define packet parsing structures
+IPHEADER = struct.Struct('!BxH8xLL') #version/IHL, total length, src, dst
+ADDRESS = struct.Struct('!L') #packs an address back for inet_ntoa
+TCPHEADER = struct.Struct('!HHLLBB') #ports, seq, ack, data offset, flags
+NULLVIEW = memoryview(bytes(65536)) #compared against, never copied
+
+
+
+#define 256-entry flag lookup tables indexed by the TCP flag byte
+'''
+ACKONLY is True when the ACK flag (0x10) is set and the PSH flag (0x08) is
+not, which is what the original (flags & 0x18) == 0x10 test computed.
+UNUSUALFLAGS is True when the PSH/ACK/URG bits of the flag byte (mask 0x38)
+are neither a bare ACK (0x10) nor a PSH/ACK (0x18). One list index replaces
+the mask and the two comparisons on every packet.
+'''
+ACKONLY = tuple((flags & 0x18) == 0x10 for flags in range(256))
+UNUSUALFLAGS = tuple((flags & 0x38) not in (0x10, 0x18) \
+                     for flags in range(256))
+
+if numpy is not None:
+
+    ACKONLYARRAY = numpy.array(ACKONLY)
+    UNUSUALFLAGSARRAY = numpy.array(UNUSUALFLAGS)
+
+
+
+#define classes
+class PacketView:
+    '''
+    This class parses the IP and TCP headers of a packet once. Every indicator
+    reads its fields from the view instead of slicing the packet and calling
+    struct.unpack on the same bytes again. The packet itself is never copied;
+    the payload and the dotted quad addresses are only built when a check or
+    an alert actually asks for them.
+    '''
+
+    '''
+    Fields:
+    pkt: the packet as bytes or as a memoryview into the capture ring.
+    iphlen: IP header length in bytes (IHL * 4).
+    totallength: IP total length (header + data).
+    srcaddr/dstaddr: source and destination addresses as 32-bit integers.
+    srcport/dstport: TCP source and destination ports.
+    seqnum/acknum: TCP sequence and acknowledgment numbers.
+    tcphlen: TCP header length in bytes (data offset * 4).
+    tcpflags: the TCP flag byte (13th byte of the TCP header).
+    datalength: length of the TCP data according to the headers.
+    '''
+
+    __slots__ = ('pkt', \
+                 'iphlen', \
+                 'totallength', \
+                 'srcaddr', \
+                 'dstaddr', \
+                 'srcport', \
+                 'dstport', \
+                 'seqnum', \
+                 'acknum', \
+                 'tcphlen', \
+                 'tcpflags', \
+                 'datalength')
+
+
+
+    def __init__(self, pkt):
+
+        self.pkt = pkt
+
+        verihl, self.totallength, self.srcaddr, self.dstaddr \
+        = IPHEADER.unpack_from(pkt, 0)
+        self.iphlen = (verihl & 0x0F) * 4
+
+        self.srcport, self.dstport, self.seqnum, self.acknum, offset, \
+        self.tcpflags = TCPHEADER.unpack_from(pkt, self.iphlen)
+        self.tcphlen = (offset >> 4) * 4
+
+        self.datalength = self.totallength - self.iphlen - self.tcphlen
+
+
+
+    @property
+    def srcip(self):
+
+        return socket.inet_ntoa(ADDRESS.pack(self.srcaddr))
+
+
+
+    @property
+    def dstip(self):
+
+        return socket.inet_ntoa(ADDRESS.pack(self.dstaddr))
+
+
+
+    @property
+    def payload(self):
+
+        return memoryview(self.pkt)[self.iphlen + self.tcphlen:]
+
+
+
+    @property
+    def flowkey(self):
+        '''
+        The 4-tuple packed into a single 96-bit integer. An int is a third of
+        the size of a tuple of four objects, which matters with a million
+        flows in the table.
+        '''
+
+        return self.srcaddr << 64 \
+        | self.dstaddr << 32 \
+        | self.srcport << 16 \
+        | self.dstport
+
+
+
+class FlowRecord:
+    '''
+    This class holds the ACK state of one direction of a TCP connection. It
+    uses __slots__ so a record costs a fixed 56 bytes plus its values instead
+    of carrying a per-instance __dict__.
+    '''
+
+    __slots__ = ('acknum', 'repeats', 'lastseen')
+
+
+
+    def __init__(self, acknum, lastseen):
+
+        self.acknum = acknum
+        self.repeats = 0
+        self.lastseen = lastseen
+
+
+
+class FlowTable:
     '''
-    This function takes a packet as input and parses its IP and TCP headers. It
-    then checks for various indicators of ACK tunneling using the other
-    functions. If an indicator is triggered, it prints the corresponding
-    message along with the source and destination IP addresses.
+    This class maps the 4-tuple of a connection to its FlowRecord. The table
+    never holds more than maxflows records: the least recently used flow is
+    evicted to make room for a new one, and flows idle for longer than
+    idletimeout seconds are expired as packets come in. Lookups, inserts,
+    evictions and expirations are counted, along with the nanoseconds spent
+    on lookups and on evicting.
     '''
 
+    '''
+    The OrderedDict keeps the flows in least to most recently seen order.
+    Every lookup moves the flow to the end, so the oldest flow is always at
+    the front: LRU eviction is a popitem(last=False) and idle expiry only
+    has to look at the front of the table. At most EXPIREBATCH flows are
+    expired per new flow so a burst of idle flows can't stall the capture.
+    '''
+
+    def __init__(self, maxflows, idletimeout):
+
+        self.flows = collections.OrderedDict()
+        self.maxflows = maxflows
+        self.idletimeout = idletimeout
+        self.lookups = 0
+        self.hits = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lookupns = 0
+        self.evictionns = 0
+
+
+
+    def lookup(self, key, now):
+
+        start = time.perf_counter_ns()
+        self.lookups += 1
+        record = self.flows.get(key)
+
+
+
+        if record is not None:
+
+            self.hits += 1
+            record.lastseen = now
+            self.flows.move_to_end(key)
+
+
+
+        self.lookupns += time.perf_counter_ns() - start
+
+
+
+        return record
+
+
 
+    def insert(self, key, record):
 
-    #parse IP header
-    iphdr = pkt[0 : 20] #first 20 bytes (IP header)
-    iph = struct.unpack('!BBHHHBBH4s4s', iphdr) #create tuple breakdown
+        start = time.perf_counter_ns()
 
+
+
+        #expire idle flows from the front of the table
+        for i in range(EXPIREBATCH):
+
+            if not self.flows:
+
+                break
+
+
+
+            oldest = next(iter(self.flows.values()))
+
+
+
+            if record.lastseen - oldest.lastseen <= self.idletimeout:
+
+                break
+
+
+
+            self.flows.popitem(last=False)
+            self.expirations += 1
+
+
+
+        #evict the least recently used flow if the table is still full
+        if len(self.flows) >= self.maxflows:
+
+            self.flows.popitem(last=False)
+            self.evictions += 1
+
+
+
+        self.flows[key] = record
+        self.inserts += 1
+        self.evictionns += time.perf_counter_ns() - start
+
+
+
+    def stats(self):
+
+        return f"flows={len(self.flows)}/{self.maxflows} \
+lookups={self.lookups} hits={self.hits} inserts={self.inserts} \
+evictions={self.evictions} expirations={self.expirations} \
+lookup_ns_avg={self.lookupns // max(self.lookups, 1)} \
+evict_ns_avg={self.evictionns // max(self.inserts, 1)}"
+
+
+
+class PacketBatch:
     '''
-    iph breakdown:
-    iph[0]: IP version and header length.
-    iph[1]: Type of service.
-    iph[2]: Total length of the packet (header + data).
-    iph[3]: Identification.
-    iph[4]: Flags and fragmentation offset.
-    iph[5]: Time to live.
-    iph[6]: Protocol (TCP, UDP, etc.).
-    iph[7]: Header checksum.
-    iph[8]: Source IP address.
-    iph[9]: Destination IP address.
+    This class collects packets for the batched path. Each packet is copied
+    once onto the end of a flat buffer and its offset recorded, which is all
+    the per-packet Python work there is; the headers are decoded for the whole
+    batch at once by printBatchIndicators. Copying also means views into the
+    capture ring can be released as soon as they are added.
     '''
 
-    srcip = socket.inet_ntoa(iph[8])
-    dstip = socket.inet_ntoa(iph[9])
+    def __init__(self, batchsize):
+
+        self.batchsize = batchsize
+        self.buffer = bytearray()
+        self.offsets = []
+
+
+
+    def add(self, pkt):
+        '''
+        Returns True once the batch is full.
+        '''
 
+        self.offsets.append(len(self.buffer))
+        self.buffer += pkt
 
 
-    #parse TCP header
-    iphlen = iph[0] & 0xF #first four bits
-    tcph = struct.unpack('!HHLLBBHHH', pkt[iphlen * 4:iphlen * 4 + 20]) 
 
+        return len(self.offsets) >= self.batchsize
+
+
+
+    def take(self):
+        '''
+        Empties the batch and returns its buffer (with a trailing null byte)
+        and packet offsets. A new buffer is started because numpy keeps a
+        view of the old one.
+        '''
+
+        buffer, offsets = self.buffer, self.offsets
+        buffer.append(0)
+        self.buffer = bytearray()
+        self.offsets = []
+
+
+
+        return buffer, offsets
+
+
+
+#define functions
+def printIndicators(pkt):
     '''
-    tcph breakdown:
-    tcph[0]: Source port number.
-    tcph[1]: Destination port number.
-    tcph[2]: Sequence number.
-    tcph[3]: Acknowledgment number.
-    tcph[4]: Data offset, reserved bits, and flags.
-    tcph[5]: TCP flags.
-    tcph[6]: Window size.
-    tcph[7]: Checksum.
-    tcph[8]: Urgent pointer.
+    This function takes a packet as input and parses its IP and TCP headers
+    into a PacketView. It then checks for various indicators of ACK tunneling
+    using the other functions, all of which read the same view. If an
+    indicator is triggered, it prints the corresponding message along with the
+    source and destination IP addresses.
     '''
 
-    acknum = tcph[2]
-    tcpflags = tcph[5]
+    view = PacketView(pkt)
 
 
 
     # Check for indicators of ACK tunneling
-    if suspiciousTrafficPattern(pkt):
+    verdicts = (suspiciousTrafficPattern(view), \
+                largeAmountOfDataTransferred(view), \
+                EncryptedOrEncodedData(view), \
+                RepeatedAcknum(view), \
+                UnusualTcpFlags(view))
+
+
+
+    if any(verdicts):
+
+        printAlerts(view.srcip, view.dstip, verdicts)
+
+
+
+def printAlerts(srcip, dstip, verdicts):
+    '''
+    This function prints a message for every indicator that was triggered.
+    verdicts holds the results of the five indicator checks in the order they
+    are listed in the header of this script.
+    '''
+
+    suspicious, large, encoded, repeated, unusual = verdicts
+
+
+
+    if suspicious:
 
         print(f"Suspicious traffic pattern detected: src={srcip}, dst={dstip}")
 
 
 
-    if largeAmountOfDataTransferred(pkt):
+    if large:
 
         print(f"Large amount of data transferred through ACK packets: \
             src={srcip}, \
@@ -124,7 +492,7 @@ def printIndicators(pkt):
 
 
 
-    if EncryptedOrEncodedData(pkt, iphlen):
+    if encoded:
 
         print(f"Encrypted or encoded data within ACK packets: \
             src={srcip}, \
@@ -132,7 +500,7 @@ def printIndicators(pkt):
 
 
 
-    if RepeatedAcknum(pkt, iphlen):
+    if repeated:
 
         print(f"Repeated use of the same ACK packet number: \
             src={srcip}, \
@@ -140,13 +508,13 @@ def printIndicators(pkt):
 
 
 
-    if UnusualTcpFlags(pkt):
+    if unusual:
 
         print(f"Unusual TCP header flags detected: src={srcip}, dst={dstip}")
 
 
 
-def suspiciousTrafficPattern(pkt):
+def suspiciousTrafficPattern(view):
     '''
     This function checks if the packet has a small size and is a TCP ACK packet
     without data. If this condition is met, it returns True, indicating that a
@@ -155,46 +523,30 @@ def suspiciousTrafficPattern(pkt):
 
     '''
     The return statement does the following:
-    1.) len(pkt) < 64: This condition checks if the length of the packet is
-        less than 64 bytes. This is because ACK packets without data are
+    1.) len(view.pkt) < 64: This condition checks if the length of the packet
+        is less than 64 bytes. This is because ACK packets without data are
         typically small in size.
-    2.) (pkt[13] & 0x18) == 0x10: This condition checks if the ACK flag is set
-        in the TCP header. The ACK flag is represented by the third bit from
-        the right in the 14th byte of the TCP header. The hexadecimal value
-        0x10 corresponds to the binary value 00010000, which has the third bit
-        set to 1.
-    3.) len(pkt) == struct.unpack('!H', pkt[2:4])[0] 
-        - (4 * (pkt[0] & 0x0f) + 4 * (pkt[12] >> 4)): This condition checks if
-        the length of the packet matches the expected length based on the TCP
-        header fields. The expected length is calculated as follows:
-        a.) The total length field in the IP header minus the IP header length
-            minus the TCP header length (i.e., the length of the TCP data).
-        b.) The total length field is located in bytes 2-3 of the IP header and
-            is in network byte order (big-endian), so we use struct.unpack() to
-            extract it.
-        c.) The IP header length field is the first 4 bits of the first byte of
-            the IP header, which we extract using the bitwise AND operator &
-            with the value 0x0f. This gives us a value in the range 0-15, which
-            we multiply by 4 to get the actual length in bytes.
-        d.) The TCP header length field is the first 4 bits of the 13th byte of
-            the TCP header, which we extract using the bitwise shift operator
-            >> with the value 4. This gives us a value in the range 0-15, which
-            we multiply by 4 to get the actual length in bytes.
-        e.) We then subtract the sum of the IP header length and TCP header
-            length from the total length to get the expected length of the TCP
-            data.
+    2.) ACKONLY[view.tcpflags]: This condition checks if the ACK flag is set
+        and the PSH flag is not in the TCP flag byte (the 14th byte of the TCP
+        header). The table holds the result of (flags & 0x18) == 0x10 for all
+        256 flag bytes.
+    3.) len(view.pkt) == view.datalength: This condition checks if the length
+        of the packet matches the expected length based on the header fields.
+        view.datalength is the total length field of the IP header minus the
+        IP header length (IHL * 4) minus the TCP header length (data offset *
+        4), i.e., the length of the TCP data. All three fields were unpacked
+        once when the view was built.
     If all three conditions are true, then the line returns True, indicating
     that a suspicious traffic pattern has been detected in the TCP ACK packet.
     '''
 
-    return len(pkt) < 64 \
-    and (pkt[13] & 0x18) == 0x10 \
-    and len(pkt) == struct.unpack('!H', pkt[2 : 4])[0] \
-    - (4 * (pkt[0] & 0x0f) + 4 * (pkt[12] >> 4))
+    return len(view.pkt) < 64 \
+    and ACKONLY[view.tcpflags] \
+    and len(view.pkt) == view.datalength
 
 
 
-def largeAmountOfDataTransferred(pkt):
+def largeAmountOfDataTransferred(view):
     '''
     This function checks if the packet has a large data size within the ACK
     flag. If this condition is met, it returns True, indicating that a large
@@ -203,43 +555,20 @@ def largeAmountOfDataTransferred(pkt):
 
     '''
     The return statement does the following:
-    1.) (pkt[13] & 0x18) == 0x10: This condition checks if the ACK flag is set
-        in the TCP header. The ACK flag is represented by the third bit from
-        the right in the 14th byte of the TCP header. The hexadecimal value
-        0x10 corresponds to the binary value 00010000, which has the third bit
-        set to 1.
-    2.) (struct.unpack('!H', pkt[2:4])[0] - 
-        (4 * (pkt[0] & 0x0f) + 4 * (pkt[12] >> 4))) > 64: This condition checks
-        if the length of the TCP data in the packet is greater than 64 bytes.
-        The length of the TCP data is calculated as follows:
-        a.) The total length field in the IP header minus the IP header length
-            minus the TCP header length (i.e., the length of the TCP data).
-        b.) The total length field is located in bytes 2-3 of the IP header
-            and is in network byte order (big-endian), so we 
-            use struct.unpack() to extract it.
-        c.) The IP header length field is the first 4 bits of the first byte
-            of the IP header, which we extract using the bitwise AND operator &
-            with the value 0x0f. This gives us a value in the range 0-15, which
-            we multiply by 4 to get the actual length in bytes.
-        d.) The TCP header length field is the first 4 bits of the 13th byte of
-            the TCP header, which we extract using the bitwise shift operator
-            >> with the value 4. This gives us a value in the range 0-15, which
-            we multiply by 4 to get the actual length in bytes.
-        e.) We then subtract the sum of the IP header length and TCP header
-            length from the total length to get the length of the TCP data.
-        f.) We then check if the length of the TCP data is greater than 64
-            bytes.
+    1.) ACKONLY[view.tcpflags]: This condition checks if the ACK flag is set
+        and the PSH flag is not in the TCP flag byte.
+    2.) view.datalength > 64: This condition checks if the length of the TCP
+        data in the packet is greater than 64 bytes. view.datalength is the IP
+        total length minus the IP header length minus the TCP header length.
     If both conditions are true, then the line returns True, indicating that a
     large amount of data has been transferred through ACK packets.
     '''
 
-    return (pkt[13] & 0x18) == 0x10 \
-    and (struct.unpack('!H', pkt[2 : 4])[0] \
-        - (4 * (pkt[0] & 0x0f) + 4 * (pkt[12] >> 4))) > 64
+    return ACKONLY[view.tcpflags] and view.datalength > 64
 
 
 
-def EncryptedOrEncodedData(pkt, iphlen):
+def EncryptedOrEncodedData(view):
     '''
     This function checks if the packet data is encoded or encrypted. If this
     condition is met, it returns True, indicating that encrypted or encoded
@@ -248,74 +577,78 @@ def EncryptedOrEncodedData(pkt, iphlen):
 
     '''
     The return statement does the following:
-    1.) (pkt[13] & 0x18) == 0x10: This condition checks if the ACK flag is set
-        in the TCP header. The ACK flag is represented by the third bit from
-        the right in the 14th byte of the TCP header. The hexadecimal value
-        0x10 corresponds to the binary value 00010000, which has the third bit
-        set to 1.
-    2.) pkt[iphlen * 4 + 20:] != b'\x00'*len(pkt[iphlen * 4 + 20:]): This 
-        condition checks if the TCP data in the packet is not all null bytes.
-    The iphlen * 4 + 20 index is used to skip over the IP and TCP headers and
-    get to the start of the TCP data in the packet. We then compare the TCP
-    data to a sequence of null bytes (b'\x00') of the same length. If the TCP
-    data is not all null bytes, it could be because the data is encrypted or
-    encoded.
+    1.) ACKONLY[view.tcpflags]: This condition checks if the ACK flag is set
+        and the PSH flag is not in the TCP flag byte.
+    2.) payload != NULLVIEW[:len(payload)]: This condition checks if the TCP
+        data in the packet is not all null bytes. view.payload starts after
+        the IP and TCP headers (including TCP options). Instead of allocating
+        b'\x00' * len(payload) for every packet, the payload is compared with
+        a slice of a preallocated buffer of null bytes. If the TCP data is not
+        all null bytes, it could be because the data is encrypted or encoded.
 
     If both conditions are true, then the line returns True, indicating that
     encrypted or encoded data has been detected within ACK packets.
     '''
 
-    return (pkt[13] & 0x18) == 0x10 \
-    and pkt[iphlen * 4 + 20:] != b'\x00'*len(pkt[iphlen * 4 + 20:])
+    if not ACKONLY[view.tcpflags]:
+
+        return False
+
+
 
+    payload = view.payload
 
 
 
+    return payload != NULLVIEW[:len(payload)]
 
 
 
-def RepeatedAcknum(pkt, iphlen):
+def RepeatedAcknum(view):
     '''
-    This function checks if the packet ACK number is repeated. It keeps track
-    of the previous ACK number seen and compares it to the current ACK number.
-    If they are the same, it returns True, indicating that a repeated ACK
-    number has been detected.
+    This function checks if the packet ACK number is repeated. It looks up
+    the flow of the packet (source and destination address and port) in the
+    flow table and compares the previous ACK number seen on that flow to the
+    current ACK number. If they are the same, it returns True, indicating that
+    a repeated ACK number has been detected. Packets of other connections in
+    between no longer reset the comparison.
     '''
     
     #declare variables
-    global prevacknum#declared global so previous packet can access number
-    acknum = struct.unpack('!L', \
-        pkt[iphlen * 4 + 8:iphlen * 4 + 12])[0]
+    acknum = view.acknum
+    key = view.flowkey
+    now = time.monotonic()
 
     '''
     acknum is doing the following:
-    1.) This line of code is extracting the acknowledgment number from the TCP
-        header of a packet and storing it in the acknum variable.
-    2.) The acknowledgment number is a 32-bit value that represents the next
+    1.) The acknowledgment number is a 32-bit value that represents the next
         expected sequence number of a TCP connection. It is used to
         acknowledge receipt of data and to signal to the sender that the 
         receiver is ready to receive more data.
-    3.) The struct.unpack() function is used to unpack the acknowledgment
-        number from the packet. The format string '!L' specifies that we want
-        to unpack a 32-bit unsigned integer in network byte order (big-endian).
-    4.) The expression pkt[iphlen * 4 + 8:iphlen * 4 + 12] is used to
-        slice the TCP header from the packet and extract the acknowledgment
-        number. The index iphlen * 4 + 8 points to the start of the
-        acknowledgment number field in the TCP header, and the index
-        iphlen * 4 + 12 points to the end of the acknowledgment number
-        field.
-    5.) The [0] at the end of the line is used to access the first (and only)
-        element of the resulting tuple returned by struct.unpack(). Since we
-        are unpacking a single 32-bit integer, the resulting tuple contains a
-        single element, which is the acknowledgment number itself.
+    2.) It was unpacked as a 32-bit unsigned integer in network byte order
+        (big-endian) from bytes 8-11 of the TCP header when the view was
+        built, so no further slicing or unpacking is needed here.
     '''
 
 
 
+    #start tracking new flows
+    record = flowtable.lookup(key, now)
+
+    if record is None:
+
+        flowtable.insert(key, FlowRecord(acknum, now))
+
+
+
+        return False
+
+
+
     #check for same acknum
-    if prevacknum and acknum == prevacknum:
+    if record.acknum and acknum == record.acknum:
 
-        prevacknum = acknum
+        record.repeats += 1
 
 
 
@@ -323,7 +656,7 @@ def RepeatedAcknum(pkt, iphlen):
 
 
 
-    prevacknum = acknum
+    record.acknum = acknum
 
 
 
@@ -331,7 +664,7 @@ def RepeatedAcknum(pkt, iphlen):
 
 
 
-def UnusualTcpFlags(pkt):    
+def UnusualTcpFlags(view):
     '''
     This function checks if the packet has unusual TCP flags set. Specifically,
     it checks if the ACK, FIN, and PUSH flags are set in a way that is not
@@ -341,51 +674,1113 @@ def UnusualTcpFlags(pkt):
     
     '''
     The return statement does the following:
-    1.) The TCP header consists of several 4-bit fields, including the 6
-        reserved bits located in the 13th byte of the header. These bits are
-        reserved for future use and should always be set to 0.
-    2.) The expression (pkt[13] & 0x38) is used to extract the 3 reserved bits
-        (i.e., bits 3-5) from the TCP header and check if their values are
-        unusual. The hexadecimal value 0x38 corresponds to the binary value
-        00111000, which has bits 3-5 set to 1 and bits 0-2 set to 0.
-    3.) Checks if the value of the 3 reserved bits is not equal to 0x10
-        (binary 00100000) or 0x18 (binary 00110000). These values are unusual
-        for the reserved bits and could indicate abnormal behavior or an
-        attempt to manipulate the TCP header.
-    4.) If either of the conditions is true (i.e., the reserved bits are not
-        set to the expected values), then the line returns True, indicating
-        that unusual TCP header flags have been detected in the packet.
+    1.) The expression (flags & 0x38) extracts bits 3-5 (PSH, ACK and URG)
+        from the TCP flag byte. The hexadecimal value 0x38 corresponds to the
+        binary value 00111000.
+    2.) Checks if the value of those bits is not equal to 0x10 (ACK) or 0x18
+        (PSH/ACK). Anything else is unusual for an ACK carrying packet and
+        could indicate abnormal behavior or an attempt to manipulate the TCP
+        header.
+    3.) UNUSUALFLAGS holds the result of both checks for all 256 flag bytes,
+        so the check is a single table lookup.
     '''
 
-    return (pkt[13] & 0x38) != 0x10 and (pkt[13] & 0x38) != 0x18
+    return UNUSUALFLAGS[view.tcpflags]
 
 
 
-#create a raw socket and bind it to all interfaces
-rawsocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
-rawsocket.bind(('0.0.0.0', 0))
+def gatherField(flat, index, width):
+    '''
+    This function reads a big-endian unsigned field of width bytes at every
+    index of the flat packet buffer and returns them as a uint64 array.
+    Indices are clamped to the buffer so truncated packets can't read past it.
+    '''
 
-'''
-The above code code creates a raw socket that listens to all incoming TCP 
-traffic on all network interfaces of the local machine.
-A raw socket is a network socket that allows direct access to network protocols
-at the transport layer (e.g., TCP, UDP). Unlike a regular socket, which is 
-typically used to communicate with a specific remote host and port, a raw 
-socket can be used to capture and manipulate network packets at a lower level.
-The socket.socket() function is used to create a new raw socket object. The 
-socket.AF_INET argument specifies that we want to use the IPv4 address family,
-and the socket.SOCK_RAW argument specifies that we want to use a raw socket.
-The socket.IPPROTO_TCP argument specifies that we want to listen for TCP
-traffic specifically.
-The rawsocket.bind(('0.0.0.0', 0)) line binds the raw socket to all network
-interfaces on the local machine by specifying the IP address '0.0.0.0' and the
-port number 0. Binding the socket to port 0 allows the operating system to
-assign an available port number automatically.
-'''
+    index = numpy.minimum(index, len(flat) - width)
+    value = numpy.zeros(len(index), dtype=numpy.uint64)
 
 
 
-#inspect packets
-while True:
-    pkt, addr = rawsocket.recvfrom(65536)
-    printIndicators(pkt)
\ No newline at end of file
+    for i in range(width):
+
+        value = (value << numpy.uint64(8)) | flat[index + i]
+
+
+
+    return value
+
+
+
+def decodeBatch(batch):
+    '''
+    This function decodes the IP and TCP header fields of every packet in the
+    batch into a NumPy structured array with the same fields as PacketView.
+    It returns the flat buffer, the packet offsets and the headers.
+    '''
+
+    buffer, offsets = batch.take()
+    flat = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    starts = numpy.array(offsets, dtype=numpy.int64)
+    ends = numpy.append(starts[1 :], len(flat) - 1)
+
+    headers = numpy.zeros(len(starts), dtype=HEADERDTYPE)
+    headers['pktlen'] = ends - starts
+
+
+
+    #IP header
+    headers['iphlen'] = (flat[starts] & 0x0F).astype(numpy.int64) * 4
+    headers['totallength'] = gatherField(flat, starts + 2, 2)
+    headers['srcaddr'] = gatherField(flat, starts + 12, 4)
+    headers['dstaddr'] = gatherField(flat, starts + 16, 4)
+
+
+
+    #TCP header
+    tcpstarts = numpy.minimum(starts + headers['iphlen'], len(flat) - 14)
+    headers['srcport'] = gatherField(flat, tcpstarts, 2)
+    headers['dstport'] = gatherField(flat, tcpstarts + 2, 2)
+    headers['acknum'] = gatherField(flat, tcpstarts + 8, 4)
+    headers['tcphlen'] = (flat[tcpstarts + 12] >> 4).astype(numpy.int64) * 4
+    headers['tcpflags'] = flat[tcpstarts + 13]
+
+
+
+    return flat, starts, ends, headers
+
+
+
+def batchNonNullPayloads(flat, starts, ends, headers):
+    '''
+    This function returns True for every packet whose TCP data holds at least
+    one non-null byte, without building a buffer of null bytes per packet.
+    '''
+
+    '''
+    numpy.maximum.reduceat() reduces flat[indices[i]:indices[i + 1]] for each
+    i. Interleaving the payload start and end of every packet makes the even
+    results the largest byte of each payload (the odd ones cover the headers
+    of the next packet and are dropped). A payload is all null bytes exactly
+    when its largest byte is 0. Empty payloads are masked out because
+    reduceat() returns the single byte at the index for them.
+    '''
+
+    payloadstarts = numpy.minimum(starts \
+                                  + headers['iphlen'] \
+                                  + headers['tcphlen'], \
+                                  ends)
+    indices = numpy.column_stack((payloadstarts, ends)).ravel()
+    largest = numpy.maximum.reduceat(flat, indices)[0 : : 2]
+
+
+
+    return (ends > payloadstarts) & (largest > 0)
+
+
+
+def batchRepeatedAcknums(headers):
+    '''
+    This function is the batched RepeatedAcknum. Packets are stable-sorted by
+    flow so each packet can be compared with the previous packet of its own
+    flow in one array operation. The flow table is only consulted once per
+    distinct flow in the batch, for the ACK number seen before the batch and
+    to store the last one seen in it.
+    '''
+
+    flowhigh = headers['srcaddr'] << numpy.uint64(32) | headers['dstaddr']
+    flowlow = headers['srcport'] << numpy.uint64(16) | headers['dstport']
+    order = numpy.lexsort((flowlow, flowhigh))
+    flowhigh = flowhigh[order]
+    flowlow = flowlow[order]
+    acknums = headers['acknum'][order]
+
+
+
+    #mark the first packet of every flow
+    firsts = numpy.ones(len(order), dtype=bool)
+    firsts[1 :] = (flowhigh[1 :] != flowhigh[: -1]) \
+    | (flowlow[1 :] != flowlow[: -1])
+    groupstarts = numpy.flatnonzero(firsts)
+    groupends = numpy.append(groupstarts[1 :], len(order)) - 1
+
+
+
+    #the previous ACK number of a packet is the one before it in its flow
+    prevacknums = numpy.zeros(len(order), dtype=numpy.uint64)
+    prevacknums[1 :] = acknums[: -1]
+    records = []
+    now = time.monotonic()
+
+
+
+    for first in groupstarts:
+
+        key = int(flowhigh[first]) << 32 | int(flowlow[first])
+        record = flowtable.lookup(key, now)
+
+
+
+        if record is None:
+
+            record = FlowRecord(0, now)
+            flowtable.insert(key, record)
+
+
+
+        prevacknums[first] = record.acknum
+        records.append(record)
+
+
+
+    repeatedsorted = (prevacknums != 0) & (acknums == prevacknums)
+    repeatcounts = numpy.add.reduceat(repeatedsorted, groupstarts)
+
+
+
+    for record, last, count in zip(records, groupends, repeatcounts):
+
+        record.acknum = int(acknums[last])
+        record.repeats += int(count)
+
+
+
+    repeated = numpy.empty(len(order), dtype=bool)
+    repeated[order] = repeatedsorted
+
+
+
+    return repeated
+
+
+
+def printBatchIndicators(batch):
+    '''
+    This function is the batched printIndicators. It evaluates all five
+    indicators over every packet of the batch with array operations and then
+    prints the same alerts, in the same order, as the per-packet path would.
+    '''
+
+    flat, starts, ends, headers = decodeBatch(batch)
+    pktlen = headers['pktlen']
+    datalength = headers['totallength'] \
+    - headers['iphlen'] \
+    - headers['tcphlen']
+    ackonly = ACKONLYARRAY[headers['tcpflags']]
+
+
+
+    #same conditions as the per-packet indicator functions
+    suspicious = (pktlen < 64) & ackonly & (pktlen == datalength)
+    large = ackonly & (datalength > 64)
+    encoded = ackonly & batchNonNullPayloads(flat, starts, ends, headers)
+    repeated = batchRepeatedAcknums(headers)
+    unusual = UNUSUALFLAGSARRAY[headers['tcpflags']]
+
+
+
+    #only the flagged packets are handled one at a time
+    flagged = suspicious | large | encoded | repeated | unusual
+
+
+
+    for i in numpy.flatnonzero(flagged):
+
+        srcip = socket.inet_ntoa(ADDRESS.pack(int(headers['srcaddr'][i])))
+        dstip = socket.inet_ntoa(ADDRESS.pack(int(headers['dstaddr'][i])))
+
+        printAlerts(srcip, \
+                    dstip, \
+                    (suspicious[i], large[i], encoded[i], repeated[i], \
+                     unusual[i]))
+
+
+
+def openRawSocket():
+    '''
+    This function creates the original raw socket that listens to all incoming
+    TCP traffic on all network interfaces of the local machine.
+    '''
+
+    '''
+    A raw socket is a network socket that allows direct access to network
+    protocols at the transport layer (e.g., TCP, UDP). Unlike a regular socket,
+    which is typically used to communicate with a specific remote host and
+    port, a raw socket can be used to capture and manipulate network packets at
+    a lower level.
+    The socket.socket() function is used to create a new raw socket object. The
+    socket.AF_INET argument specifies that we want to use the IPv4 address
+    family, and the socket.SOCK_RAW argument specifies that we want to use a
+    raw socket. The socket.IPPROTO_TCP argument specifies that we want to
+    listen for TCP traffic specifically.
+    The rawsocket.bind(('0.0.0.0', 0)) line binds the raw socket to all network
+    interfaces on the local machine by specifying the IP address '0.0.0.0' and
+    the port number 0. Binding the socket to port 0 allows the operating system
+    to assign an available port number automatically.
+    '''
+
+    rawsocket = socket.socket(socket.AF_INET, \
+                              socket.SOCK_RAW, \
+                              socket.IPPROTO_TCP)
+    rawsocket.bind(('0.0.0.0', 0))
+
+
+
+    return rawsocket
+
+
+
+def readRawSocket(rawsocket):
+    '''
+    This generator yields the packets read from the raw socket. Every packet is
+    a recvfrom() syscall of its own, so each "block" holds a single packet. The
+    timeout lets the caller regain control when the wire is quiet.
+    '''
+
+    rawsocket.settimeout(POLLTIMEOUT / 1000)
+
+
+
+    while True:
+
+        try:
+
+            pkt, addr = rawsocket.recvfrom(65536)
+
+        except socket.timeout:
+
+            yield []
+
+            continue
+
+
+
+        yield [pkt]
+
+
+
+def openRingSocket(iface, blocksize, blockcount):
+    '''
+    This function creates an AF_PACKET socket with a memory-mapped TPACKET_V3
+    receive ring. The kernel fills whole blocks of frames in the ring and
+    hands a block to userspace when it is full or when the block timeout
+    expires, so one poll() covers hundreds of packets instead of one
+    recvfrom() per packet.
+    '''
+
+    '''
+    The ring is set up as follows:
+    1.) socket.htons(ETH_P_IP) only asks the kernel for IPv4 frames. TCP is
+        filtered in userspace by checking the protocol byte of the IP header.
+    2.) PACKET_VERSION switches the socket to TPACKET_V3, the only version
+        that supports variable sized frames packed into blocks.
+    3.) PACKET_RX_RING takes a tpacket_req3 structure of seven unsigned ints:
+        block size, block count, frame size, frame count, block retire timeout
+        in ms, size of the private area and the feature request word.
+    4.) mmap() maps blocksize * blockcount bytes of the ring into our address
+        space. Nothing is copied; the frames are read where the kernel put
+        them.
+    '''
+
+    ringsocket = socket.socket(socket.AF_PACKET, \
+                               socket.SOCK_RAW, \
+                               socket.htons(ETH_P_IP))
+    ringsocket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+
+    tpreq = struct.pack('IIIIIII', \
+                        blocksize, \
+                        blockcount, \
+                        FRAMESIZE, \
+                        (blocksize * blockcount) // FRAMESIZE, \
+                        BLOCKTIMEOUT, \
+                        0, \
+                        0)
+    ringsocket.setsockopt(SOL_PACKET, PACKET_RX_RING, tpreq)
+
+
+
+    #bind to a single interface if asked, otherwise all interfaces are read
+    if iface:
+
+        ringsocket.bind((iface, ETH_P_IP))
+
+
+
+    ring = mmap.mmap(ringsocket.fileno(), \
+                     blocksize * blockcount, \
+                     mmap.MAP_SHARED, \
+                     mmap.PROT_READ | mmap.PROT_WRITE)
+
+
+
+    return ringsocket, ring
+
+
+
+def readRingBlocks(ringsocket, ring, blocksize, blockcount):
+    '''
+    This generator walks the TPACKET_V3 ring block by block. It yields a list
+    of memoryviews over the IP packets of a block and hands the block back to
+    the kernel once the caller asks for the next one, so the views must not be
+    kept past that point.
+    '''
+
+    '''
+    Offsets used from <linux/if_packet.h>:
+    1.) tpacket_block_desc: block_status at byte 8, num_pkts at byte 12 and
+        offset_to_first_pkt at byte 16.
+    2.) tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len and
+        tp_status as six unsigned ints followed by tp_mac and tp_net as two
+        unsigned shorts. tp_net is where the IP header starts and tp_mac +
+        tp_snaplen is where the captured frame ends. The IP total length
+        ends the packet before that if the frame carries Ethernet padding.
+    3.) sockaddr_ll follows the 48 byte tpacket3_hdr; sll_pkttype sits 10
+        bytes into it. Outgoing frames are skipped so that the ring sees the
+        same traffic as the AF_INET raw socket.
+    '''
+
+    view = memoryview(ring)
+    poller = select.poll()
+    poller.register(ringsocket, select.POLLIN | select.POLLERR)
+    blockindex = 0
+
+
+
+    while True:
+
+        blockoffset = blockindex * blocksize
+
+
+
+        #wait for the kernel to retire the block to userspace
+        if not BLOCKSTATUS.unpack_from(ring, blockoffset + 8)[0] \
+        & TP_STATUS_USER:
+
+            poller.poll(POLLTIMEOUT)
+
+
+
+            if not BLOCKSTATUS.unpack_from(ring, blockoffset + 8)[0] \
+            & TP_STATUS_USER:
+
+                yield []
+
+                continue
+
+
+
+        #collect views of every IP/TCP packet in the block
+        numpkts, pktoffset = BLOCKHEADER.unpack_from(ring, blockoffset + 12)
+        pktoffset += blockoffset
+        frames = []
+
+
+
+        for i in range(numpkts):
+
+            nextoffset, sec, nsec, snaplen, pktlen, status, mac, net \
+            = FRAMEHEADER.unpack_from(ring, pktoffset)
+
+
+
+            if ring[pktoffset + 58] != PACKET_OUTGOING \
+            and ring[pktoffset + net + 9] == socket.IPPROTO_TCP:
+
+                length = IPLENGTH.unpack_from(ring, pktoffset + net + 2)[0]
+                length = min(length, mac + snaplen - net)
+                frames.append(view[pktoffset + net : \
+                                   pktoffset + net + length])
+
+
+
+            pktoffset += nextoffset
+
+
+
+        yield frames
+
+
+
+        #give the block back to the kernel
+        BLOCKSTATUS.pack_into(ring, blockoffset + 8, TP_STATUS_KERNEL)
+        blockindex = (blockindex + 1) % blockcount
+
+
+
+def ringDrops(ringsocket):
+    '''
+    This function returns the number of packets the kernel dropped because the
+    ring was full since the last call (reading the statistics resets them).
+    '''
+
+    stats = ringsocket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12)
+
+
+
+    return struct.unpack('III', stats)[1]
+
+
+
+def compileFilter(ports, excludeports, hosts, excludehosts):
+    '''
+    This function builds the classic BPF program that dk.py attaches to its
+    capture socket. Only TCP segments with the ACK flag set are passed to
+    userspace, optionally narrowed down to segments from or to the given
+    ports and hosts and without the excluded ones. It returns a list of
+    (code, jt, jf, k) instructions.
+    '''
+
+    '''
+    The program reads:
+    1.) ldb [9]: the protocol byte of the IP header, dropping anything that
+        isn't TCP (6).
+    2.) ldh [6]: the flags and fragment offset, dropping non-first fragments
+        which don't carry a TCP header.
+    3.) ldxb 4*([0]&0xf): the IP header length into X, so the TCP fields can
+        be loaded at [x + n] whatever the IP options are.
+    4.) ldb [x + 13]: the TCP flags, dropping segments without ACK (0x10).
+    5.) ldh [x + 0] and ldh [x + 2]: the source and destination port, checked
+        against the include and exclude lists.
+    6.) ld [12] and ld [16]: the source and destination address, checked the
+        same way.
+    All offsets are relative to SKF_NET_OFF, i.e. the start of the IP header,
+    so the same program works on the AF_INET raw socket (which starts at the
+    IP header) and on the AF_PACKET ring (which starts at the link layer
+    header). Jumps are written against labels and resolved at the end because
+    classic BPF only jumps forward by an 8-bit offset.
+    '''
+
+    program = [(BPF_LD_B_ABS, 0, 0, SKF_NET_OFF + 9), \
+               (BPF_JEQ_K, 0, "drop", socket.IPPROTO_TCP), \
+               (BPF_LD_H_ABS, 0, 0, SKF_NET_OFF + 6), \
+               (BPF_JSET_K, "drop", 0, 0x1FFF), \
+               (BPF_LDX_B_MSH, 0, 0, SKF_NET_OFF + 0), \
+               (BPF_LD_B_IND, 0, 0, SKF_NET_OFF + 13), \
+               (BPF_JSET_K, 0, "drop", 0x10)]
+    checks = [(BPF_LD_H_IND, 0, 2, ports, excludeports), \
+              (BPF_LD_W_ABS, 12, 16, hosts, excludehosts)]
+
+
+
+    for i, (code, srcoffset, dstoffset, include, exclude) in enumerate(checks):
+
+        #drop anything from or to an excluded value
+        for offset in [srcoffset, dstoffset]:
+
+            if exclude:
+
+                program.append((code, 0, 0, SKF_NET_OFF + offset))
+
+                for value in exclude:
+
+                    program.append((BPF_JEQ_K, "drop", 0, value))
+
+
+
+        #pass only what is from or to an included value
+        if include:
+
+            for offset in [srcoffset, dstoffset]:
+
+                program.append((code, 0, 0, SKF_NET_OFF + offset))
+
+                for value in include:
+
+                    program.append((BPF_JEQ_K, f"match{i}", 0, value))
+
+
+
+            program.append((BPF_RET_K, 0, 0, 0))
+            program.append(f"match{i}")
+
+
+
+    program.append((BPF_RET_K, 0, 0, 0xFFFF))
+    program.append("drop")
+    program.append((BPF_RET_K, 0, 0, 0))
+
+
+
+    #resolve the labels into jump offsets
+    labels = {}
+    position = 0
+
+    for insn in program:
+
+        if isinstance(insn, str):
+
+            labels[insn] = position
+
+        else:
+
+            position += 1
+
+
+
+    instructions = []
+
+    for insn in [insn for insn in program if not isinstance(insn, str)]:
+
+        code, jt, jf, k = insn
+        here = len(instructions) + 1
+        jt = labels[jt] - here if isinstance(jt, str) else jt
+        jf = labels[jf] - here if isinstance(jf, str) else jf
+
+
+
+        if jt > 255 or jf > 255:
+
+            sys.exit("BPF filter too long, use shorter port/host lists.")
+
+
+
+        instructions.append((code, jt, jf, k))
+
+
+
+    return instructions
+
+
+
+def attachFilter(capsocket, instructions):
+    '''
+    This function attaches a classic BPF program to a socket with
+    SO_ATTACH_FILTER. The kernel then drops every packet the program rejects
+    before it is queued to the socket or copied into the ring.
+    '''
+
+    '''
+    SO_ATTACH_FILTER takes a struct sock_fprog: the number of instructions as
+    an unsigned short followed by a pointer to the array of struct
+    sock_filter. The array is built in a ctypes buffer so it has an address;
+    the kernel copies it during the setsockopt() call.
+    '''
+
+    code = b''.join(BPFINSN.pack(code, jt, jf, k & 0xFFFFFFFF) \
+                    for code, jt, jf, k in instructions)
+    buffer = ctypes.create_string_buffer(code, len(code))
+    fprog = struct.pack('HP', len(instructions), ctypes.addressof(buffer))
+
+    capsocket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+
+def runFilter(instructions, pkt):
+    '''
+    This function interprets the BPF program in userspace for an IP packet.
+    It is only used by --replay to count what the kernel would have passed.
+    Loads past the end of the packet reject it, as they do in the kernel.
+    '''
+
+    a = x = pc = 0
+
+
+
+    while True:
+
+        code, jt, jf, k = instructions[pc]
+        pc += 1
+
+
+
+        if code == BPF_RET_K:
+
+            return k
+
+
+
+        if code == BPF_JEQ_K or code == BPF_JSET_K:
+
+            taken = a == k if code == BPF_JEQ_K else a & k
+
+            pc += jt if taken else jf
+
+            continue
+
+
+
+        offset = k - SKF_NET_OFF
+
+
+
+        if code == BPF_LDX_B_MSH:
+
+            if offset >= len(pkt):
+
+                return 0
+
+            x = (pkt[offset] & 0x0F) * 4
+
+            continue
+
+
+
+        if code in (BPF_LD_H_IND, BPF_LD_B_IND):
+
+            offset += x
+
+
+
+        if code == BPF_LD_W_ABS:
+
+            width = 4
+
+        elif code in (BPF_LD_H_ABS, BPF_LD_H_IND):
+
+            width = 2
+
+        else:
+
+            width = 1
+
+
+
+        if offset + width > len(pkt):
+
+            return 0
+
+
+
+        a = int.from_bytes(pkt[offset : offset + width], 'big')
+
+
+
+def readPcap(path):
+    '''
+    This generator yields the IPv4 packets of a pcap file with the link layer
+    header stripped, the way the raw socket would have returned them.
+    '''
+
+    with open(path, 'rb') as pcap:
+
+        header = pcap.read(24)
+        endian = '<' if header[: 4] in (b'\xd4\xc3\xb2\xa1', \
+                                        b'\x4d\x3c\xb2\xa1') else '>'
+        linktype = struct.unpack(endian + 'I', header[20 : 24])[0] & 0xFFFF
+        linklen = PCAPLINKTYPES.get(linktype)
+
+
+
+        if linklen is None:
+
+            sys.exit(f"Unsupported pcap link type {linktype}.")
+
+
+
+        recordheader = struct.Struct(endian + 'IIII')
+
+
+
+        while True:
+
+            record = pcap.read(16)
+
+            if len(record) < 16:
+
+                return
+
+
+
+            sec, usec, caplen, wirelen = recordheader.unpack(record)
+            frame = pcap.read(caplen)
+            pkt = frame[linklen :]
+
+
+
+            if pkt and pkt[0] >> 4 == 4:
+
+                yield pkt
+
+
+
+def replayBenchmark(path, instructions, batch):
+    '''
+    This function replays a capture through the indicator checks twice:
+    once with every TCP packet reaching userspace, as with the bare raw
+    socket, and once with only the packets the BPF filter passes. It reports
+    how many packets userspace handled and how long it took each way.
+    '''
+
+    global flowtable
+    pkts = [pkt for pkt in readPcap(path) if pkt[9] == socket.IPPROTO_TCP]
+    passed = [pkt for pkt in pkts if runFilter(instructions, pkt)]
+
+    print(f"\n\n\nReplaying {len(pkts)} TCP packets from {path}...\n")
+
+
+
+    for name, selected in [("no filter", pkts), ("BPF filter", passed)]:
+
+        flowtable = FlowTable(flowtable.maxflows, flowtable.idletimeout)
+
+
+
+        with open(os.devnull, 'w') as devnull, \
+        contextlib.redirect_stdout(devnull):
+
+            start = time.perf_counter()
+            inspectBlock(selected, batch)
+
+            if batch is not None:
+
+                inspectBlock([], batch)
+
+            elapsed = time.perf_counter() - start
+
+
+
+        print(f"{name:>10}: {len(selected):10} packets to userspace in \
+{elapsed:.3f}s")
+
+
+
+def openBackend(backend, iface, blocksize, blockcount, instructions):
+    '''
+    This function opens the requested capture backend, attaches the BPF
+    filter if there is one, and returns its name, its socket and a generator
+    of packet blocks. If the ring cannot be set up (old kernel, no AF_PACKET,
+    not enough locked memory) it falls back to the raw socket.
+    '''
+
+    if backend == "ring":
+
+        try:
+
+            ringsocket, ring = openRingSocket(iface, blocksize, blockcount)
+
+
+
+            if instructions:
+
+                attachFilter(ringsocket, instructions)
+
+
+
+            return "ring", ringsocket, readRingBlocks(ringsocket, \
+                                                     ring, \
+                                                     blocksize, \
+                                                     blockcount)
+
+
+
+        except (AttributeError, OSError) as error:
+
+            print(f"TPACKET_V3 ring unavailable ({error}), falling back to \
+the raw socket.")
+
+
+
+    rawsocket = openRawSocket()
+
+
+
+    if instructions:
+
+        attachFilter(rawsocket, instructions)
+
+
+
+    return "socket", rawsocket, readRawSocket(rawsocket)
+
+
+
+def inspectBlock(block, batch):
+    '''
+    This function runs the indicator checks on a block of packets, one packet
+    at a time or, if a batch is given, through the batched path. A partial
+    batch is evaluated when the capture goes quiet (an empty block) so alerts
+    aren't held back waiting for a full batch.
+    '''
+
+    if batch is None:
+
+        for pkt in block:
+
+            printIndicators(pkt)
+
+
+
+        return
+
+
+
+    for pkt in block:
+
+        if batch.add(pkt):
+
+            printBatchIndicators(batch)
+
+
+
+    if not block and batch.offsets:
+
+        printBatchIndicators(batch)
+
+
+
+def fanoutWorker(groupid, iface, blocksize, blockcount, instructions, batch):
+    '''
+    This function runs in each worker process of --workers mode. It opens its
+    own TPACKET_V3 ring, joins the PACKET_FANOUT group so the kernel gives it
+    a share of the flows, and runs the usual capture loop on that share. The
+    flow hash keeps every packet of a connection on the same worker, so each
+    worker's flow table sees whole flows.
+    '''
+
+    name, capsocket, blocks = openBackend("ring", \
+                                          iface, \
+                                          blocksize, \
+                                          blockcount, \
+                                          instructions)
+
+
+
+    if name != "ring":
+
+        print("--workers needs the AF_PACKET ring backend.")
+
+        return
+
+
+
+    pf.joinFanout(capsocket, groupid)
+
+
+
+    try:
+
+        for block in blocks:
+
+            inspectBlock(block, batch)
+            pf.countPackets(len(block))
+
+
+
+    except KeyboardInterrupt:
+
+        print(f"Flow table: {flowtable.stats()}")
+
+
+
+def benchmarkBackend(backend, \
+                     seconds, \
+                     iface, \
+                     blocksize, \
+                     blockcount, \
+                     instructions, \
+                     batch):
+    '''
+    This function runs the indicator checks on one backend for the given
+    number of seconds with the alerts muted and returns the backend actually
+    used, the packets per second it sustained and the kernel drops seen.
+    '''
+
+    name, capsocket, blocks = openBackend(backend, \
+                                          iface, \
+                                          blocksize, \
+                                          blockcount, \
+                                          instructions)
+    pktcount = 0
+    drops = 0
+
+
+
+    #drain the statistics gathered while the ring was being set up
+    if name == "ring":
+
+        ringDrops(capsocket)
+
+
+
+    with open(os.devnull, 'w') as devnull, \
+    contextlib.redirect_stdout(devnull):
+
+        start = time.perf_counter()
+
+
+
+        for block in blocks:
+
+            inspectBlock(block, batch)
+            pktcount += len(block)
+
+
+
+            if time.perf_counter() - start >= seconds:
+
+                break
+
+
+
+        elapsed = time.perf_counter() - start
+
+
+
+    if name == "ring":
+
+        drops = ringDrops(capsocket)
+
+
+
+    blocks.close()
+    capsocket.close()
+
+
+
+    return name, pktcount / elapsed, drops
+
+
+
+#parse command line arguments
+parser = argparse.ArgumentParser(description="Sniff out potential ACK \
+tunneling")
+parser.add_argument("--backend", choices=["ring", "socket"], default="ring", \
+                    help="capture backend (default: ring, falls back to \
+socket)")
+parser.add_argument("--iface", default=None, \
+                    help="interface for the ring backend (default: all)")
+parser.add_argument("--block-size", type=int, default=1 << 20, \
+                    help="ring block size in bytes (default: 1 MiB)")
+parser.add_argument("--block-count", type=int, default=64, \
+                    help="number of ring blocks (default: 64)")
+parser.add_argument("--max-flows", type=int, default=1000000, \
+                    help="hard cap on tracked flows, about 230 bytes each \
+(default: 1000000)")
+parser.add_argument("--flow-timeout", type=float, default=120, \
+                    help="seconds before an idle flow is expired (default: \
+120)")
+parser.add_argument("--no-filter", action="store_true", \
+                    help="don't attach the BPF filter, every TCP packet \
+reaches userspace")
+parser.add_argument("--ports", default="", \
+                    help="comma separated ports; only pass segments from or \
+to them")
+parser.add_argument("--exclude-ports", default="", \
+                    help="comma separated ports to drop in the kernel")
+parser.add_argument("--hosts", default="", \
+                    help="comma separated IPv4 addresses; only pass segments \
+from or to them")
+parser.add_argument("--exclude-hosts", default="", \
+                    help="comma separated IPv4 addresses to drop in the \
+kernel")
+parser.add_argument("--replay", metavar="PCAP", \
+                    help="count and time the packets userspace handles with \
+and without the BPF filter on a capture file, then exit")
+parser.add_argument("--batch", type=int, metavar="SIZE", \
+                    help="evaluate the indicators over batches of SIZE \
+packets with NumPy")
+parser.add_argument("--workers", type=int, default=1, \
+                    help="number of capture processes sharing the traffic \
+through PACKET_FANOUT (default: 1)")
+parser.add_argument("--benchmark", type=float, metavar="SECONDS", \
+                    help="measure packets per second of the ring and the \
+recvfrom loop for SECONDS each, then exit")
+args = parser.parse_args()
+
+
+
+#track the ACK numbers of each flow
+flowtable = FlowTable(args.max_flows, args.flow_timeout)
+
+
+
+#compile the kernel-side filter
+instructions = None
+
+if not args.no_filter or args.replay:
+
+    instructions = compileFilter( \
+        [int(port) for port in args.ports.split(",") if port], \
+        [int(port) for port in args.exclude_ports.split(",") if port], \
+        [ADDRESS.unpack(socket.inet_aton(host))[0] \
+         for host in args.hosts.split(",") if host], \
+        [ADDRESS.unpack(socket.inet_aton(host))[0] \
+         for host in args.exclude_hosts.split(",") if host])
+
+
+
+#set up the batched path
+batch = None
+
+if args.batch:
+
+    if numpy is None:
+
+        sys.exit("--batch needs NumPy (pip3 install numpy).")
+
+
+
+    batch = PacketBatch(args.batch)
+
+
+
+#compare userspace load with and without the filter on a capture
+if args.replay:
+
+    replayBenchmark(args.replay, instructions, batch)
+
+    sys.exit(0)
+
+
+
+#benchmark both backends against the same traffic
+if args.benchmark:
+
+    print(f"\n\n\nBenchmarking each backend for {args.benchmark} seconds. \
+Generate traffic now...\n")
+
+
+
+    for backend in ["ring", "socket"]:
+
+        name, pps, drops = benchmarkBackend(backend, \
+                                            args.benchmark, \
+                                            args.iface, \
+                                            args.block_size, \
+                                            args.block_count, \
+                                            instructions, \
+                                            batch)
+
+        print(f"{name:>6}: {pps:12.0f} packets/s, {drops} kernel drops")
+        print(f"        {flowtable.stats()}")
+
+
+
+    sys.exit(0)
+
+
+
+#spread the flows over several processes
+if args.workers > 1:
+
+    pf.runWorkers(args.workers, \
+                  fanoutWorker, \
+                  (args.iface, \
+                   args.block_size, \
+                   args.block_count, \
+                   instructions, \
+                   batch))
+
+    sys.exit(0)
+
+
+
+#inspect packets
+name, capsocket, blocks = openBackend(args.backend, \
+                                      args.iface, \
+                                      args.block_size, \
+                                      args.block_count, \
+                                      instructions)
+
+print(f"\n\n\nSniffing for ACK tunneling ({name} backend)...\n\n\n")
+
+try:
+
+    for block in blocks:
+
+        inspectBlock(block, batch)
+
+
+
+except KeyboardInterrupt:
+
+    print(f"\n\n\nFlow table: {flowtable.stats()}")
@@ -18,12 +18,29 @@
 #              available on A for receiving packets. So when B receives a     #
 #              packet with window size 1, it would tell B how many bytes it   #
 #              is allowed to send to A before getting a response.             #
+#              With --passive nothing is sent. The hop count of each packet   #
+#              is inferred from its TTL (the initial TTL is taken to be the   #
+#              smallest of 32, 64, 128 and 255 not below it) and compared to  #
+#              the hop count learned for its /24 from TCP handshakes seen     #
+#              from their SYN. A spoofer rarely guesses the right TTL for the #
+#              address it forges, so a packet whose hop count is off is a     #
+#              sign of spoofing (see res/DetectingSpoofed.pdf).               #
 #                                                                             #
-# INPUT: None                                                                 #
+# INPUT: Optional command line arguments (see ./ip.py --help)                 #
 #                                                                             #
 # OUTPUT: STDOUT                                                              #
 #                                                                             #
-# PRE-RUNTIME NOTES: None                                                     #
+# PRE-RUNTIME NOTES: 1.) The probes are sent from a raw socket and their      #
+#                        replies are picked out of the capture, so sniffing   #
+#                        goes on while up to --max-probes probes wait for     #
+#                        PROBETIMEOUT seconds. At most --probe-rate probes go #
+#                        out per second and --max-prefix-probes per /24 per   #
+#                        minute, the sources with the most SYNs first, so a   #
+#                        SYN flood isn't answered with a flood of probes.     #
+#                    2.) The hop-count table has two bytes per /24 (32 MB in  #
+#                        all) and is kept between runs with --hop-table.      #
+#                        Hop counts are only checked once their /24 has been  #
+#                        seen in HOPMINSEEN handshakes.                       #
 #                                                                             #
 # AUTHORS: @southwickio                                                       #
 #                                                                             #
@@ -41,24 +58,764 @@
 
 #import dependencies
 from scapy.all import *
+from array import array
+import argparse
+import collections
+import heapq
+import os
+import socket
+import struct
 import time
 
 
 
-#initialize members
-spoofers = []
-incomingips = []
+#declare constants
+PROBETIMEOUT = 3 #seconds a probe waits for its reply
+PROBEROUNDS = 2 #probes a source has to accept in a row to count as spoofed
+PROBEBURST = 2 #seconds of --probe-rate the token bucket can save up
+PREFIXWINDOW = 60 #seconds the probes per /24 are counted over
+MAXCANDIDATES = 4096 #sources waiting for a probe, further ones are skipped
+CANDIDATEWAIT = 10 #seconds a source waits for a probe before it is skipped
+MAXBACKLOG = 256 #probes waiting for room in the socket buffer
+SEQMOD = 1 << 32 #TCP sequence numbers wrap around
+SYN = 0x02 #TCP flags
+RST = 0x04
+ACK = 0x10
+SYNACK = SYN | ACK
+PROBEACCEPTED = 1 #outcomes of matching a packet against the probes
+PROBEREFUSED = 2
+PROBESPOOFED = 3
+HOPMISMATCH = 4 #verdict of --passive
+VERDICTTTL = 300 #seconds a source is not probed again after a probe
+MAXSOURCES = 65536 #sources whose counters are kept, the oldest are evicted
+MAXSPOOFERS = 4096 #potential spoofers kept for the report
+VERDICTNAMES = {None: "-", \
+                PROBEREFUSED: "refused", \
+                PROBESPOOFED: "spoofed", \
+                HOPMISMATCH: "hop count"}
+INITIALTTLS = (32, 64, 128, 255) #initial TTLs used by common stacks
+HOPCOUNTS = [min(initial for initial in INITIALTTLS if initial >= ttl) - ttl \
+             for ttl in range(256)] #TTL: hop count
+HOPTABLESIZE = 1 << 24 #one entry per /24
+HOPTOLERANCE = 1 #hops a packet may be off the learned hop count
+HOPMINSEEN = 4 #handshakes a /24 needs before it is checked or relearned
+MAXHOPCHANGES = 65536 #/24s whose new hop count is being confirmed
+MAXHANDSHAKES = 65536 #TCP handshakes followed, the oldest are dropped
+MAXFRAME = 65535 #bytes read per captured frame
+ETHERLENGTH = 14 #bytes of an ethernet header
+LINKOFFSETS = {1: ETHERLENGTH, 113: 16, 228: 0} #DLT: link header length
+VLANTYPES = (b"\x81\x00", b"\x88\xa8") #802.1Q and 802.1ad ethertypes
+IPV4TYPE = b"\x08\x00"
+
+#version/ihl, flags/fragment offset, ttl, protocol, source, destination
+IPHEADER = struct.Struct("!B5xHBB2x4s4s")
+
+#source port, destination port, sequence number, ack number, flags
+TCPHEADER = struct.Struct("!HHIIxB")
+
+
+
+#define classes
+class SourceCounts:
+    '''
+    Counters of one source: the SYNs seen from it, the probes sent to it or
+    skipped for lack of budget, the replies matched to them and its packets
+    with a hop count off the learned one, plus the last verdict and when it
+    was last probed.
+    '''
+
+    __slots__ = ('syns', 'probes', 'skipped', 'replies', 'mismatches', \
+                 'verdict', 'probed')
+
+
+
+    def __init__(self):
+
+        self.syns = 0
+        self.probes = 0
+        self.skipped = 0
+        self.replies = 0
+        self.mismatches = 0
+        self.verdict = None
+        self.probed = None
+
+
+
+class SourceTable:
+    '''
+    Keeps the SourceCounts of up to maxsources sources in a least recently
+    used map, and caches the verdict of a source for ttl seconds: a source
+    is probed at most once per ttl, however many SYNs it sends. Potential
+    spoofers are kept in their own capped set so the report doesn't lose
+    them when their counters are evicted.
+    '''
+
+    def __init__(self, maxsources, maxspoofers, ttl):
+
+        self.maxsources = maxsources
+        self.maxspoofers = maxspoofers
+        self.ttl = ttl
+        self.sources = collections.OrderedDict() #address: SourceCounts
+        self.spoofers = {} #address: None, a set that keeps its order
+        self.evicted = 0
+
+
+
+    def get(self, address):
+
+        counts = self.sources.get(address)
+
+
+
+        if counts is None:
+
+            counts = SourceCounts()
+            self.sources[address] = counts
+
+
+
+            if len(self.sources) > self.maxsources:
+
+                self.sources.popitem(last=False)
+                self.evicted += 1
+
+
+
+        else:
+
+            self.sources.move_to_end(address)
+
+
+
+        return counts
+
+
+
+    def isDue(self, counts, now):
+        '''
+        Returns whether the ttl of the last probe of the source of counts has
+        run out. Setting counts.probed starts a new one.
+        '''
+
+        return counts.probed is None or now - counts.probed >= self.ttl
+
+
+
+    def addSpoofer(self, address):
+
+        if address not in self.spoofers \
+        and len(self.spoofers) < self.maxspoofers:
+
+            self.spoofers[address] = None
+
+
+
+class ProbeEngine:
+    '''
+    Sends the window-zero SYN/ACK probes from a raw socket of its own and
+    pairs the replies with them as they are captured, so the sniff callback
+    never waits on a probe. A probe answers a SYN with the SYN's sequence
+    number as its own, which makes any reply carry it: an ACK acknowledges
+    seq + 1 and a RST without ACK uses our ack of seq + 1 as its sequence
+    number. Outstanding probes are kept under the 4-tuple of the SYN and its
+    sequence number until PROBETIMEOUT runs out.
+    '''
+
+    def __init__(self, timeout, rounds, maxprobes, maxbacklog):
+
+        self.timeout = timeout
+        self.rounds = rounds
+        self.maxprobes = maxprobes
+        self.probes = collections.OrderedDict() #key: [attempt, deadline]
+        self.backlog = collections.deque()
+        self.maxbacklog = maxbacklog
+        self.counters = collections.Counter()
+
+
+
+        #IPPROTO_RAW implies IP_HDRINCL, so the probe can carry the SYN's
+        #destination as its source
+        self.sock = socket.socket(socket.AF_INET, \
+                                  socket.SOCK_RAW, \
+                                  socket.IPPROTO_RAW)
+        self.sock.setblocking(False)
+
+
+
+    def __len__(self):
+
+        return len(self.probes)
+
+
+
+    def probe(self, ipsrc, sport, ipdst, dport, seq, now):
+        '''
+        Starts probing the source of a SYN. Returns False if the SYN is
+        already being probed or too many probes are outstanding.
+        '''
+
+        key = (ipsrc, sport, ipdst, dport, seq)
+
+
+
+        if key in self.probes or len(self.probes) >= self.maxprobes:
+
+            self.counters["skipped"] += 1
+
+            return False
+
+
+
+        self.send(key, 1, now)
+
+        return True
+
+
+
+    def send(self, key, attempt, now):
+
+        ipsrc, sport, ipdst, dport, seq = key
+
+
+
+        #craft a SYN/ACK packet with window size of 0
+        '''
+        / is the Scapy operator used to stack the ip and tcp layers
+        together
+        '''
+        synackpac = IP(dst=ipsrc, src=ipdst)/TCP(dport=sport, \
+            sport=dport, \
+            flags="SA", \
+            seq=seq, \
+            ack=(seq + 1) % SEQMOD, \
+            window=0)
+
+
+
+        self.probes.pop(key, None)
+        self.probes[key] = [attempt, now + self.timeout]
+        self.counters["sent"] += 1
+
+
+
+        if len(self.backlog) >= self.maxbacklog:
+
+            self.counters["dropped"] += 1
+
+            return
+
+
+
+        self.backlog.append((bytes(synackpac), ipsrc))
+        self.flush()
+
+
+
+    def flush(self):
+        '''
+        Writes the waiting probes until the socket buffer is full.
+        '''
+
+        while self.backlog:
+
+            data, address = self.backlog[0]
+
+
+
+            try:
+
+                self.sock.sendto(data, (address, 0))
+
+            except BlockingIOError:
+
+                return
+
+            except OSError:
+
+                self.counters["failed"] += 1
+
+
+
+            self.backlog.popleft()
+
+
+
+    def expire(self, now):
+
+        self.flush()
+
+
+
+        #probes are kept in the order of their deadlines
+        while self.probes:
+
+            key, (attempt, deadline) = next(iter(self.probes.items()))
+
+
+
+            if deadline > now:
+
+                break
+
+
+
+            del self.probes[key]
+            self.counters["timedout"] += 1
+
+
+
+    def match(self, ipsrc, sport, ipdst, dport, flags, seq, ack, now):
+        '''
+        Returns PROBEACCEPTED, PROBEREFUSED or PROBESPOOFED for a reply to an
+        outstanding probe, None for any other packet. A source that answers
+        with a SYN/ACK accepted the probe and is probed again, up to rounds
+        times.
+        '''
+
+        number = ack if flags & ACK else seq
+        key = (ipsrc, sport, ipdst, dport, (number - 1) % SEQMOD)
+        entry = self.probes.get(key)
+
+
+
+        if entry is None or not flags & (SYNACK | RST):
+
+            return None
+
+
+
+        self.counters["replies"] += 1
+
+
+
+        if flags & SYNACK != SYNACK:
+
+            del self.probes[key]
+
+            return PROBEREFUSED
+
+
+
+        if entry[0] < self.rounds:
+
+            self.send(key, entry[0] + 1, now)
+
+            return PROBEACCEPTED
+
+
+
+        del self.probes[key]
+
+        return PROBESPOOFED
+
+
+
+class ProbeBudget:
+    '''
+    Decides which sources get probed, so a SYN flood of spoofed sources
+    doesn't turn into a flood of probes. Sources due for a probe wait as
+    candidates and take() hands out the ones with the most SYNs first, as
+    long as the token bucket (rate probes/s, saving up to burst) has tokens
+    and the caller has room for more outstanding probes. A /24 gets at most
+    prefixlimit probes per PREFIXWINDOW. Candidates dropped on the way are
+    counted per reason in counters and on their SourceCounts. A source that
+    accepts a probe is probed again outside the budget, so at most twice the
+    rate goes out.
+    '''
+
+    def __init__(self, rate, burst, prefixlimit, maxcandidates):
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = None
+        self.prefixlimit = prefixlimit
+        self.prefixes = collections.Counter() #/24: probes this window
+        self.window = None
+        self.maxcandidates = maxcandidates
+        self.candidates = collections.OrderedDict() #address: [syn, counts,
+                                                    #waiting since]
+        self.counters = collections.Counter()
+
+
+
+    def skip(self, counts, reason):
+
+        counts.skipped += 1
+        self.counters[reason] += 1
+
+
+
+    def offer(self, address, syn, counts, now):
+        '''
+        Adds a source as a candidate, syn being the (sport, dst, dport, seq)
+        of the SYN to answer; a source already waiting keeps its place and
+        answers its latest SYN.
+        '''
+
+        candidate = self.candidates.get(address)
+
+
+
+        if candidate is not None:
+
+            candidate[0] = syn
+
+        else:
+
+            #when full, a source with more SYNs replaces the oldest candidate
+            if len(self.candidates) >= self.maxcandidates:
+
+                oldest = next(iter(self.candidates.values()))
+
+
+
+                if oldest[1].syns >= counts.syns:
+
+                    self.skip(counts, "queue")
+
+                    return
+
+
+
+                self.candidates.popitem(last=False)
+                self.skip(oldest[1], "queue")
+
+
+
+            self.candidates[address] = [syn, counts, now]
+
+
+
+    def take(self, now, room):
+        '''
+        Returns up to room (address, syn, counts) candidates to probe now.
+        '''
+
+        #refill the bucket
+        if self.last is not None:
+
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, \
+                              self.burst)
+
+
+
+        self.last = now
+
+
+
+        #skip the candidates that waited too long, oldest first
+        while self.candidates:
+
+            address, candidate = next(iter(self.candidates.items()))
+
+
+
+            if now - candidate[2] < CANDIDATEWAIT:
+
+                break
+
+
+
+            del self.candidates[address]
+            self.skip(candidate[1], "expired")
+
+
+
+        count = min(int(self.tokens), room, len(self.candidates))
+
+
+
+        if count <= 0:
+
+            return []
+
+
+
+        if self.window is None or now - self.window >= PREFIXWINDOW:
+
+            self.window = now
+            self.prefixes.clear()
+
+
+
+        chosen = []
+
+
+
+        for address, (syn, counts, since) \
+        in heapq.nlargest(count, \
+                          self.candidates.items(), \
+                          key=lambda item: item[1][1].syns):
+
+            del self.candidates[address]
+            prefix = address.rsplit(".", 1)[0]
+
+
+
+            if self.prefixes[prefix] >= self.prefixlimit:
+
+                self.skip(counts, "prefix")
+
+                continue
+
+
+
+            self.prefixes[prefix] += 1
+            self.tokens -= 1
+            chosen.append((address, syn, counts))
+
+
+
+        return chosen
+
+
+
+class HandshakeTable:
+    '''
+    Follows TCP handshakes from their SYN to pick out the packets a spoofer
+    could not have sent: a SYN/ACK that acknowledges a SYN seen before, and
+    the ACK that acknowledges that SYN/ACK, which takes receiving it. Only
+    these are learned from; a bare ACK on its own proves nothing. At most
+    maxentries handshakes are followed, the oldest are dropped.
+    '''
+
+    def __init__(self, maxentries):
+
+        self.maxentries = maxentries
+        self.entries = collections.OrderedDict() #(client, client port,
+                                                 #server, server port):
+                                                 #[SYN seq, SYN/ACK seq]
+
+
+
+    def isProven(self, src, sport, dst, dport, flags, seq, ack):
+        '''
+        Follows a TCP packet and returns whether it is the SYN/ACK or the
+        ACK of a handshake seen from its SYN.
+        '''
+
+        flags &= SYN | RST | ACK
+
+
+
+        if flags == SYN:
+
+            self.entries[(src, sport, dst, dport)] = [seq, None]
+            self.entries.move_to_end((src, sport, dst, dport))
+
+
+
+            if len(self.entries) > self.maxentries:
+
+                self.entries.popitem(last=False)
+
+
+
+        elif flags == SYN | ACK:
+
+            entry = self.entries.get((dst, dport, src, sport))
+
+
+
+            if entry is not None and entry[1] is None \
+            and ack == (entry[0] + 1) % SEQMOD:
+
+                entry[1] = seq
+
+                return True
+
+        elif flags == ACK:
+
+            entry = self.entries.get((src, sport, dst, dport))
+
+
+
+            if entry is not None and entry[1] is not None \
+            and ack == (entry[1] + 1) % SEQMOD:
+
+                del self.entries[(src, sport, dst, dport)]
+
+                return True
+
+        elif flags & RST:
+
+            self.entries.pop((src, sport, dst, dport), None)
+            self.entries.pop((dst, dport, src, sport), None)
+
+
+
+        return False
+
+
+
+class HopTable:
+    '''
+    The hop counts learned per /24, in a flat array indexed by the first
+    three bytes of the address: hops holds the hop count + 1 (0 while none
+    is known) and seen how many handshake packets agreed with it within
+    HOPTOLERANCE, up to 255. Only packets a HandshakeTable proved are
+    learned from. A /24 seen fewer than HOPMINSEEN times takes any new hop
+    count at once; past that a new hop count (a change of route) replaces
+    the learned one only once HOPMINSEEN samples in a row agree on it, so a
+    few forged packets can't move it.
+    '''
+
+    def __init__(self):
+
+        self.hops = array('B', bytes(HOPTABLESIZE))
+        self.seen = array('B', bytes(HOPTABLESIZE))
+        self.changes = {} #/24: [new hop count, samples agreeing]
+        self.counters = collections.Counter()
+
+
+
+    def check(self, prefix, hopcount, learn):
+        '''
+        Learns or checks the hop count of a packet from the /24 prefix.
+        Returns the learned hop count if the packet is off it by more than
+        HOPTOLERANCE, else None.
+        '''
+
+        stored = self.hops[prefix]
+
+
+
+        if learn:
+
+            self.learn(prefix, hopcount)
+
+            return None
+
+
+
+        if stored == 0 or self.seen[prefix] < HOPMINSEEN:
+
+            self.counters["unknown"] += 1
+
+            return None
+
+
+
+        self.counters["checked"] += 1
+
+
+
+        if abs(stored - 1 - hopcount) <= HOPTOLERANCE:
+
+            return None
+
+
+
+        self.counters["mismatched"] += 1
+
+        return stored - 1
+
+
+
+    def learn(self, prefix, hopcount):
+
+        stored = self.hops[prefix]
+
+
+
+        #a sample that agrees confirms the hop count
+        if stored and abs(stored - 1 - hopcount) <= HOPTOLERANCE:
+
+            self.seen[prefix] = min(self.seen[prefix] + 1, 255)
+            self.changes.pop(prefix, None)
+
+            return
+
+
+
+        if not stored or self.seen[prefix] < HOPMINSEEN:
+
+            self.hops[prefix] = hopcount + 1
+            self.seen[prefix] = 1
+            self.counters["learned"] += 1
+
+            return
+
+
+
+        #a confident hop count only moves once the new one is confirmed
+        change = self.changes.get(prefix)
+
+
+
+        if change is not None and abs(change[0] - hopcount) <= HOPTOLERANCE:
+
+            change[1] += 1
+
+
+
+            if change[1] >= HOPMINSEEN:
+
+                self.hops[prefix] = change[0] + 1
+                self.seen[prefix] = change[1]
+                del self.changes[prefix]
+                self.counters["relearned"] += 1
+
+
+
+        elif change is not None or len(self.changes) < MAXHOPCHANGES:
+
+            self.changes[prefix] = [hopcount, 1]
+
+
+
+    def __len__(self):
+        '''
+        Returns the number of /24s with a hop count.
+        '''
+
+        return len(self.hops) - self.hops.count(0)
+
+
+
+    def load(self, path):
+
+        with open(path, "rb") as tablefile:
+
+            hops = array('B')
+            seen = array('B')
+            hops.fromfile(tablefile, HOPTABLESIZE)
+            seen.fromfile(tablefile, HOPTABLESIZE)
+
+
+
+        self.hops = hops
+        self.seen = seen
+
+
+
+    def save(self, path):
+
+        #write to a temporary file first so an interrupted save keeps the
+        #last table
+        with open(path + ".tmp", "wb") as tablefile:
+
+            self.hops.tofile(tablefile)
+            self.seen.tofile(tablefile)
+
+
+
+        os.replace(path + ".tmp", path)
 
 
 
 #define workhorse
 def processPacket(packet):
 
+    now = time.time()
+    prober.expire(now)
+
 
 
     #check if the packet has an ip layer
     if IP in packet:
-        
+
 
 
         #store ip addresses
@@ -69,90 +826,292 @@ def processPacket(packet):
 
         #display incoming ip address
         print("Src IP address: " + ipsrc)
+        counts = sources.get(ipsrc)
 
 
 
-        #check if the packet is a SYN packet
-        if 'TCP' in packet and packet[TCP].flags == "S":
+        #check if the packet answers one of our probes
+        if TCP in packet:
 
+            tcp = packet[TCP]
+            flags = int(tcp.flags)
+            verdict = prober.match(ipsrc, \
+                                   tcp.sport, \
+                                   ipdst, \
+                                   tcp.dport, \
+                                   flags, \
+                                   tcp.seq, \
+                                   tcp.ack, \
+                                   now)
 
 
-            #let the user know
-            print("\n\n\nA SYN packet was detected from", ipsrc)
-            print("Testing response.")
 
+            if verdict is not None:
 
+                counts.replies += 1
 
-            #craft a SYN/ACK packet with window size of 0
-            '''
-            / is the Scapy operator used to stack the ip and tcp layers 
-            together
-            '''
-            synackpac = IP(dst=ipsrc, src=ipdst)/TCP(dport=packet[TCP].sport, \
-                sport=packet[TCP].dport, \
-                flags="SA", \
-                window=0)
 
 
+                if verdict != PROBEACCEPTED:
 
-            #send the SYN/ACK packet to the source ip address
-            send(synackpac, verbose=0)
+                    counts.verdict = verdict
 
 
 
-            # Wait for a response
-            response = sr1(synackpac, timeout=3)
+            if verdict == PROBEACCEPTED:
 
+                counts.probes += 1
 
+                #alert the user
+                print("\n\n\nThe crafted packet was accepted. Checking \
+again...")
 
-            #if there is a response, try for another for redundancies
-            if response and TCP in response and response[TCP].flags == "SA":
+            elif verdict == PROBESPOOFED:
 
+                #alert the user
+                print("\n\n\nThe crafted packet was accepted again.")
+                print("Adding to potential spoofer list.")
 
 
-                #alert the user
-                print("\n\n\nThe crafted packet was accepted. Checking again...")
+
+                #add the ip to the potential spoofers list
+                sources.addSpoofer(ipsrc)
+
 
 
+            #check if the packet is a SYN packet
+            elif flags & (SYN | ACK) == SYN:
 
-                #craft another SYN/ACK packet with window size of 0
-                synackpac2 = IP(dst=ipsrc, src=ipdst)/TCP(dport=packet[TCP].sport, \
-                    sport=packet[TCP].dport, \
-                    flags="SA", \
-                    window=0)
+                counts.syns += 1
 
 
 
-                #send the second SYN/ACK packet to the incoming ip address
-                send(synackpac2, verbose=0)
+                #probe a source once per VERDICTTTL, within the budget
+                if sources.isDue(counts, now):
 
+                    budget.offer(ipsrc, \
+                                 (tcp.sport, ipdst, tcp.dport, tcp.seq), \
+                                 counts, \
+                                 now)
 
 
-                #wait for a second response
-                response2 = sr1(synackpac2, timeout=3)
 
+    dispatchProbes(now)
 
 
-                #check if there is a second response
-                if response2 and TCP in response2 and response2[TCP].flags == "SA":
 
+def dispatchProbes(now):
+    '''
+    This function sends the probes the budget allows right now.
+    '''
 
+    for address, syn, counts \
+    in budget.take(now, prober.maxprobes - len(prober)):
 
-                    #alert the user
-                    print("\n\n\nThe crafted packet was accepted again.")
-                    print("Adding to potential spoofer list.")
+        #let the user know
+        print("\n\n\nA SYN packet was detected from", address)
+        print(f"Testing response ({counts.syns} SYNs seen).")
 
+        counts.probed = now
 
 
-                    #add the ip to the potential spoofers list
-                    if ipsrc not in spoofers:
-                        spoofers.append(ipsrc)
 
+        if prober.probe(address, *syn, now):
 
+            counts.probes += 1
 
-        #add the incoming ip to the list
-        if ipsrc not in incomingips:
-            incomingips.append(ipsrc)
+        else:
+
+            budget.skip(counts, "busy")
+
+
+
+def watchHops(sock):
+    '''
+    This function checks the hop count of every IPv4 packet captured by a
+    scapy L2listen socket against the hop-count table, receiving the raw
+    frames without letting scapy dissect them. Nothing is sent.
+    '''
+
+    while True:
+
+        linktype, frame, now = sock.recv_raw(MAXFRAME)
+        offset = LINKOFFSETS.get(conf.l2types.layer2num.get(linktype))
+
+
+
+        if frame is None or offset is None:
+
+            continue
+
+
+
+        #skip the VLAN tags after the ethertype and check for IPv4
+        if offset >= ETHERLENGTH:
+
+            while frame[offset - 2 : offset] in VLANTYPES:
+
+                offset += 4
+
+
+
+            if frame[offset - 2 : offset] != IPV4TYPE:
+
+                continue
+
+
+
+        if len(frame) < offset + 20:
+
+            continue
+
+
+
+        versionihl, fragment, ttl, proto, src, dst \
+        = IPHEADER.unpack_from(frame, offset)
+
+
+
+        if versionihl >> 4 != 4:
+
+            continue
+
+
+
+        #learn from handshakes seen from their SYN, read the TCP header of
+        #first fragments only
+        flags = 0
+        learn = False
+        tcpoffset = offset + (versionihl & 0x0F) * 4
+
+
+
+        if proto == 6 and not fragment & 0x1FFF \
+        and len(frame) >= tcpoffset + 14:
+
+            sport, dport, seq, ack, flags \
+            = TCPHEADER.unpack_from(frame, tcpoffset)
+            learn = handshakes.isProven(src, \
+                                        sport, \
+                                        dst, \
+                                        dport, \
+                                        flags, \
+                                        seq, \
+                                        ack)
+
+
+
+        hopcount = HOPCOUNTS[ttl]
+        expected = hops.check(int.from_bytes(src[: 3], "big"), \
+                              hopcount, \
+                              learn)
+
+
+
+        if expected is None and flags & (SYN | ACK) != SYN:
+
+            continue
+
+
+
+        address = socket.inet_ntoa(src)
+        counts = sources.get(address)
+
+
+
+        if flags & (SYN | ACK) == SYN:
+
+            counts.syns += 1
+
+
+
+        if expected is None:
+
+            continue
+
+
+
+        counts.mismatches += 1
+
+
+
+        #alert the user once per source
+        if counts.verdict != HOPMISMATCH:
+
+            counts.verdict = HOPMISMATCH
+            sources.addSpoofer(address)
+
+            print(f"Hop count mismatch from {address}: TTL {ttl} is \
+{hopcount} hops, its /24 is {expected} hops away")
+
+
+
+#parse command line arguments
+parser = argparse.ArgumentParser(description="Check for potential IP \
+spoofing")
+parser.add_argument("--passive", action="store_true", \
+                    help="infer hop counts from the TTL and flag packets off \
+the hop count learned for their /24 instead of sending probes (default: off)")
+parser.add_argument("--hop-table", default=None, \
+                    help="file the learned hop-count table of --passive is \
+loaded from and saved to on exit (default: none)")
+parser.add_argument("--probe-rate", type=float, default=10, \
+                    help="probes sent per second at most, the sources with \
+the most SYNs go first (default: 10)")
+parser.add_argument("--max-prefix-probes", type=int, default=4, \
+                    help="probes sent to one /24 per minute at most \
+(default: 4)")
+parser.add_argument("--max-probes", type=int, default=1024, \
+                    help="probes waiting for their reply at most \
+(default: 1024)")
+args = parser.parse_args()
+
+
+
+#create the tables of the chosen mode
+sources = SourceTable(MAXSOURCES, MAXSPOOFERS, VERDICTTTL)
+prober = None
+budget = None
+hops = None
+handshakes = None
+
+
+
+if args.passive:
+
+    hops = HopTable()
+    handshakes = HandshakeTable(MAXHANDSHAKES)
+
+
+
+    if args.hop_table is not None and os.path.exists(args.hop_table):
+
+        try:
+
+            hops.load(args.hop_table)
+
+            print(f"Loaded the hop counts of {len(hops)} /24s from \
+{args.hop_table}")
+
+        #a short file (an older or interrupted save) starts an empty table
+        except (OSError, EOFError) as error:
+
+            print(f"Could not load {args.hop_table} ({error}), starting with \
+an empty hop-count table")
+
+
+
+else:
+
+    #the probes go out from their own raw socket
+    prober = ProbeEngine(PROBETIMEOUT, \
+                         PROBEROUNDS, \
+                         args.max_probes, \
+                         MAXBACKLOG)
+    budget = ProbeBudget(args.probe_rate, \
+                         args.probe_rate * PROBEBURST, \
+                         args.max_prefix_probes, \
+                         MAXCANDIDATES)
 
 
 
@@ -166,17 +1125,72 @@ time.sleep(5)
 
 print("\n\n\nChecking for potential IP spoofing...\n\n\n")
 
-#store=0 keeps the memory clear
-sniff(prn=processPacket, store=0)
 
 
-#print all src ips
+if args.passive:
+
+    sock = conf.L2listen(filter="ip")
+
+
+
+    try:
+
+        watchHops(sock)
+
+    except KeyboardInterrupt:
+
+        pass
+
+
+
+    if args.hop_table is not None:
+
+        hops.save(args.hop_table)
+
+
+
+else:
+
+    #store=0 keeps the memory clear
+    sniff(prn=processPacket, store=0)
+
+
+#print all src ips with their counters
 print("\n\n\nAll Source IPs:")
 print("---------------")
+print(f"{'address':<40} {'syns':>8} {'probes':>8} {'skipped':>8} \
+{'replies':>8} {'hops off':>8}  verdict")
+
+for address, counts in sources.sources.items():
+
+    print(f"{address:<40} {counts.syns:>8} {counts.probes:>8} \
+{counts.skipped:>8} {counts.replies:>8} {counts.mismatches:>8}  \
+{VERDICTNAMES[counts.verdict]}")
+
+
+
+if sources.evicted:
+
+    print(f"({sources.evicted} older sources evicted past {MAXSOURCES})")
+
+
+
+if prober is not None:
+
+    print(f"\nProbes: {prober.counters['sent']} sent, \
+{prober.counters['replies']} replies, {prober.counters['timedout']} timed \
+out, {sum(budget.counters.values())} skipped ({budget.counters['queue']} \
+with too many sources waiting, {budget.counters['expired']} waited too long, \
+{budget.counters['prefix']} over the /24 limit, {budget.counters['busy']} \
+already probed or too many outstanding)")
+
+
 
-for address in incomingips:
+if hops is not None:
 
-    print(address)
+    print(f"\nHop counts: {len(hops)} /24s learned, \
+{hops.counters['checked']} packets checked, {hops.counters['mismatched']} \
+off, {hops.counters['unknown']} from unknown /24s")
 
 
 
@@ -184,6 +1198,6 @@ for address in incomingips:
 print("\n\n\nPotentially Spoofed IPs:")
 print("------------------------")
 
-for address in spoofers:
+for address in sources.spoofers:
 
     print(address)
\ No newline at end of file
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# NAME: pf.py                                                                 #
+#                                                                             #
+# VERSION: 20230415                                                           #
+#                                                                             #
+# SYNOPSIS: Spread a sniffing detector over several processes                 #
+#                                                                             #
+# DESCRIPTION: This helper is imported by the sniffing detectors (dk.py,      #
+#              dc.py, db.py and st.py) for their --workers mode. It starts N  #
+#              worker processes that each open an AF_PACKET socket and join   #
+#              the same PACKET_FANOUT group. The kernel then hashes every     #
+#              packet on its flow (both directions of a connection hash the   #
+#              same) and hands it to exactly one of the sockets, so each      #
+#              worker runs the detector callback on its own share of the      #
+#              flows on its own core. The parent process prints the alerts of #
+#              all workers as one stream and merges their packet and alert    #
+#              counters.                                                      #
+#                                                                             #
+# INPUT: None                                                                 #
+#                                                                             #
+# OUTPUT: STDOUT                                                              #
+#                                                                             #
+# PRE-RUNTIME NOTES: This is not a standalone script. Worker processes are    #
+#                    forked, so the detector's setup at import time is        #
+#                    inherited by every worker.                               #
+#                                                                             #
+# AUTHORS: @southwickio                                                       #
+#                                                                             #
+# LICENSE: GPLv3                                                              #
+#                                                                             #
+# DISCLAIMER: All work produced by Authors is provided “AS IS”. Authors make  #
+#             no warranties, express or implied, and hereby disclaims any and #
+#             all warranties, including, but not limited to, any warranty of  #
+#             fitness, application, et cetera, for any particular purpose,    #
+#             use case, or application of this script.                        #
+#                                                                             #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+
+#import dependencies
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+import sys
+import threading
+import time
+
+
+
+#define constants from <linux/if_packet.h>
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+
+
+#define constants
+STATSINTERVAL = 5 #seconds between counter reports from a worker
+STOPTIMEOUT = 3 #seconds to wait for the final counters of the workers
+
+
+
+#declare variables
+packets = 0 #packets handled by this worker
+alerts = 0 #alert lines printed by this worker
+resultqueue = None #queue to the parent, set in a worker
+workerindex = None #number of this worker
+
+
+
+#define classes
+class QueueWriter:
+    '''
+    This class replaces sys.stdout in a worker process. Whatever the detector
+    prints is cut into lines and sent to the parent over the queue, so the
+    alerts of all workers come out as whole lines instead of interleaved
+    characters.
+    '''
+
+    def __init__(self, alertqueue, index):
+
+        self.alertqueue = alertqueue
+        self.index = index
+        self.buffer = ""
+
+
+
+    def write(self, text):
+
+        global alerts
+        self.buffer += text
+
+
+
+        while "\n" in self.buffer:
+
+            line, self.buffer = self.buffer.split("\n", 1)
+
+
+
+            if line.strip():
+
+                alerts += 1
+
+
+
+            self.alertqueue.put(("line", self.index, line))
+
+
+
+        return len(text)
+
+
+
+    def flush(self):
+
+        pass
+
+
+
+#define functions
+def joinFanout(sock, groupid):
+    '''
+    This function adds an AF_PACKET socket to the fanout group. The option
+    value holds the group id in the low 16 bits and the mode and flags in the
+    high 16 bits. PACKET_FANOUT_HASH picks the socket from the flow hash of
+    the packet; PACKET_FANOUT_FLAG_DEFRAG reassembles IP fragments first so
+    they hash like the rest of their flow. The value is packed by hand since
+    the defrag flag puts it past the range of a signed int.
+    '''
+
+    mode = PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG
+    value = struct.pack('I', (groupid & 0xFFFF) | mode << 16)
+
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, value)
+
+
+
+def countPackets(count=1):
+    '''
+    This function adds to the number of packets handled by this worker.
+    '''
+
+    global packets
+    packets += count
+
+
+
+def counted(callback):
+    '''
+    This function wraps a scapy prn callback so every packet it is called
+    with is counted.
+    '''
+
+    def countedCallback(pkt):
+
+        countPackets()
+
+
+
+        return callback(pkt)
+
+
+
+    return countedCallback
+
+
+
+def sendResult(result):
+    '''
+    This function sends a picklable result from a worker to the parent, which
+    passes it to the merge function given to runWorkers().
+    '''
+
+    resultqueue.put(("result", workerindex, result))
+
+
+
+def reportCounters(alertqueue, index):
+    '''
+    This function runs in a thread of each worker and sends its counters to
+    the parent every STATSINTERVAL seconds.
+    '''
+
+    while True:
+
+        time.sleep(STATSINTERVAL)
+
+        alertqueue.put(("stats", index, packets, alerts))
+
+
+
+def workerMain(alertqueue, index, groupid, target, args):
+    '''
+    This function is the entry point of a worker process. It routes STDOUT to
+    the parent and runs the detector until it is interrupted, then sends its
+    final counters.
+    '''
+
+    global resultqueue, workerindex
+    resultqueue = alertqueue
+    workerindex = index
+    sys.stdout = QueueWriter(alertqueue, index)
+    threading.Thread(target=reportCounters, \
+                     args=(alertqueue, index), \
+                     daemon=True).start()
+
+
+
+    try:
+
+        target(groupid, *args)
+
+    except KeyboardInterrupt:
+
+        pass
+
+
+
+    finally:
+
+        #a second ctrl+c from the parent, or one sent after the detector
+        #returned, must not cut the report short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+
+        #flush a last line printed without a newline
+        if sys.stdout.buffer:
+
+            sys.stdout.write("\n")
+
+
+
+        alertqueue.put(("done", index, packets, alerts))
+
+
+
+def handleMessage(message, counters, running, merge):
+    '''
+    This function prints an alert line from a worker, prefixed with the
+    worker number, merges a result it sent or records the counters it
+    reported.
+    '''
+
+    if message[0] == "line":
+
+        print(f"[{message[1]}] {message[2]}")
+
+    elif message[0] == "result":
+
+        if merge is not None:
+
+            merge(message[2])
+
+    else:
+
+        counters[message[1]] = message[2 :]
+
+
+
+    if message[0] == "done":
+
+        running.discard(message[1])
+
+
+
+def stopWorkers(processes, alertqueue, counters, running, merge):
+    '''
+    This function passes a ctrl+c on to the workers that are still running
+    and collects their final counters for up to STOPTIMEOUT seconds.
+    '''
+
+    for process in processes:
+
+        if process.is_alive():
+
+            os.kill(process.pid, signal.SIGINT)
+
+
+
+    deadline = time.time() + STOPTIMEOUT
+
+
+
+    while running and time.time() < deadline:
+
+        try:
+
+            message = alertqueue.get(timeout=deadline - time.time())
+
+        except (queue.Empty, ValueError):
+
+            break
+
+
+
+        handleMessage(message, counters, running, merge)
+
+
+
+def runWorkers(workers, target, args=(), merge=None, duration=None):
+    '''
+    This function forks the worker processes and merges what they report
+    until ctrl+c, or for duration seconds if given. target(groupid, *args)
+    is called in every worker; it opens its capture socket(s), calls
+    joinFanout() with the group id and runs the detector, calling
+    countPackets() or using counted() as it goes. Results a worker sends
+    with sendResult() are passed to merge(result) in the parent. Prints the
+    packets per second of every worker and returns the total.
+    '''
+
+    context = multiprocessing.get_context("fork")
+    alertqueue = context.Queue()
+    groupid = os.getpid() & 0xFFFF
+    counters = {index: (0, 0) for index in range(workers)}
+    running = set(range(workers))
+    processes = []
+
+
+
+    for index in range(workers):
+
+        process = context.Process(target=workerMain, \
+                                  args=(alertqueue, \
+                                        index, \
+                                        groupid, \
+                                        target, \
+                                        args))
+        process.start()
+        processes.append(process)
+
+
+
+    print(f"\n\n\nStarted {workers} workers in fanout group {groupid}.\n\n\n")
+    start = time.time()
+    deadline = None if duration is None else start + duration
+    handler = signal.getsignal(signal.SIGINT)
+
+
+
+    #merge the alert streams and counters
+    try:
+
+        while running:
+
+            timeout = None if deadline is None else deadline - time.time()
+
+
+
+            if timeout is not None and timeout <= 0:
+
+                break
+
+
+
+            try:
+
+                message = alertqueue.get(timeout=timeout)
+
+            except queue.Empty:
+
+                break
+
+
+
+            handleMessage(message, counters, running, merge)
+
+
+
+    except KeyboardInterrupt:
+
+        pass
+
+
+
+    #a second ctrl+c must not cut the final counters short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    elapsed = max(time.time() - start, 1e-9)
+    stopWorkers(processes, alertqueue, counters, running, merge)
+
+
+
+    for process in processes:
+
+        process.join(timeout=1)
+
+
+
+        if process.is_alive():
+
+            process.terminate()
+
+
+
+    #print the merged counters
+    totalpackets = sum(count[0] for count in counters.values())
+    totalalerts = sum(count[1] for count in counters.values())
+
+    print("\n\n\nWorker counters:")
+    print("----------------")
+
+
+
+    for index, (workerpackets, workeralerts) in sorted(counters.items()):
+
+        rate = workerpackets / elapsed
+
+        print(f"worker {index}: {workerpackets} packets ({rate:.0f} \
+packets/s), {workeralerts} alert lines")
+
+
+
+    print(f"total: {totalpackets} packets ({totalpackets / elapsed:.0f} \
+packets/s), {totalalerts} alert lines")
+
+    signal.signal(signal.SIGINT, handler)
+
+
+
+    return totalpackets / elapsed
@@ -11,9 +11,10 @@
 #                                                                             #
 # DESCRIPTION: This script looks for over a dozen different indicators of     #
 #              potential HTTP tunelling by running a function on each packet. #
-#              The analyzePacket function checks for the following indicators #
-#              and HTTP protocol violations around ports 80 and 443 that      #
-#              could indicate HTTP tunneling.                                 #
+#              The analyzePacket function reassembles the TCP streams around  #
+#              ports 80 and 443 into HTTP messages, and analyzeMessage checks #
+#              each message once for the following indicators and HTTP        #
+#              protocol violations that could indicate HTTP tunneling.        #
 #                                                                             #
 #              Indicators:                                                    #
 #              1.) Unusual HTTP traffic patterns such as repeated connections #
@@ -24,6 +25,7 @@
 #              4.) Use of unusual or non-standard HTTP methods such as        #
 #                  CONNECT                                                    #
 #              5.) Use of HTTP compression to hide the data being transmitted #
+#                  or a text body that is as random as encrypted data         #
 #              6.) Unexpected user agents                                     #
 #              7.) HTTP traffic over non-HTTP protocols such as ICMP or DNS   #
 #              8.) Unusual traffic from known good sources such as traffic    #
@@ -40,16 +42,21 @@
 #                  for a request that was successful                          #
 #             16.) Invalid or unsupported HTTP cookies                        #
 #                                                                             #
-# INPUT: None                                                                 #
+# INPUT: Optional command line arguments (see ./st.py --help)                 #
 #                                                                             #
 # OUTPUT: STDOUT                                                              #
 #                                                                             #
-# PRE-RUNTIME NOTES: 1.) packet[Raw] is a layer in the Scapy packet capture   #
-#                        library that represents the raw data payload of a    #
-#                        packet. In the context of HTTP traffic, the Raw      #
-#                        layer contains the HTTP request or response body as  #
-#                        a string of bytes.                                   #
+# PRE-RUNTIME NOTES: 1.) A request or response can span several TCP           #
+#                        segments, so the payloads are put back together per  #
+#                        connection and direction first. Streams silent for   #
+#                        --stream-timeout seconds are dropped and at most     #
+#                        --max-streams are kept.                              #
 #                    2.) I used regex101.com as a source for regex checking   #
+#                    3.) TLS streams are not decrypted. Their ClientHello is  #
+#                        parsed once for the SNI, the ALPN and a JA3          #
+#                        fingerprint (see --ja3) and the rest is skipped.     #
+#                    4.) Only TCP segments are captured, so indicator 7 is    #
+#                        not checked here. Use dc.py for ICMP tunneling.      #
 #                                                                             #
 # AUTHORS: @southwickio                                                       #
 #                                                                             #
@@ -66,50 +73,1987 @@
 
 
 #import dependencies
+from array import array
+import argparse
+import collections
+import hashlib
+import heapq
+import itertools
+import math
+import random
+import zlib
+import sys
 import re
+import socket
+import struct
 from scapy.all import *
-from scapy.layers.http import HTTPRequest, HTTPResponse
+from scapy.layers.http import HTTP, HTTPRequest, HTTPResponse
 import time
 
+import pf #./pf.py, worker pool for --workers
+
+
+
+#import optional dependencies
+try:
+
+    import numpy #pip3 install numpy, only needed for beaconing detection
+
+except ImportError:
+
+    numpy = None
+
+
+
+#declare constants
+MAXSTREAMS = 65536 #TCP streams reassembled at the same time
+STREAMTIMEOUT = 120 #seconds of silence before a stream is dropped
+MAXHEADER = 65536 #bytes of start line and headers buffered per stream
+BODYSAMPLE = 65536 #bytes at the start of a body sampled for entropy
+STREAMSAMPLE = 1048576 #bytes of all bodies of a stream sampled for entropy
+BODYMIN = 256 #bytes a body sample needs before its entropy is checked
+BODYENTROPY = 7.0 #bits per byte above which a body looks encrypted
+BODYRATIO = 0.9 #compressed / sampled size above which a body looks encrypted
+ENCODEDSHARE = 0.95 #share of base64/hex bytes above which a body is encoded
+BASE64ENTROPY = 5.5 #bits per byte above which base64 text hides random data
+                    #(6 at most)
+HEXENTROPY = 3.8 #bits per byte above which hex text hides random data (4 at
+                 #most)
+BASE64BYTES = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz\
+0123456789+/-_=\r\n") #the standard and URL-safe alphabets and line breaks
+HEXBYTES = frozenset(b"0123456789abcdefABCDEF\r\n")
+MAXPENDING = 262144 #out of order bytes held per stream
+MAXSEGMENTS = 4096 #out of order segments held per stream
+SEQMOD = 1 << 32 #TCP sequence numbers wrap around at 2^32
+FIN = 0x01 #TCP flags
+SYN = 0x02
+RST = 0x04
+ACK = 0x10
+HEAD = 0 #framing states of a stream: reading the start line and headers,
+BODY = 1 #a body of known length,
+CHUNKSIZE = 2 #a chunk size line or the line ending a chunk,
+CHUNKDATA = 3 #the data of a chunk,
+TRAILER = 4 #the trailer of a chunked body,
+UNTILCLOSE = 5 #a body that ends with the connection,
+HANDSHAKE = 6 #the first TLS record of a TLS stream,
+ENCRYPTED = 7 #the rest of a TLS stream, which is skipped,
+TUNNEL = 8 #or the opaque bytes of a CONNECT tunnel or upgraded connection
+MAXINFLIGHT = 64 #request methods kept per connection for framing responses
+MAXHELLO = 16389 #bytes of the first TLS record buffered (one full record)
+MAXCONNKEYS = 65536 #(src, dst, dport) whose connection attempts are counted
+CONNWINDOW = 60 #seconds connection attempts are counted over
+CONNBUCKETS = 12 #sub-windows the connection window moves by
+MAXBEACONKEYS = 32768 #(src, dst, host) whose request times are kept
+BEACONSAMPLES = 32 #request times kept per (src, dst, host)
+BEACONMIN = 8 #requests a key needs before it is scored for beaconing
+BEACONMININTERVAL = 1 #seconds, faster requests are a page load not a beacon
+BEACONJITTER = 0.1 #stddev / mean of the intervals below which a key beacons
+BEACONPEAK = 0.7 #spectral peak (1 = all requests in phase) above which a
+                 #key with BEACONSAMPLES requests beacons
+BEACONBINS = 512 #bins the request train of a key is spread over for the FFT
+BEACONMINCYCLES = 4 #slowest frequency looked at, in cycles over the train
+BEACONMAXCYCLES = 2 * BEACONSAMPLES #fastest, a beacon skipping half its
+                                    #requests
+BEACONCHUNK = 2048 #keys scored per call, to bound its time and memory
+HLLPRECISION = 10 #bits of a hash that pick a HyperLogLog register
+HLLREGISTERS = 1 << HLLPRECISION #registers (bytes) per HyperLogLog sketch
+HLLALPHA = 0.7213 / (1 + 1.079 / HLLREGISTERS) #bias correction
+HLLPOWERS = [2.0 ** -rank for rank in range(65)] #2^-register
+MAXCARDINALITYHOSTS = 4096 #hosts whose distinct paths, cookies and user
+                           #agents are counted
+CARDINALITYINTERVAL = 60 #seconds between growth checks of a host
+CARDINALITYNAMES = ["paths", "cookies", "user agents"]
+BENCHMARKROUNDS = 20 #times --benchmark goes over the capture
+BENCHMARKKEYS = 20000 #keys of random requests --benchmark scores for beacons
+MAXFRAME = 65535 #bytes read per captured frame
+ETHERLENGTH = 14 #bytes of an ethernet header
+LINKOFFSETS = {1: ETHERLENGTH, 113: 16, 228: 0} #DLT: link header length
+VLANTYPES = (b"\x81\x00", b"\x88\xa8") #802.1Q and 802.1ad ethertypes
+IPV4TYPE = b"\x08\x00"
+
+#IPv4 version/ihl, length, fragment offset, protocol, src and dst
+IPHEADER = struct.Struct("!B1xH2xH1xB2x4s4s")
+
+#TCP ports, seq, data offset and flags
+TCPHEADER = struct.Struct("!HHI4xBB")
+
+#match the first line of an HTTP response or request message
+STARTLINEPATTERN = re.compile(rb"HTTP/(\d\.\d) (\d{3}) (.*)|"
+                              rb"([A-Z]+) (/\S*) HTTP/(\d\.\d)")
+
+#match the headers the checks read, all in one pass over the head
+HEADERPATTERN = re.compile(rb"^(host|user-agent|cookie|content-encoding|"
+                           rb"content-type|content-length|transfer-encoding)"
+                           rb"[ \t]*:[ \t]*([^\r\n]*?)[ \t]*\r?$", \
+                           re.IGNORECASE | re.MULTILINE)
+HEADERSLOTS = {b"host": "host", \
+               b"user-agent": "useragent", \
+               b"cookie": "cookie", \
+               b"content-encoding": "encoding", \
+               b"content-type": "contenttype", \
+               b"content-length": "contentlength", \
+               b"transfer-encoding": "transferencoding"}
+
+#match a URL
+URLPATTERN = re.compile(rb"[a-zA-Z0-9\-\._~:/\?#\[\]@!\$&'\(\)\*\+,;=]*")
+
+#match a string that represents an HTTP cookie
+COOKIEPATTERN = re.compile(rb"[a-zA-Z0-9\-\._~:\+%/]*=\S*")
+
+#match the content types that should carry text
+TEXTPATTERN = re.compile(rb"text/|application/(json|xml|javascript|"
+                         rb"x-www-form-urlencoded)|\+json|\+xml", \
+                         re.IGNORECASE)
+
+METHODS = frozenset([b"GET", \
+                     b"HEAD", \
+                     b"POST", \
+                     b"PUT", \
+                     b"DELETE", \
+                     b"CONNECT", \
+                     b"OPTIONS", \
+                     b"TRACE"])
+
+
+
+#create classes
+class HttpHead:
+    '''
+    The start line and the headers the checks read, parsed once from the
+    bytes of a message head: one match of STARTLINEPATTERN and one pass of
+    HEADERPATTERN, which picks out all the headers at once. Values are the
+    raw bytes; a header that is not there is None. valid is False when the
+    start line is not a well formed request or response line, in which case
+    method, path and status are its space separated fields.
+    '''
+
+    __slots__ = ('startline', 'isrequest', 'isresponse', 'valid', 'method', \
+                 'path', 'version', 'status', 'host', 'useragent', 'cookie', \
+                 'encoding', 'contenttype', 'contentlength', \
+                 'transferencoding')
+
+
+
+    def __init__(self, head):
+
+        end = head.find(b"\r\n")
+        self.startline = head[: end] if end >= 0 else head
+        self.method = self.path = self.version = self.status = b""
+        self.host = self.useragent = self.cookie = self.encoding = None
+        self.contenttype = self.contentlength = self.transferencoding = None
+
+
+
+        #parse the start line
+        fields = self.startline.split(b" ")
+        match = STARTLINEPATTERN.fullmatch(self.startline)
+        self.valid = match is not None
+        self.isresponse = self.startline.startswith(b"HTTP/")
+        self.isrequest = not self.isresponse and len(fields) == 3 \
+                         and fields[2].startswith(b"HTTP/")
+
+
+
+        if match and self.isresponse:
+
+            self.version, self.status = match.group(1, 2)
+
+        elif match:
+
+            self.method, self.path, self.version = match.group(4, 5, 6)
+
+        elif self.isresponse:
+
+            self.status = fields[1] if len(fields) > 1 else b""
+
+        else:
+
+            self.method = fields[0]
+            self.path = fields[1] if len(fields) > 1 else b""
+
+
+
+        #parse the headers
+        for name, value in HEADERPATTERN.findall(head):
+
+            setattr(self, HEADERSLOTS[name.lower()], value)
+
+
+
+    def hasBody(self):
+        '''
+        Returns whether a body follows the head: chunked, of Content-Length
+        bytes or, for a response without a length, until the connection
+        closes. 1xx, 204 and 304 responses never have one.
+        '''
+
+        if self.isresponse and (self.status[: 1] == b"1" \
+                                or self.status in (b"204", b"304")):
+
+            return False
+
+
+
+        if self.isChunked():
+
+            return True
+
+
+
+        if self.contentlength is not None:
+
+            return self.contentlength.isdigit() and int(self.contentlength) > 0
+
+
+
+        return self.isresponse
+
+
+
+    def isChunked(self):
+
+        return self.transferencoding is not None \
+        and b"chunked" in self.transferencoding.lower()
+
+
+
+class BodySample:
+    '''
+    Byte statistics of the start of a message body, gathered as the body
+    arrives: a histogram of the bytes for their Shannon entropy and a zlib
+    stream for how well they compress. Only the bytes the stream hands to
+    add() are looked at (see BODYSAMPLE and STREAMSAMPLE); the compressor
+    uses a small window so a message in progress costs a few KB.
+    '''
+
+    '''
+    Encrypted data sent as base64 or hex text has at most 6 or 4 bits of
+    entropy per byte and compresses to about 3/4 or 1/2 of its size, so it
+    stays under BODYENTROPY and BODYRATIO. encoding() looks for it
+    separately: nearly all bytes in one of the alphabets and an entropy
+    close to the most that alphabet allows, which ordinary text (words,
+    identifiers, numbers) doesn't reach.
+    '''
+
+    __slots__ = ('histogram', 'compressor', 'sampled', 'compressed')
+
+
+
+    def __init__(self):
+
+        self.histogram = collections.Counter()
+        self.compressor = None
+        self.sampled = 0
+        self.compressed = 0
+
+
+
+    def add(self, data):
+
+        if self.compressor is None:
+
+            self.compressor = zlib.compressobj(1, zlib.DEFLATED, 10, 1)
+
+
+
+        self.histogram.update(data)
+        self.compressed += len(self.compressor.compress(data))
+        self.sampled += len(data)
+
+
+
+    def finish(self):
+        '''
+        Flushes and frees the compressor once the body is complete.
+        '''
+
+        if self.compressor is not None:
+
+            self.compressed += len(self.compressor.flush())
+            self.compressor = None
+
+
+
+    def entropy(self):
+
+        return -sum(count / self.sampled * math.log2(count / self.sampled) \
+                    for count in self.histogram.values())
+
+
+
+    def ratio(self):
+        '''
+        Returns the compressed size of the sample over its size, around 1 or
+        above for data that is already compressed or encrypted.
+        '''
+
+        self.finish()
+
+        return self.compressed / max(self.sampled, 1)
+
+
+
+    def encoding(self):
+        '''
+        Returns "hex" or "base64" if the sample reads like random data in that
+        encoding, otherwise None.
+        '''
+
+        entropy = self.entropy()
+
+
+
+        for name, alphabet, threshold in (("hex", HEXBYTES, HEXENTROPY), \
+                                          ("base64", BASE64BYTES, \
+                                           BASE64ENTROPY)):
+
+            share = sum(count for byte, count in self.histogram.items() \
+                        if byte in alphabet) / self.sampled
+
+
+
+            if share >= ENCODEDSHARE and entropy >= threshold:
+
+                return name
+
+
+
+        return None
+
+
+
+class HttpMessage:
+    '''
+    One HTTP request or response cut out of a TCP stream: the addresses it
+    was sent between, its start line and headers (as bytes and parsed into
+    an HttpHead), a BodySample of its body (de-chunked) and its full
+    length on the wire. complete is False for a message cut short by the end
+    of its stream, a gap in the stream or a header section larger than
+    MAXHEADER.
+    '''
+
+    __slots__ = ('srcip', 'srcport', 'dstip', 'dstport', 'head', 'http', \
+                 'body', 'length', 'complete')
+
+
+
+    def __init__(self, key, head):
+
+        self.srcip, self.srcport, self.dstip, self.dstport = key
+        self.head = head
+        self.http = HttpHead(head)
+        self.body = BodySample()
+        self.length = len(head)
+        self.complete = False
+
+
+
+class ClientHello:
+    '''
+    The fields of a TLS ClientHello that identify the client: the addresses
+    it was sent between, the SNI host name and ALPN protocols (None if not
+    offered), and the version, cipher suites, extensions, supported groups
+    and point formats it offered, in order and without GREASE values. ja3
+    is the JA3 string of those five fields and ja3hash its MD5.
+    '''
+
+    __slots__ = ('srcip', 'srcport', 'dstip', 'dstport', 'sni', 'alpn', \
+                 'version', 'ciphers', 'extensions', 'groups', \
+                 'pointformats', 'ja3', 'ja3hash')
+
+
+
+    def __init__(self, key, handshake):
+        '''
+        Parses the ClientHello handshake message (type, length and body).
+        Raises IndexError or ValueError if it is cut short or malformed.
+        '''
+
+        self.srcip, self.srcport, self.dstip, self.dstport = key
+        self.sni = self.alpn = None
+        self.groups = []
+        self.pointformats = []
+        self.extensions = []
+        length = int.from_bytes(handshake[1 : 4], "big")
+        body = memoryview(handshake)[4 : 4 + length]
+
+
+
+        #client version, random, session id, cipher suites and compression
+        self.version = int.from_bytes(body[0 : 2], "big")
+        offset = 34 + 1 + body[34]
+        length = int.from_bytes(body[offset : offset + 2], "big")
+        self.ciphers = ungrease(body[offset + 2 : offset + 2 + length])
+        offset += 2 + length
+        offset += 1 + body[offset]
+
+
+
+        #extensions: type, length, data
+        end = offset + 2 + int.from_bytes(body[offset : offset + 2], "big")
+        offset += 2
+
+
+
+        if end > len(body):
+
+            raise ValueError("extensions past the end of the ClientHello")
+
+
+
+        while offset + 4 <= end:
+
+            extension = int.from_bytes(body[offset : offset + 2], "big")
+            length = int.from_bytes(body[offset + 2 : offset + 4], "big")
+            data = body[offset + 4 : offset + 4 + length]
+            offset += 4 + length
+
+
+
+            if not isGrease(extension):
+
+                self.extensions.append(extension)
+
+
+
+            #server_name: list length, name type, name length, name
+            if extension == 0 and len(data) > 5:
+
+                self.sni = bytes(data[5 : 5 + int.from_bytes(data[3 : 5], \
+                                                              "big")])
+
+            #application_layer_protocol_negotiation: list of length, name
+            elif extension == 16 and len(data) > 2:
+
+                self.alpn = []
+                position = 2
+
+
+
+                while position < len(data):
+
+                    self.alpn.append(bytes(data[position + 1 : position + 1 \
+                                                + data[position]]))
+                    position += 1 + data[position]
+
+            #supported_groups (elliptic curves)
+            elif extension == 10 and len(data) > 2:
+
+                self.groups = ungrease(data[2 :])
+
+            #ec_point_formats
+            elif extension == 11 and len(data) > 1:
+
+                self.pointformats = list(data[1 : 1 + data[0]])
+
+
+
+        self.ja3 = ",".join([str(self.version)] \
+                            + ["-".join(map(str, values)) \
+                               for values in [self.ciphers, \
+                                              self.extensions, \
+                                              self.groups, \
+                                              self.pointformats]])
+        self.ja3hash = hashlib.md5(self.ja3.encode()).hexdigest()
+
+
+
+class Exchange:
+    '''
+    What the two Streams of a connection share: the methods of the requests
+    still waiting for their response, oldest first, and whether the
+    connection became a tunnel (a 2xx response to CONNECT or a 101
+    response) whose bytes are no longer HTTP.
+    '''
+
+    __slots__ = ('methods', 'tunnel')
+
+
+
+    def __init__(self):
+
+        self.methods = collections.deque(maxlen=MAXINFLIGHT)
+        self.tunnel = False
+
+
+
+class Stream:
+    '''
+    Reassembly state of one direction of a TCP connection. The bytes up to
+    nextseq have been passed on to the HTTP framing; segments past it wait
+    in pending, keyed by their position in the stream (nextseq without the
+    wrap around, counted from the first byte seen), until the gap before
+    them is filled. The positions are also kept in a heap so the segment
+    closest to nextseq is found without scanning the rest. If more than
+    MAXPENDING bytes or MAXSEGMENTS segments wait, the gap is given up on
+    and the message it fell in is passed on as incomplete.
+    '''
+
+    '''
+    The framing cuts the byte stream into messages: the start line and
+    headers end at the first empty line, and the body that follows is
+    Content-Length bytes long, chunked, absent (requests without a length,
+    1xx/204/304 responses and responses to HEAD) or runs until the
+    connection closes (other responses without a length). A response is
+    framed by the method of the request it answers, taken from the Exchange
+    the stream shares with the opposite direction.
+    '''
+
+    '''
+    A TLS record header where a message should start (the start of a
+    stream on port 443, after a CONNECT or where a stream was picked up)
+    switches the stream to TLS for good. If it is a handshake record, it is
+    buffered and, if it is a ClientHello, parsed once into a ClientHello
+    passed on with the messages; the encrypted rest of the stream is
+    skipped without being looked at.
+    '''
+
+    __slots__ = ('key', 'nextseq', 'position', 'pending', 'starts', \
+                 'pendingbytes', 'buffer', 'state', 'remaining', 'message', \
+                 'sampled', 'exchange', 'lastseen')
+
+
+
+    def __init__(self, key, seq, now, exchange):
+
+        self.key = key
+        self.nextseq = seq
+        self.position = 0 #bytes passed on or skipped, nextseq unwrapped
+        self.pending = {} #position: payload
+        self.starts = [] #heap of the positions in pending
+        self.pendingbytes = 0
+        self.buffer = bytearray()
+        self.state = HEAD
+        self.remaining = 0
+        self.message = None
+        self.sampled = 0 #bytes of bodies sampled
+        self.exchange = exchange
+        self.lastseen = now
+
+
+
+    def add(self, seq, payload, messages):
+        '''
+        Adds a segment and appends the messages it completed to messages.
+        '''
+
+        #how far nextseq is past the start of the segment, mod 2^32
+        offset = (self.nextseq - seq) % SEQMOD
+
+
+
+        #a segment ahead of nextseq waits for the gap to be filled
+        if offset >= SEQMOD // 2:
+
+            start = self.position + SEQMOD - offset
+
+
+
+            if start not in self.pending:
+
+                self.pending[start] = payload
+                self.pendingbytes += len(payload)
+                heapq.heappush(self.starts, start)
+
+
+
+            if self.pendingbytes > MAXPENDING or \
+               len(self.pending) > MAXSEGMENTS:
+
+                self.skipGap(messages)
+
+
+
+            return
+
+
+
+        #skip what was seen before (retransmissions and overlaps)
+        if offset < len(payload):
+
+            self.feed(payload[offset :], messages)
+            self.drain(messages)
+
+
+
+    def drain(self, messages):
+
+        #the closest segment is the only one that can fill the gap
+        while self.starts and self.starts[0] <= self.position:
+
+            start = heapq.heappop(self.starts)
+            payload = self.pending.pop(start)
+            self.pendingbytes -= len(payload)
+            offset = self.position - start
+
+
+
+            if offset < len(payload):
+
+                self.feed(payload[offset :], messages)
+
+
+
+    def skipGap(self, messages):
+
+        self.flush(messages)
+        gap = self.starts[0] - self.position
+        self.nextseq = (self.nextseq + gap) % SEQMOD
+        self.position += gap
+        self.drain(messages)
+
+
+
+    def feed(self, data, messages):
+
+        self.nextseq = (self.nextseq + len(data)) % SEQMOD
+        self.position += len(data)
+
+
+
+        while data:
+
+            if self.state == HEAD:
+
+                #skip the empty lines allowed between messages
+                if not self.buffer:
+
+                    data = data.lstrip(b"\r\n")
+
+
+
+                    if not data:
+
+                        continue
+
+
+
+                    #a TLS record header: change_cipher_spec, alert,
+                    #handshake or application_data, version 3.0-3.4; only
+                    #a handshake can be parsed, a stream picked up later on
+                    #is skipped
+                    if len(data) > 2 and 0x14 <= data[0] <= 0x17 \
+                    and data[1] == 3 and data[2] <= 4:
+
+                        self.state = HANDSHAKE if data[0] == 0x16 \
+                                     else ENCRYPTED
+
+                        continue
+
+
+
+                    if self.exchange.tunnel:
+
+                        self.state = TUNNEL
+
+                        continue
+
+
+
+                #the empty line may have started in the previous segment
+                start = max(len(self.buffer) - 3, 0)
+                self.buffer += data
+                data = b""
+                end = self.buffer.find(b"\r\n\r\n", start)
+
+
+
+                if end >= 0:
+
+                    data = bytes(self.buffer[end + 4 :])
+                    self.startMessage(bytes(self.buffer[: end + 4]), messages)
+                    self.buffer.clear()
+
+                elif len(self.buffer) > MAXHEADER:
+
+                    self.flush(messages)
+
+
+
+            elif self.state in (ENCRYPTED, TUNNEL):
+
+                data = b""
+
+            elif self.state == HANDSHAKE:
+
+                self.buffer += data
+                data = b""
+                self.readHandshake(messages)
+
+            elif self.state in (BODY, CHUNKDATA, UNTILCLOSE):
+
+                take = len(data)
+
+
+
+                if self.state != UNTILCLOSE:
+
+                    take = min(self.remaining, take)
+                    self.remaining -= take
+
+
+
+                #sample the start of the body, within the stream's budget
+                message = self.message
+                room = min(take, \
+                           BODYSAMPLE - message.body.sampled, \
+                           STREAMSAMPLE - self.sampled)
+
+
+
+                if room > 0:
+
+                    message.body.add(data[: room])
+                    self.sampled += room
+
+
+
+                message.length += take
+                data = data[take :]
+
+
+
+                if self.state == BODY and not self.remaining:
+
+                    self.finishMessage(messages)
+
+                elif self.state == CHUNKDATA and not self.remaining:
+
+                    self.state = CHUNKSIZE
+
+
+
+            else:
+
+                #chunk size and trailer lines
+                self.buffer += data
+                data = b""
+                end = self.buffer.find(b"\r\n")
+
+
+
+                if end < 0:
+
+                    if len(self.buffer) > MAXHEADER:
+
+                        self.flush(messages)
+
+
+
+                    continue
+
+
+
+                line = bytes(self.buffer[: end])
+                data = bytes(self.buffer[end + 2 :])
+                self.buffer.clear()
+                self.message.length += end + 2
+
+
+
+                if self.state == TRAILER:
+
+                    if not line:
+
+                        self.finishMessage(messages)
+
+
+
+                    continue
+
+
+
+                #the empty line after the data of a chunk
+                if not line:
+
+                    continue
+
+
+
+                try:
+
+                    size = int(line.split(b";")[0], 16)
+
+                except ValueError:
+
+                    self.flush(messages)
+
+                    continue
+
+
+
+                self.state = CHUNKDATA if size else TRAILER
+                self.remaining = size
+
+
+
+    def readHandshake(self, messages):
+
+        #record header: type, version, length
+        if len(self.buffer) < 5 \
+        or len(self.buffer) < 5 + int.from_bytes(self.buffer[3 : 5], "big"):
+
+            if len(self.buffer) > MAXHELLO:
+
+                self.state = ENCRYPTED
+                self.buffer.clear()
+
+
+
+            return
+
+
+
+        record = bytes(self.buffer[5 : 5 + int.from_bytes(self.buffer[3 : 5], \
+                                                          "big")])
+        self.state = ENCRYPTED
+        self.buffer.clear()
+
+
+
+        #1 = ClientHello
+        if record[: 1] == b"\x01":
+
+            try:
+
+                messages.append(ClientHello(self.key, record))
+
+            except (IndexError, ValueError):
+
+                pass
+
+
+
+    def startMessage(self, head, messages):
+
+        self.message = HttpMessage(self.key, head)
+        http = self.message.http
+        method = None
+
+
+
+        #pair a response with its request, 1xx but 101 are interim
+        if http.isrequest:
+
+            self.exchange.methods.append(http.method)
+
+        elif http.isresponse and self.exchange.methods \
+        and (http.status[: 1] != b"1" or http.status == b"101"):
+
+            method = self.exchange.methods.popleft()
+
+
+
+        #the connection carries something else after a 2xx to CONNECT or
+        #a 101
+        if http.status == b"101" \
+        or (method == b"CONNECT" and http.status[: 1] == b"2"):
+
+            self.exchange.tunnel = True
+            self.finishMessage(messages)
+            self.state = TUNNEL
+
+        elif method == b"HEAD" or not http.hasBody():
+
+            self.finishMessage(messages)
+
+        elif http.isChunked():
+
+            self.state = CHUNKSIZE
+
+        elif http.contentlength is not None:
+
+            self.state = BODY
+            self.remaining = int(http.contentlength)
+
+        else:
+
+            self.state = UNTILCLOSE
+
+
+
+    def finishMessage(self, messages, complete=True):
+
+        self.message.complete = complete
+        self.message.body.finish()
+        messages.append(self.message)
+        self.message = None
+        self.state = HEAD
+        self.remaining = 0
+
+
+
+    def flush(self, messages):
+        '''
+        Passes on the message in progress as it is and starts over at the
+        next start line. Only a body running until the connection closes is
+        complete at this point.
+        '''
+
+        if self.state in (HANDSHAKE, ENCRYPTED):
+
+            self.state = ENCRYPTED
+
+        elif self.state == TUNNEL:
+
+            pass
+
+        elif self.message is not None:
+
+            self.finishMessage(messages, self.state == UNTILCLOSE)
+
+        elif self.buffer:
+
+            self.message = HttpMessage(self.key, bytes(self.buffer))
+            self.finishMessage(messages, False)
+
+
+
+        self.buffer.clear()
+
+
+
+class StreamTable:
+    '''
+    This class maps (srcip, srcport, dstip, dstport) to the Stream of that
+    direction of a connection and reassembles the HTTP messages sent over
+    it. A SYN starts a stream over; a stream first seen with data is picked
+    up where it is. FIN and RST end a stream and pass on the message in
+    progress.
+    '''
+
+    '''
+    The OrderedDict keeps the streams in least to most recently seen order,
+    so the streams idle for longer than idletimeout are expired from the
+    front as packets come in and, past maxstreams, the least recently seen
+    one is evicted. Either way its message in progress is passed on.
+    '''
+
+    def __init__(self, maxstreams, idletimeout):
+
+        self.streams = collections.OrderedDict()
+        self.maxstreams = maxstreams
+        self.idletimeout = idletimeout
+        self.counters = collections.Counter()
+
+
+
+    def add(self, key, seq, flags, payload, now):
+        '''
+        Adds a TCP segment to its stream and returns the list of messages it
+        completed.
+        '''
+
+        messages = []
+        self.expire(now, messages)
+        stream = self.streams.get(key)
+
+
+
+        if flags & SYN:
+
+            if stream is not None:
+
+                stream.flush(messages)
+
+
+
+            stream = Stream(key, \
+                            (seq + 1) % SEQMOD, \
+                            now, \
+                            self.exchange(key, not flags & ACK))
+            self.insert(key, stream, messages)
+
+        elif stream is None:
+
+            if not payload:
+
+                return messages
+
+
+
+            stream = Stream(key, seq, now, self.exchange(key, False))
+            self.insert(key, stream, messages)
+
+        else:
+
+            stream.lastseen = now
+            self.streams.move_to_end(key)
+
+
+
+        if payload and not flags & SYN:
+
+            stream.add(seq, payload, messages)
+
+
+
+        if flags & (FIN | RST):
+
+            stream.flush(messages)
+            del self.streams[key]
+            self.counters["closed"] += 1
+
+
+
+        return messages
+
+
+
+    def exchange(self, key, new):
+        '''
+        Returns the Exchange of the opposite direction of the connection, or
+        a new one if there is none or a new connection starts (a SYN).
+        '''
+
+        reverse = self.streams.get((key[2], key[3], key[0], key[1]))
+
+
+
+        if new or reverse is None:
+
+            return Exchange()
+
+
+
+        return reverse.exchange
+
+
+
+    def insert(self, key, stream, messages):
+
+        self.streams[key] = stream
+        self.streams.move_to_end(key)
+        self.counters["streams"] += 1
+
+
+
+        if len(self.streams) > self.maxstreams:
+
+            self.streams.popitem(last=False)[1].flush(messages)
+            self.counters["evicted"] += 1
+
+
+
+    def expire(self, now, messages):
+
+        while self.streams:
+
+            stream = next(iter(self.streams.values()))
+
+
+
+            if now - stream.lastseen < self.idletimeout:
+
+                break
+
+
+
+            self.streams.popitem(last=False)
+            stream.flush(messages)
+            self.counters["expired"] += 1
+
+
+
+class ConnectionCount:
+    '''
+    The SYNs sent to one (src, dst, dport) over the last CONNWINDOW seconds,
+    in CONNBUCKETS counters of CONNWINDOW / CONNBUCKETS seconds each and
+    their running total. alerted is set once the total reaches the limit
+    and cleared when it falls below it again.
+    '''
+
+    __slots__ = ('tick', 'counts', 'total', 'alerted')
+
+
+
+    def __init__(self, tick):
+
+        self.tick = tick
+        self.counts = array('I', bytes(4 * CONNBUCKETS))
+        self.total = 0
+        self.alerted = False
+
+
+
+    def add(self, tick):
+
+        #clear the buckets that fell out of the window
+        for i in range(1, min(tick - self.tick, CONNBUCKETS) + 1):
+
+            slot = (self.tick + i) % CONNBUCKETS
+            self.total -= self.counts[slot]
+            self.counts[slot] = 0
+
+
+
+        self.tick = max(tick, self.tick)
+        self.counts[self.tick % CONNBUCKETS] += 1
+        self.total += 1
+
+
+
+        return self.total
+
+
+
+class ConnectionTracker:
+    '''
+    This class counts the connection attempts (SYN without ACK) per (src,
+    dst, dport) over a sliding window, so repeated connections are a rate
+    rather than a property of single packets. At most maxkeys keys are
+    counted, each in a fixed size ConnectionCount; past that the least
+    recently seen key is evicted.
+    '''
+
+    def __init__(self, maxkeys, limit):
+
+        self.counts = collections.OrderedDict()
+        self.maxkeys = maxkeys
+        self.limit = limit
+        self.bucketseconds = CONNWINDOW / CONNBUCKETS
+
+
+
+    def add(self, key, now):
+        '''
+        Counts a connection attempt and returns the number of attempts in
+        the window if this one brought it up to the limit, else None.
+        '''
+
+        tick = int(now // self.bucketseconds)
+        count = self.counts.get(key)
+
+
+
+        if count is None:
+
+            count = ConnectionCount(tick)
+            self.counts[key] = count
+
+
+
+            if len(self.counts) > self.maxkeys:
+
+                self.counts.popitem(last=False)
+
+        else:
+
+            self.counts.move_to_end(key)
+
+
+
+        total = count.add(tick)
+
+
+
+        #alert once per run of attempts above the limit
+        if total < self.limit:
+
+            count.alerted = False
+
+            return None
+
+
+
+        if count.alerted:
+
+            return None
+
+
+
+        count.alerted = True
+
+        return total
+
+
+
+class BeaconTracker:
+    '''
+    This class keeps the times of the last BEACONSAMPLES requests from each
+    src to each dst and host, in an array of doubles per key, for at most
+    maxkeys keys (least recently seen evicted). A request older than the
+    last one of its key is dropped so the times stay sorted. Every interval
+    seconds the keys with new requests are scored for periodicity with
+    NumPy, BEACONCHUNK keys per call so a pass never holds up the capture
+    for long; score() is called again right away until all are done.
+    '''
+
+    '''
+    The timestamps of the keys with at least BEACONMIN requests are laid out
+    as the rows of one matrix, padded with NaN. Two scores come out per row:
+    the jitter ratio, the standard deviation of the intervals between
+    requests over their mean, and the spectral peak, the magnitude of the
+    strongest frequency of the request train (binned into BEACONBINS bins
+    over the row's time span) over the number of requests. A steady beacon
+    has a low jitter ratio; a beacon that skips some of its requests still
+    has all of them in phase, so a peak near 1. For n random requests n *
+    peak^2 is about exponentially distributed at each frequency, so the peak
+    is only taken for keys with all BEACONSAMPLES requests and over the
+    frequencies from BEACONMINCYCLES to BEACONMAXCYCLES cycles (a beacon
+    skipping up to half its requests): a random key then reaches BEACONPEAK
+    with a chance of about 1e-5. Rows whose median interval is below
+    BEACONMININTERVAL or half their mean interval are bursts and never
+    count. A key is reported once.
+    '''
+
+    def __init__(self, maxkeys, interval):
+
+        self.times = collections.OrderedDict()
+        self.maxkeys = maxkeys
+        self.interval = interval
+        self.nextscore = 0
+        self.reported = set()
+        self.dirty = {} #keys with requests since they were scored, in order
+
+
+
+    def add(self, key, now):
+
+        times = self.times.get(key)
+
+
+
+        if times is None:
+
+            times = array('d')
+            self.times[key] = times
+
+
+
+            if len(self.times) > self.maxkeys:
+
+                evicted = self.times.popitem(last=False)[0]
+                self.reported.discard(evicted)
+                self.dirty.pop(evicted, None)
+
+        else:
+
+            self.times.move_to_end(key)
+
+
+
+        #a request older than the last one (several interfaces or a clock
+        #stepped back) would break the order the intervals are taken in
+        if times and now < times[-1]:
+
+            return
+
+
+
+        if len(times) == BEACONSAMPLES:
+
+            del times[0]
+
+
+
+        times.append(now)
+        self.dirty[key] = None
+
+
+
+    def score(self, now):
+        '''
+        Scores the next BEACONCHUNK keys with new requests and returns (key,
+        requests, mean interval, jitter ratio, spectral peak) for the new
+        beacons.
+        '''
+
+        chunk = list(itertools.islice(self.dirty, BEACONCHUNK))
+
+
+
+        for key in chunk:
+
+            del self.dirty[key]
+
+
+
+        #keep going while keys are left, else wait for the next interval
+        self.nextscore = now if self.dirty else now + self.interval
+        keys = [key for key in chunk \
+                if len(self.times[key]) >= BEACONMIN \
+                and key not in self.reported]
+
+
+
+        if not keys:
+
+            return []
+
+
+
+        #one row of timestamps per key
+        matrix = numpy.full((len(keys), BEACONSAMPLES), numpy.nan)
+
+
+
+        for row, key in enumerate(keys):
+
+            times = self.times[key]
+            matrix[row, : len(times)] = times
+
+
+
+        #jitter ratio of the intervals
+        intervals = numpy.diff(matrix, axis=1)
+        mean = numpy.nanmean(intervals, axis=1)
+        jitter = numpy.nanstd(intervals, axis=1) / numpy.maximum(mean, 1e-9)
+
+
+
+        #spectral peak of the binned request train of the full rows
+        peak = numpy.zeros(len(keys))
+        full = numpy.nonzero(~numpy.isnan(matrix[:, -1]))[0]
+
+
+
+        if len(full):
+
+            trains = matrix[full]
+            first = trains.min(axis=1)
+            span = numpy.maximum(trains.max(axis=1) - first, 1e-9)
+            indices = numpy.clip(((trains - first[:, None]) / span[:, None] \
+                                  * (BEACONBINS - 1)).astype(int), \
+                                 0, \
+                                 BEACONBINS - 1)
+            train = numpy.zeros((len(full), BEACONBINS))
+            numpy.add.at(train, \
+                         (numpy.arange(len(full))[:, None], indices), \
+                         1)
+            spectrum = numpy.fft.rfft(train, axis=1)
+            peak[full] = numpy.abs(spectrum[:, BEACONMINCYCLES \
+                                             : BEACONMAXCYCLES + 1]) \
+                         .max(axis=1) / BEACONSAMPLES
+
+
+
+        #bursts of requests are not beacons, however regular they are
+        median = numpy.nanmedian(intervals, axis=1)
+        beacons = (median >= BEACONMININTERVAL) & (median * 2 >= mean) \
+                  & ((jitter < BEACONJITTER) | (peak >= BEACONPEAK))
+        results = []
+
+
+
+        for row in numpy.nonzero(beacons)[0]:
+
+            self.reported.add(keys[row])
+            results.append((keys[row], \
+                            len(self.times[keys[row]]), \
+                            float(mean[row]), \
+                            float(jitter[row]), \
+                            float(peak[row])))
+
+
+
+        return results
+
+
+
+class HyperLogLog:
+    '''
+    Estimates the number of distinct values added to it in 2^HLLPRECISION
+    one byte registers, whatever that number is. A value's 64 bit hash picks
+    a register with its low bits and the register keeps the highest rank
+    (leading zeros + 1) seen in the rest; the harmonic mean of 2^rank over
+    the registers estimates the count within about 1.04 / sqrt(registers).
+    Two sketches of the same precision merge by taking the larger register
+    of each pair, which gives the sketch of the union of their values.
+    '''
+
+    __slots__ = ('registers',)
+
+
+
+    def __init__(self, registers=None):
+
+        self.registers = bytearray(registers or HLLREGISTERS)
+
+
+
+    def add(self, value):
+
+        digest = hashlib.blake2b(value, digest_size=8).digest()
+        key = int.from_bytes(digest, "little")
+        index = key & (HLLREGISTERS - 1)
+        rank = 64 - HLLPRECISION - (key >> HLLPRECISION).bit_length() + 1
+
+
+
+        if rank > self.registers[index]:
+
+            self.registers[index] = rank
+
+
+
+    def merge(self, other):
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+
+    def count(self):
+
+        estimate = HLLALPHA * HLLREGISTERS ** 2 \
+                   / sum(map(HLLPOWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+
+
+
+        #linear counting is more accurate while many registers are empty
+        if estimate <= 2.5 * HLLREGISTERS and zeros:
+
+            return HLLREGISTERS * math.log(HLLREGISTERS / zeros)
+
+
+
+        return estimate
+
+
+
+class HostCardinality:
+    '''
+    HyperLogLog sketches of the distinct request paths, cookies and user
+    agents sent to one host, with the estimates of the last check and when
+    it was made, so their growth rate can be worked out.
+    '''
+
+    __slots__ = ('sketches', 'counts', 'checked')
+
+
+
+    def __init__(self, now):
+
+        self.sketches = [HyperLogLog() for name in CARDINALITYNAMES]
+        self.counts = [0.0] * len(CARDINALITYNAMES)
+        self.checked = now
+
+
+
+class CardinalityTable:
+    '''
+    This class keeps a HostCardinality per Host header for at most maxhosts
+    hosts (least recently seen evicted), about 3 KB each. Every
+    CARDINALITYINTERVAL seconds a host's estimates are compared with the
+    last ones; growth faster than maxrate new distinct values per minute is
+    reported. Tables of several workers merge host by host.
+    '''
+
+    def __init__(self, maxhosts, maxrate):
+
+        self.hosts = collections.OrderedDict()
+        self.maxhosts = maxhosts
+        self.maxrate = maxrate
+
+
+
+    def add(self, host, values, now):
+        '''
+        Adds the path, cookie and user agent (None if absent) of a request
+        and returns [(name, new values per minute, estimate)] for those
+        growing too fast, if the host was due for a check.
+        '''
+
+        cardinality = self.hosts.get(host)
+
+
+
+        if cardinality is None:
+
+            cardinality = HostCardinality(now)
+            self.hosts[host] = cardinality
+
+
+
+            if len(self.hosts) > self.maxhosts:
+
+                self.hosts.popitem(last=False)
+
+        else:
+
+            self.hosts.move_to_end(host)
+
+
+
+        for sketch, value in zip(cardinality.sketches, values):
+
+            if value is not None:
+
+                sketch.add(value)
+
+
+
+        elapsed = now - cardinality.checked
+
+
+
+        if elapsed < CARDINALITYINTERVAL:
+
+            return []
+
+
+
+        #compare the estimates with the last check
+        growing = []
+
+
+
+        for i, name in enumerate(CARDINALITYNAMES):
+
+            count = cardinality.sketches[i].count()
+            rate = (count - cardinality.counts[i]) / elapsed * 60
+            cardinality.counts[i] = count
+
+
+
+            if rate > self.maxrate:
+
+                growing.append((name, rate, count))
+
+
+
+        cardinality.checked = now
+
+
+
+        return growing
+
+
+
+    def registers(self):
+        '''
+        Returns the registers of every sketch, to merge in another process.
+        '''
+
+        return {host: [bytes(sketch.registers) \
+                       for sketch in cardinality.sketches] \
+                for host, cardinality in self.hosts.items()}
+
+
+
+    def merge(self, registers):
+        '''
+        Merges the registers of another table, host by host, keeping the
+        maxhosts most recently seen hosts.
+        '''
+
+        for host, sketches in registers.items():
+
+            cardinality = self.hosts.setdefault(host, HostCardinality(0))
+            self.hosts.move_to_end(host)
+
+
+
+            for sketch, other in zip(cardinality.sketches, sketches):
+
+                sketch.merge(HyperLogLog(other))
+
+
+
+        while len(self.hosts) > self.maxhosts:
+
+            self.hosts.popitem(last=False)
+
+
+
+class Segment:
+    '''
+    The fields of a captured TCP/IPv4 segment the checks read, taken straight
+    from the bytes of the frame by dissectFrame instead of a full scapy
+    dissection. The payload is only sliced out of the frame and the scapy
+    packet only built when asked for.
+    '''
+
+    __slots__ = ('frame', 'ipoffset', 'srcip', 'dstip', 'proto', 'srcport', \
+                 'dstport', 'seq', 'flags', 'payloadoffset', 'payloadend', \
+                 'time', 'scapypacket')
+
+
+
+    def payload(self):
+
+        return self.frame[self.payloadoffset : self.payloadend]
+
+
+
+    def packet(self):
+        '''
+        Returns the frame dissected by scapy, built on first use.
+        '''
+
+        if self.scapypacket is None:
+
+            if self.ipoffset == ETHERLENGTH:
+
+                self.scapypacket = Ether(self.frame)
+
+            else:
+
+                self.scapypacket = IP(self.frame[self.ipoffset :])
+
+
+
+            self.scapypacket.time = self.time
+
+
+
+        return self.scapypacket
+
 
 
 #create functions
-def analyzePacket(packet):
+def dissectFrame(frame, linkoffset, now):
+    '''
+    Reads the IPv4 and TCP headers of a frame whose link layer header is
+    linkoffset bytes long (VLAN tags are skipped) and returns a Segment, or
+    None for anything but the first fragment of a TCP/IPv4 packet
+    '''
+
+    #skip the VLAN tags after the ethertype and check for IPv4
+    offset = linkoffset
+
+
+
+    if offset >= ETHERLENGTH:
+
+        while frame[offset - 2 : offset] in VLANTYPES:
+
+            offset += 4
+
+
+
+        if frame[offset - 2 : offset] != IPV4TYPE:
+
+            return None
+
+
+
+    if len(frame) < offset + 20:
+
+        return None
+
+
+
+    versionihl, length, fragment, proto, src, dst \
+    = IPHEADER.unpack_from(frame, offset)
+
+
+
+    if versionihl >> 4 != 4 or fragment & 0x1FFF:
+
+        return None
+
+
+
+    #6 = TCP
+    tcpoffset = offset + (versionihl & 0x0F) * 4
+
+
+
+    if proto != 6 or len(frame) < tcpoffset + 14:
+
+        return None
+
+
+
+    segment = Segment()
+    segment.frame = frame
+    segment.ipoffset = offset
+    segment.srcip = socket.inet_ntoa(src)
+    segment.dstip = socket.inet_ntoa(dst)
+    segment.proto = proto
+    segment.srcport, segment.dstport, segment.seq, dataoffset, segment.flags \
+    = TCPHEADER.unpack_from(frame, tcpoffset)
+    segment.payloadoffset = tcpoffset + (dataoffset >> 4) * 4
+    segment.payloadend = min(offset + length, len(frame))
+    segment.time = now
+    segment.scapypacket = None
+
+
+
+    return segment
+
+
+
+def readSegments(sock):
+    '''
+    This generator yields the Segments captured by a scapy L2listen socket,
+    receiving the raw frames without letting scapy dissect them
+    '''
+
+    while True:
+
+        linktype, frame, now = sock.recv_raw(MAXFRAME)
+        linkoffset = LINKOFFSETS.get(conf.l2types.layer2num.get(linktype))
+
+
+
+        if frame is None or linkoffset is None:
+
+            continue
+
+
+
+        segment = dissectFrame(frame, linkoffset, now)
+
+
+
+        if segment is not None:
+
+            yield segment
+
+
+
+def analyzePacket(segment):
+
+    '''
+    packet analysis function to detect indicators of HTTP tunelling. The
+    checks on the TCP segment itself run here; its payload is reassembled
+    and every HTTP message it completes goes to analyzeMessage
+    '''
+
+
+
+    #extract packet fields
+    srcip = segment.srcip
+    dstip = segment.dstip
+    srcport = segment.srcport
+    dstport = segment.dstport
+
+
+
+    #check for potential indicators
+    #SYN without ACK = connection attempt, counted per destination and port
+    if segment.flags & (SYN | ACK) == SYN:
+
+        attempts = connectiontracker.add((srcip, dstip, dstport), segment.time)
+
+
+
+        if attempts is not None:
+
+            print("Indicator 1: Repeated connections to the same IP address \
+detected ({} in {}s, src={}, dst={}, dport={})".format(attempts, \
+                                                        CONNWINDOW, \
+                                                        srcip, \
+                                                        dstip, \
+                                                        dstport))
+
+            if args.details:
+
+                print("              " + segment.packet().summary())
+
+
+
+    #reassemble the stream and analyze the messages it completed
+    for message in streamtable.add((srcip, srcport, dstip, dstport), \
+                                   segment.seq, \
+                                   segment.flags, \
+                                   segment.payload(), \
+                                   segment.time):
+
+        if isinstance(message, ClientHello):
+
+            analyzeHello(message)
+            request = (message.srcip, message.dstip, message.sni or b"")
+
+        elif message.http.isrequest:
+
+            analyzeMessage(message)
+            analyzeCardinality(message, segment.time)
+            request = (message.srcip, message.dstip, message.http.host or b"")
+
+        else:
+
+            analyzeMessage(message)
+            request = None
+
+
+
+        #remember when each client asked each server for each host
+        if beacontracker is not None and request is not None:
+
+            beacontracker.add(request, segment.time)
+
+
+
+    #score the request times for beaconing every --beacon-interval seconds
+    if beacontracker is not None and segment.time >= beacontracker.nextscore:
+
+        printBeacons(beacontracker.score(segment.time))
+
+
+
+def analyzeCardinality(message, now):
+    '''
+    Counts the distinct paths, cookies and user agents of the host a request
+    is for and prints the ones growing too fast
+    '''
+
+    http = message.http
+    host = http.host or b""
+
+
+
+    for name, rate, count in cardinalitytable.add(host, \
+                                                  [http.path, \
+                                                   http.cookie, \
+                                                   http.useragent], \
+                                                  now):
+
+        print("Indicator {}: Fast growing number of distinct {} for host {} \
+detected ({:.0f} new per minute, about {:.0f} in total)"\
+            .format(6 if name == "user agents" else 1, \
+                    name, \
+                    host.decode("latin-1"), \
+                    rate, \
+                    count))
+
+
+
+def printCardinality():
+    '''
+    Prints the hosts with the most distinct paths, cookies and user agents
+    '''
+
+    counts = sorted(([cardinality.sketches[i].count() \
+                      for i in range(len(CARDINALITYNAMES))], host) \
+                    for host, cardinality in cardinalitytable.hosts.items())
+
+
+
+    print("\n\n\nDistinct values per host (estimated):")
+    print("-------------------------------------")
+
+
+
+    for (paths, cookies, useragents), host in counts[: -11 : -1]:
+
+        print("{}: {:.0f} paths, {:.0f} cookies, {:.0f} user agents"\
+            .format(host.decode("latin-1"), paths, cookies, useragents))
+
+
+
+def printBeacons(beacons):
+    '''
+    Prints the new beacons found by the beacon tracker
+    '''
+
+    for (srcip, dstip, host), requests, mean, jitter, peak in beacons:
+
+        print("Indicator 1: Periodic requests to the same host detected \
+(src={}, dst={}, host={}, {} requests every {:.1f}s, jitter {:.2f}, spectral \
+peak {:.2f})".format(srcip, \
+                     dstip, \
+                     host.decode("latin-1"), \
+                     requests, \
+                     mean, \
+                     jitter, \
+                     peak))
+        print("\n\n\n")
+
+
+
+def isGrease(value):
+    '''
+    Returns whether a TLS value is one of the reserved GREASE values (RFC
+    8701), which clients add at random and JA3 leaves out
+    '''
+
+    return value & 0x0F0F == 0x0A0A and value >> 8 == value & 0xFF
+
+
+
+def ungrease(data):
+    '''
+    Returns the 16 bit values of a TLS list without the GREASE values
+    '''
+
+    values = [int.from_bytes(data[i : i + 2], "big") \
+              for i in range(0, len(data) - 1, 2)]
+
+    return [value for value in values if not isGrease(value)]
+
+
+
+def analyzeHello(hello):
     
     '''
-    packet analysis function to detect indicators of HTTP tunelling
+    handshake analysis function to detect indicators of HTTPS tunelling in a
+    TLS ClientHello, the only part of a TLS stream that is not encrypted
     '''
     
 
 
-    #extract packet fields
-    srcip = packet[IP].src
-    dstip = packet[IP].dst
-    srcport = packet[TCP].sport
-    dstport = packet[TCP].dport
-    httpmethod = packet[Raw].load.split()[0] if Raw in packet else ""
-    useragent = packet[HTTPRequest].User_Agent if HTTPRequest in packet else ""
-    requestsize = len(packet[Raw].load) if Raw in packet else 0 #bytes
-    responsesize = len(packet[Raw].load) if Raw in packet else 0 #bytes
-    httpport = 80 if dstport == 80 else 443 if dstport == 443 else None
+    #extract handshake fields
+    sni = hello.sni.decode("latin-1") if hello.sni is not None else ""
+    alpn = ",".join(protocol.decode("latin-1") \
+                    for protocol in hello.alpn or [])
 
 
 
-    #print packet src and dst
-    print(srcip + " -> " + dstip)
+    #print handshake src and dst
+    print(hello.srcip + " -> " + hello.dstip)
+    print("TLS ClientHello (SNI={}, ALPN={}, JA3={})".format(sni, \
+                                                            alpn, \
+                                                            hello.ja3hash))
 
 
 
     #check for potential indicators
-    #0x018 = TCP flag for repeat connection attempt
-    if packet[TCP].flags == 0x018:
+    if hello.dstport not in [80, 443]:
+
+        print("Indicator 3: Anomalous HTTPS port detected (port {})"\
+            .format(hello.dstport))
+
+    if sni == "":
+
+        print("Indicator 6: Empty or missing SNI in TLS ClientHello")
+
+    if hello.ja3hash in ja3hashes:
+
+        print("Indicator 6: Known tunneling client TLS fingerprint detected \
+(JA3 {})".format(hello.ja3hash))
+
+
+
+    #onto the next message
+    print("\n\n\n")
+
+
+
+def analyzeMessage(message):
+
+    '''
+    message analysis function to detect indicators of HTTP tunelling in a
+    reassembled HTTP request or response
+    '''
+
+
+
+    #extract message fields
+    http = message.http
+    srcip = message.srcip
+    dstip = message.dstip
+    httpmethod = http.method
+    useragent = http.useragent or b""
+    requestsize = message.length if not http.isresponse else 0 #bytes
+    responsesize = message.length if http.isresponse else 0 #bytes
+
+    #the port of the server and of the client, whichever way the message went
+    serverport = message.srcport if http.isresponse else message.dstport
+    clientport = message.dstport if http.isresponse else message.srcport
+    httpport = 80 if serverport == 80 else 443 if serverport == 443 else None
+
+
+
+    #print message src and dst
+    print(srcip + " -> " + dstip)
+
 
-        print("Indicator 1: Repeated connections to the same IP address \
-detected (src={}, dst={}, sport={}, dport={})".format(srcip, \
-                                                      dstip, \
-                                                      srcport, \
-                                                      dstport))
 
+    #check for potential indicators
     if requestsize > 1000000 or responsesize > 1000000:
 
         print("Indicator 2: Large HTTP request or response size detected.")
@@ -125,121 +2069,499 @@ detected (src={}, dst={}, sport={}, dport={})".format(srcip, \
     if httpport not in [80, 443]:
 
         print("Indicator 3: Anomalous HTTP port detected (port {})"\
-            .format(dstport))
+            .format(serverport))
 
-    if httpmethod == "CONNECT":
+    if httpmethod == b"CONNECT":
 
         print("Indicator 4: Unusual HTTP method detected (CONNECT)")
     
-    if "Content-Encoding" in str(packet) and "gzip" in str(packet):
+    if http.encoding is not None and b"gzip" in http.encoding:
 
         print("Indicator 5: HTTP compression detected (gzip)")
-    
-    if useragent == "":
 
-        print("Indicator 6: Empty or missing user agent detected")
+    #a text body that is not declared as encoded should compress well
+    if http.encoding is None and http.contenttype is not None \
+    and TEXTPATTERN.search(http.contenttype) \
+    and message.body.sampled >= BODYMIN \
+    and message.body.entropy() >= BODYENTROPY \
+    and message.body.ratio() >= BODYRATIO:
+
+        print("Indicator 5: Compressed or encrypted data in a text body \
+detected ({}, {:.2f} bits/byte, compresses to {:.0%})"\
+            .format(http.contenttype.decode("latin-1"), \
+                    message.body.entropy(), \
+                    message.body.ratio()))
+
+    #or be readable text rather than random data spelled out in base64/hex
+    elif http.encoding is None and http.contenttype is not None \
+    and TEXTPATTERN.search(http.contenttype) \
+    and message.body.sampled >= BODYMIN \
+    and message.body.encoding() is not None:
+
+        print("Indicator 5: Encoded random data in a text body detected \
+({}, {}, {:.2f} bits/byte)"\
+            .format(http.contenttype.decode("latin-1"), \
+                    message.body.encoding(), \
+                    message.body.entropy()))
     
-    #6 = TCP, 17 = UDP
-    if packet[IP].proto not in [6, 17]:
+    if http.isrequest and useragent == b"":
 
-        print("Indicator 7: HTTP traffic over non-HTTP protocol detected \
-(protocol {})".format(packet[IP].proto))
+        print("Indicator 6: Empty or missing user agent detected")
     
-    if srcport > 1024 and srcport not in [80, 443] and httpport == None:
+    if clientport > 1024 and clientport not in [80, 443] and httpport == None:
 
         print("Indicator 8: Non-standard port detected (port {})"\
-            .format(srcport))
+            .format(clientport))
 
-    if requestsize > 100000 and httpmethod != "POST":
+    if requestsize > 100000 and httpmethod != b"POST":
 
         print("Indicator 9: Large amount of data transferred in a short amount \
 of time ({} bytes)".format(requestsize))
 
 
 
-    #resource saving if
-    if Raw in packet:
-        
-        #serialize packet[Raw]
-        raw = str(packet[Raw].load)
+    #check for potential violations
+    if requestsize and not http.valid:
 
+        print("Violation 10: Invalid request syntax detected: " \
+              + http.startline.decode("latin-1"))
 
+    if responsesize and not http.valid:
 
-        #check for potential violations
-        #match the first line of an HTTP request or response message
-        if not re.search(r"^([A-Z]+) /(\S+) HTTP/(\d\.\d)$", raw):
+        print("Violation 11: Invalid response syntax detected: " \
+              + http.startline.decode("latin-1"))
 
-            print("Violation 10: Invalid request syntax detected: " + raw)
-        
-        #match the first line and captures the version and status code
-        if not re.search(r"^HTTP/(\d\.\d) (\d{3}) .*$", raw):
+    if http.isrequest and http.host is None:
 
-            print("Violation 11: Invalid response syntax detected: " + raw)
-        
-        if HTTPRequest in packet and "Host" not in packet[HTTPRequest].fields:
+        print("Violation 12: Missing Host header in HTTP request")
 
-            print("Violation 12: Missing Host header in HTTP request")
-        
-        if HTTPRequest in packet and packet[HTTPRequest].fields["Host"] == "":
+    if http.isrequest and http.host == b"":
 
-            print("Violation 12: Empty Host header in HTTP request")
-        
-        if HTTPRequest in packet and httpmethod not in ["GET", \
-                                                        "HEAD", \
-                                                        "POST", \
-                                                        "PUT", \
-                                                        "DELETE", \
-                                                        "CONNECT", \
-                                                        "OPTIONS", \
-                                                        "TRACE"]:
-
-            print("Violation 13: Unsupported HTTP method: " + httpmethod)
-
-        #match a URL
-        if HTTPRequest in packet and not \
-        re.search(r"^[a-zA-Z0-9\-\._~:/\?#\[\]@!\$&'\(\)\*\+,;=]*$",\
-                  packet[HTTPRequest].Path):
+        print("Violation 12: Empty Host header in HTTP request")
 
-            print("Violation 14: Invalid characters in HTTP request URL \
-detected: " + packet[HTTPRequest].Path)
+    if http.isrequest and httpmethod not in METHODS:
 
-        if HTTPRequest in packet and packet[HTTPRequest].Path == "":
-            
-            print("Violation 14: Empty HTTP request URL detected")
-        
-        if HTTPResponse in packet and packet[HTTPResponse].Status_Code == "":
-         
-            print("Violation 15: Empty HTTP response status code detected")
+        print("Violation 13: Unsupported HTTP method: " \
+              + httpmethod.decode("latin-1"))
+
+    if http.isrequest and not URLPATTERN.fullmatch(http.path):
+
+        print("Violation 14: Invalid characters in HTTP request URL \
+detected: " + http.path.decode("latin-1"))
+
+    if http.isrequest and http.path == b"":
         
-        #match the first line of an HTTP response
-        if HTTPResponse in packet and not \
-        re.search(r"^HTTP/(\d\.\d) \d{3} .*$", str(packet[HTTPResponse])):
-            
-            print("Violation 15: Invalid HTTP response status line detected: "\
-                  + str(packet[HTTPResponse]))
+        print("Violation 14: Empty HTTP request URL detected")
+
+    if http.isresponse and http.status == b"":
+
+        print("Violation 15: Empty HTTP response status code detected")
+
+    if http.isresponse and not http.valid:
         
-        #match a string that represents an HTTP cookie
-        if HTTPRequest in packet and "Cookie" in packet[HTTPRequest].fields \
-        and not re.search(r"^[a-zA-Z0-9\-\._~:\+%/]*=\S*$", \
-                          packet[HTTPRequest].fields["Cookie"]):
+        print("Violation 15: Invalid HTTP response status line detected: "\
+              + http.startline.decode("latin-1"))
 
-            print("Violation 16: Potential invalid HTTP cookie format detected: "\
-                  + packet[HTTPRequest].fields["Cookie"])
+    if http.isrequest and http.cookie is not None \
+    and not COOKIEPATTERN.fullmatch(http.cookie):
 
+        print("Violation 16: Potential invalid HTTP cookie format detected: "\
+              + http.cookie.decode("latin-1"))
 
 
-    #onto the next packet
+
+    #onto the next message
     print("\n\n\n")
 
 
 
+def scapyParse(head):
+    '''
+    Parses a message head the way analyzeMessage used to, with scapy's HTTP
+    layers and a str copy of the start line for the regexes. Only kept as
+    the baseline of --benchmark.
+    '''
+
+    http = HTTP(head)
+    request = http[HTTPRequest] if HTTPRequest in http else None
+    response = http[HTTPResponse] if HTTPResponse in http else None
+    startline = head.split(b"\r\n", 1)[0].decode("latin-1")
+    re.search(r"^([A-Z]+) /(\S*) HTTP/(\d\.\d)$", startline)
+    re.search(r"^HTTP/(\d\.\d) (\d{3}) .*$", startline)
+
+
+
+    if request:
+
+        request.Method.decode("latin-1")
+        request.User_Agent, request.Host
+        re.search(r"^[a-zA-Z0-9\-\._~:/\?#\[\]@!\$&'\(\)\*\+,;=]*$",\
+                  request.Path.decode("latin-1"))
+
+
+
+        if request.Cookie is not None:
+
+            re.search(r"^[a-zA-Z0-9\-\._~:\+%/]*=\S*$", \
+                      request.Cookie.decode("latin-1"))
+
+
+
+    if response:
+
+        response.Status_Code
+        re.search(r"^HTTP/(\d\.\d) \d{3} .*$", startline)
+
+
+
+    return request or response
+
+
+
+def scapyDissect(frame):
+    '''
+    Dissects a frame the way st.py used to, with scapy, and reads the same
+    fields as dissectFrame. Only kept as the baseline of --benchmark.
+    '''
+
+    packet = Ether(frame)
+
+
+
+    if IP not in packet or TCP not in packet:
+
+        return None
+
+
+
+    payloadsize = packet[IP].len - packet[IP].ihl * 4 - packet[TCP].dataofs * 4
+
+    return (packet[IP].src, \
+            packet[IP].dst, \
+            packet[IP].proto, \
+            packet[TCP].sport, \
+            packet[TCP].dport, \
+            packet[TCP].seq, \
+            int(packet[TCP].flags), \
+            bytes(packet[TCP].payload)[: max(payloadsize, 0)])
+
+
+
+def fastDissect(frame):
+    '''
+    Reads the same fields as scapyDissect with dissectFrame, for --benchmark.
+    '''
+
+    segment = dissectFrame(frame, ETHERLENGTH, 0)
+
+
+
+    if segment is None:
+
+        return None
+
+
+
+    return (segment.srcip, \
+            segment.dstip, \
+            segment.proto, \
+            segment.srcport, \
+            segment.dstport, \
+            segment.seq, \
+            segment.flags, \
+            segment.payload())
+
+
+
+def timeRuns(stage, items, runs):
+    '''
+    Prints how long each (name, function) of runs takes to go over items
+    BENCHMARKROUNDS times.
+    '''
+
+    for name, run in runs:
+
+        start = time.perf_counter()
+
+
+
+        for i in range(BENCHMARKROUNDS):
+
+            for item in items:
+
+                run(item)
+
+
+
+        elapsed = time.perf_counter() - start
+        peritem = elapsed / max(len(items) * BENCHMARKROUNDS, 1) * 1e6
+
+        print(f"{stage:>6} {name:>12}: {elapsed:.3f}s, {peritem:.1f}us each")
+
+
+
+def benchmarkCapture(path):
+    '''
+    Times the two halves of the per-packet work on an ethernet capture file:
+    dissecting every frame with scapy and with dissectFrame, then parsing
+    the head of every reassembled HTTP message with scapy's HTTP layers and
+    with HttpHead.
+    '''
+
+    reader = RawPcapReader(path)
+
+
+
+    if LINKOFFSETS.get(reader.linktype) != ETHERLENGTH:
+
+        sys.exit(f"Unsupported pcap link type {reader.linktype}.")
+
+
+
+    frames = [frame for frame, metadata in reader]
+    table = StreamTable(args.max_streams, args.stream_timeout)
+    heads = []
+
+
+
+    #reassemble the messages once to get their heads
+    for frame in frames:
+
+        segment = dissectFrame(frame, ETHERLENGTH, 0)
+
+
+
+        if segment is None:
+
+            continue
+
+
+
+        for message in table.add((segment.srcip, \
+                                  segment.srcport, \
+                                  segment.dstip, \
+                                  segment.dstport), \
+                                 segment.seq, \
+                                 segment.flags, \
+                                 segment.payload(), \
+                                 segment.time):
+
+            if isinstance(message, HttpMessage):
+
+                heads.append(message.head)
+
+
+
+    print(f"\n\n\nGoing over {len(frames)} frames and {len(heads)} message \
+heads from {path} {BENCHMARKROUNDS} times...\n")
+
+    timeRuns("frames", frames, [("scapy", scapyDissect), \
+                                ("dissectFrame", fastDissect)])
+    timeRuns("heads", heads, [("scapy", scapyParse), \
+                              ("HttpHead", HttpHead)])
+
+
+
+    if numpy is not None:
+
+        benchmarkBeacons()
+
+
+
+def benchmarkBeacons():
+    '''
+    Scores BENCHMARKKEYS keys of random (Poisson) requests, 30 seconds apart
+    on average, for beaconing at a few request counts. None of them are
+    beacons, so every key reported is a false positive.
+    '''
+
+    print(f"\nScoring {BENCHMARKKEYS} keys of random requests for \
+beaconing...\n")
+
+
+
+    for requests in (BEACONMIN, BEACONSAMPLES // 2, BEACONSAMPLES):
+
+        tracker = BeaconTracker(BENCHMARKKEYS, args.beacon_interval)
+
+
+
+        for key in range(BENCHMARKKEYS):
+
+            now = 0
+
+
+
+            for i in range(requests):
+
+                now += random.expovariate(1 / 30)
+                tracker.add(key, now)
+
+
+
+        #score until every key is done, one chunk per call
+        start = time.perf_counter()
+        beacons = []
+        calls = 0
+
+
+
+        while tracker.dirty:
+
+            beacons += tracker.score(now)
+            calls += 1
+
+
+
+        elapsed = time.perf_counter() - start
+
+        print(f"{requests} requests: {len(beacons)} false positives \
+({len(beacons) / BENCHMARKKEYS:.3%}), {elapsed / calls * 1000:.1f} ms per \
+call")
+
+
+
+def sniffWorker(groupid):
+    '''
+    Runs analyzePacket in a --workers process on its fanout share of the
+    port 80 and 443 traffic.
+    '''
+
+    sock = conf.L2listen(filter="tcp port 80 or tcp port 443")
+    pf.joinFanout(sock.ins, groupid)
+
+
+
+    try:
+
+        for segment in readSegments(sock):
+
+            pf.countPackets()
+            analyzePacket(segment)
+
+
+
+    finally:
+
+        #hand the sketches to the parent to merge
+        pf.sendResult(cardinalitytable.registers())
+
+
+
+#parse command line arguments
+parser = argparse.ArgumentParser(description="Check for potential HTTP \
+tunneling")
+parser.add_argument("--workers", type=int, default=1, \
+                    help="number of capture processes sharing the traffic \
+through PACKET_FANOUT (default: 1)")
+parser.add_argument("--max-streams", type=int, default=MAXSTREAMS, \
+                    help="hard cap on TCP streams reassembled at once \
+(default: {})".format(MAXSTREAMS))
+parser.add_argument("--stream-timeout", type=float, default=STREAMTIMEOUT, \
+                    help="seconds before an idle stream is dropped (default: \
+{})".format(STREAMTIMEOUT))
+parser.add_argument("--max-connections", type=int, default=30, \
+                    help="connection attempts to the same IP address and \
+port within {} seconds reported as repeated connections (default: 30)"\
+                    .format(CONNWINDOW))
+parser.add_argument("--ja3", default="", \
+                    help="comma separated JA3 hashes of known tunneling \
+clients to report (default: none)")
+parser.add_argument("--beacon-interval", type=float, default=60, \
+                    help="seconds between scoring the request times of all \
+clients for beaconing, 0 to disable; needs NumPy (default: 60)")
+parser.add_argument("--max-distinct-rate", type=float, default=100, \
+                    help="new distinct paths, cookies or user agents per \
+minute for one host reported as fast growing (default: 100)")
+parser.add_argument("--details", action="store_true", \
+                    help="print the scapy summary of flagged packets")
+parser.add_argument("--benchmark", metavar="PCAP", \
+                    help="time dissecting the frames and parsing the HTTP \
+messages of an ethernet capture file with scapy and with the fast path, check \
+beacon scoring on random requests, then exit")
+args = parser.parse_args()
+
+
+
+#create the TCP stream reassembly table
+streamtable = StreamTable(args.max_streams, args.stream_timeout)
+
+
+
+#parse the JA3 hashes to report
+ja3hashes = set(ja3.strip().lower() for ja3 in args.ja3.split(",") if ja3)
+
+
+
+#create the beacon tracker, if it can score
+beacontracker = None
+
+
+
+if args.beacon_interval and numpy is None:
+
+    print("Beaconing detection needs NumPy (pip3 install numpy), skipping \
+it.")
+
+elif args.beacon_interval:
+
+    beacontracker = BeaconTracker(MAXBEACONKEYS, args.beacon_interval)
+
+
+
+#create the per host distinct value sketches
+cardinalitytable = CardinalityTable(MAXCARDINALITYHOSTS, \
+                                    args.max_distinct_rate)
+
+
+
+#create the connection attempt tracker
+connectiontracker = ConnectionTracker(MAXCONNKEYS, args.max_connections)
+
+
+
+#compare scapy and the fast path on a capture file
+if args.benchmark:
+
+    benchmarkCapture(args.benchmark)
+
+    sys.exit(0)
+
+
+
 #sniff on all interfaces
-print("\n\n\nIndicators will be printed for each packet. If you want a record \
-    outside of STDOUT, restart this script and output to your file.")
+print("\n\n\nIndicators will be printed for each HTTP message. If you want a \
+record outside of STDOUT, restart this script and output to your file.")
 print("[ctrl+c to exit sniffing]")
 
 time.sleep(5)
 
 print("\n\n\nChecking for HTTP Tunelling indicators and HTTP Violations...\n\n\n")
 
-sniff(filter="tcp port 80 or tcp port 443", prn=analyzePacket)
\ No newline at end of file
+#spread the flows over several processes
+if args.workers > 1:
+
+    pf.runWorkers(args.workers, sniffWorker, merge=cardinalitytable.merge)
+    printCardinality()
+
+    sys.exit(0)
+
+
+
+sock = conf.L2listen(filter="tcp port 80 or tcp port 443")
+
+
+
+try:
+
+    for segment in readSegments(sock):
+
+        analyzePacket(segment)
+
+except KeyboardInterrupt:
+
+    pass
+
+
+
+printCardinality()
\ No newline at end of file
@@ -47,6 +47,7 @@
 
 #import dependencies
 import scapy.all as scapy #sudo pip3 install scapy
+from array import array
 import os
 import shutil
 
@@ -83,43 +84,67 @@ print(f"Sniffing for {packetcount} packets from {ip}...")
 
 
 
-#sniff packets and provide status
-packets = []
+#packets go straight to sample.pcap, only their times and IP-IDs are kept
+writer = scapy.PcapWriter(f"{TARGETDIR}/sample.pcap")
+times = array('d')
+ipids = array('H')
+captured = 0
 
-for i in range(packetcount):
 
-    packet = scapy.sniff(filter=f"src host {ip}", count=1)[0]
 
-    packets.append(packet)
+#write each packet out and provide status
+def storePacket(packet):
+
+    global captured
+    captured += 1
+
+    writer.write(packet)
+
+    if packet.haslayer('IP'):
+
+        times.append(float(packet.time))
+        ipids.append(packet['IP'].id)
 
     print(packet)
 
-    if (i + 1) % 5 == 0:
+    if captured % 5 == 0:
 
-        print(f"\n{i+1} packets captured.\n")
+        print(f"\n{captured} packets captured.\n")
 
 
 
-#extract IP-IDs
-ipids = []
+#sniff packets in one capture session so none are missed between reads
+try:
 
-for packet in packets:
+    scapy.sniff(filter=f"src host {ip}", \
+                count=packetcount, \
+                prn=storePacket, \
+                store=False)
+
+finally:
+
+    writer.close()
 
-    if packet.haslayer('IP'):
 
-        ipids.append(packet['IP'].id)
 
+#determine patterned behavior, IP-IDs wrap around after 65535
+if not ipids:
 
+    print("\nNo IP-ID values captured.")
 
-#determine patterned behavior
-if all(x == ipids[0] for x in ipids):
+elif all(x == ipids[0] for x in ipids):
 
     print("\nIP-ID values are constant.")
 
-elif all(x == ipids[0]+i for i, x in enumerate(ipids)):
+elif all(x == (ipids[0]+i) & 0xFFFF for i, x in enumerate(ipids)):
 
     print("\nIP-ID values are incremented sequentially.")
 
+    if times[-1] > times[0]:
+
+        print(f"The IP-ID advanced {len(ipids) - 1} in \
+{times[-1] - times[0]:.3f} seconds.")
+
 else:
 
     print("\nIP-ID values are random.")
@@ -145,9 +170,7 @@ else:
 
 
 
-#output to sample.pcap file and ipids.txt for further analysis
-scapy.wrpcap(f"{TARGETDIR}/sample.pcap", packets)
-
+#output ipids.txt for further analysis, sample.pcap is already written
 with open(f"{TARGETDIR}/ipids.txt", 'w') as file:
 
     for ip_id in ipids:
@@ -156,4 +179,4 @@ with open(f"{TARGETDIR}/ipids.txt", 'w') as file:
 
 print("\nCaptured packets saved in ../res/output/sample.pcap file.")
 print("\nIP-ID values saved in ../res/output/ipids.txt file.")
-print("\nExiting...\n")
\ No newline at end of file
+print("\nExiting...\n")